@@ -9,12 +9,45 @@
 # warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
 #
 
+import cProfile
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
 import logging
+import os
+import queue
+import re
+import shutil
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
 
 from abc import ABCMeta, abstractmethod
 
 import sys, traceback
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+try:
+    import bz2
+except ImportError:  # optional in Python builds
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:  # optional in Python builds
+    lzma = None
+
 
 # Exceptions
 class AnnexError(Exception):
@@ -54,6 +87,17 @@ class NotLinkedError(AnnexError):
     """
 
 
+def _keysize(key):
+    """
+    Returns the size encoded in the -s field of a key, or None if the key has none.
+    """
+    fields = key.split("--", 1)[0].split("-")
+    for field in fields[1:]:
+        if field.startswith("s") and field[1:].isdigit():
+            return int(field[1:])
+    return None
+
+
 class AnnexLoggingHandler(logging.StreamHandler):
     """
     Stream Handler that sends log records to git annex via the special remote protocol
@@ -92,12 +136,39 @@ class SpecialRemote(metaclass=ABCMeta):
         Providing them makes `git annex initremote` work better, because it can check the user's input,
         and can also display a list of settings with descriptions.
         Note that the user is not required to provided all the settings listed here.
+    cost_estimator : CostEstimator
+        If set, measures the latency and throughput of the remote, and the default
+        getcost() reports a cost derived from them. None by default.
+    content_cache : ContentCache
+        If set, keys are served from this local cache if possible, and retrieved keys
+        are added to it. None by default.
+    url_claims : UrlClaims
+        If set, CLAIMURL requests for the urls it matches are answered without
+        calling claimurl(). None by default.
+    whereis_cache : WhereisCache
+        If set, the replies of whereis() are remembered for a while. None by default.
+    circuit_breaker : CircuitBreaker
+        If set, requests fail right away while the remote seems to be unreachable.
+        None by default.
+    checkurl_workers : int
+        The number of threads resolving lazy sizes returned by checkurl().
+    checkurl_timeout : float
+        The number of seconds after which lazy sizes which haven't been resolved
+        are reported as UNKNOWN.
     """
 
+    checkurl_workers = 8
+    checkurl_timeout = 30
+
     def __init__(self, annex):
         self.annex = annex
         self.info = {}
         self.configs = {}
+        self.cost_estimator = None
+        self.content_cache = None
+        self.url_claims = None
+        self.whereis_cache = None
+        self.circuit_breaker = None
 
     @abstractmethod
     def initremote(self):
@@ -233,12 +304,16 @@ class SpecialRemote(metaclass=ABCMeta):
         veryExpensiveRemoteCost = 1000
         (taken from Config/Cost.hs)
 
+        If `cost_estimator` is set, the default implementation returns its estimate.
+
         Returns
         -------
         int
             Indicates the cost of the remote.
         """
-        raise UnsupportedRequest()
+        if self.cost_estimator is None:
+            raise UnsupportedRequest()
+        return self.cost_estimator.cost()
 
     def getavailability(self):
         """
@@ -248,6 +323,9 @@ class SpecialRemote(metaclass=ABCMeta):
         -------
         str
             Allowed values are "global" or "local".
+            "unavailable" means that the remote can't be used at the moment, eg. because
+            its server is down. It is reported as "global" to git-annex versions
+            which don't support the UNAVAILABLERESPONSE extension.
 
         """
         raise UnsupportedRequest()
@@ -255,7 +333,7 @@ class SpecialRemote(metaclass=ABCMeta):
     def claimurl(self, url):
         """
         Asks the remote if it wishes to claim responsibility for downloading an url.
-
+        If `url_claims` is set, this is only called for the urls it doesn't match.
 
         Parameters
         ----------
@@ -287,6 +365,12 @@ class SpecialRemote(metaclass=ABCMeta):
 
             In order to provide additional information, a list of dictionaries can be returned.
             The dictionaries can have 3 keys: {'url': str, 'size': int, 'filename': str}. All of them are optional.
+            Instead of a list, a generator may be returned, eg. for playlists of many urls.
+
+            If looking up the sizes is slow, 'size' can be a callable which returns the size
+            (or raises RemoteError). These are called concurrently on `checkurl_workers` threads,
+            and the sizes not known after `checkurl_timeout` seconds are reported as UNKNOWN:
+            [{'url': url, 'size': functools.partial(self.lookup_size, url)} for url in urls]
 
             If there is only one file to be downloaded, we could return:
             [{'size': 512, 'filename':'example_file.txt'}]
@@ -306,6 +390,7 @@ class SpecialRemote(metaclass=ABCMeta):
         content of a key stored in it, such as eg, public urls. This will be displayed
         to the user by eg, git annex whereis.
         Note that users expect git annex whereis to run fast, without eg, network access.
+        If that can't be avoided, set a `whereis_cache`.
 
         Parameters
         ----------
@@ -386,8 +471,15 @@ class ExportRemote(SpecialRemote):
         Providing them makes `git annex initremote` work better, because it can check the user's input,
         and can also display a list of settings with descriptions.
         Note that the user is not required to provided all the settings listed here.
+    export_manifest : ExportManifest
+        If set, records which key is exported to which path, so that CHECKPRESENTEXPORT
+        can be answered without asking the remote. None by default.
     """
 
+    def __init__(self, annex):
+        super().__init__(annex)
+        self.export_manifest = None
+
     def exportsupported(self):
         return True
 
@@ -413,6 +505,12 @@ class ExportRemote(SpecialRemote):
             It will be in the form of a relative path, and may contain
             path separators, whitespace, and other special characters.
 
+        Returns
+        -------
+        str
+            Optionally the ETag (or a similar version identifier) of the stored file,
+            which is recorded in the export manifest.
+
         Raises
         ------
         RemoteError
@@ -517,6 +615,10 @@ class ExportRemote(SpecialRemote):
         Requests the remote rename a file stored on it from `filename` to `new_filename`.
         Remotes that support exports but not renaming do not need to implement this.
 
+        By default, the file is copied with copyexport() and the old one is removed
+        with removeexport(). If copyexport() isn't implemented either, git-annex
+        uploads the file again under the new name.
+
         Parameters
         ----------
         key : str
@@ -531,504 +633,2762 @@ class ExportRemote(SpecialRemote):
         RemoteError
             If the the remote directory couldn't be deleted.
         """
+        if (
+            self.export_manifest is not None
+            and self.export_manifest.checkpresent(key, filename) is False
+        ):
+            raise RemoteError("{} is not exported to {}".format(key, filename))
+        self.copyexport(key, filename, new_filename)
+        self.removeexport(key, filename)
+
+    def copyexport(self, key, filename, new_filename):
+        """
+        Requests the remote to copy a file stored on it from `filename` to `new_filename`
+        without transferring its content, eg. with a server-side copy request.
+        Optional; if it is implemented together with `export_manifest`, renames become
+        copies and keys exported to several paths are only uploaded once.
+
+        Parameters
+        ----------
+        key : str
+            The key of the file to copy.
+        filename : str
+            The path of the existing file.
+        new_filename : str
+            The path of the copy.
+
+        Returns
+        -------
+        str
+            Optionally the ETag of the copy, which is recorded in the export manifest.
+
+        Raises
+        ------
+        RemoteError
+            If the file couldn't be copied.
+        """
         raise UnsupportedRequest()
 
+    def removeexports(self, files):
+        """
+        Requests the remote to remove several exported files at once, eg. with a bulk
+        delete request. Optional; used by removeexporttree() if implemented.
 
-class Protocol(object):
-    """
-    Helper class handling the receiving part of the protocol (git-annex to remote)
-    It parses the requests coming from git-annex and calls the respective
-    method of the remote object.
+        Parameters
+        ----------
+        files : list
+            A tuple (key, remote_file) for each file to remove. The key is None
+            for files only known from listexport().
 
-    It is not further documented as it was never intended to be part of the public API.
-    """
+        Raises
+        ------
+        RemoteError
+            If the files couldn't be removed.
+        """
+        raise UnsupportedRequest()
 
-    def __init__(self, remote):
-        self.remote = remote
-        self.version = "VERSION 1"
-        self.exporting = False
-        self.extensions = list()
+    def removeexporttree(self, remote_directory, workers=8, batch_size=1000):
+        """
+        Removes all files below `remote_directory`, to be used by removeexportdirectory()
+        for remotes that don't have real directories, eg. object stores:
 
-    def command(self, line):
-        line = line.strip()
-        parts = line.split(" ", 1)
-        if not parts:
-            raise ProtocolError("Got empty line")
+            def removeexportdirectory(self, remote_directory):
+                self.removeexporttree(remote_directory)
 
-        method = self.lookupMethod(parts[0]) or self.do_UNKNOWN
+        The files are taken from the export manifest if there is one, otherwise from
+        listexport(). They are removed with removeexports() in batches of `batch_size`
+        if it is implemented, otherwise one by one with removeexport(), either way
+        on a pool of `workers` threads.
 
+        Raises
+        ------
+        RemoteError
+            If a file couldn't be removed. The remaining files are not removed then.
+        """
+        prefix = remote_directory.rstrip("/") + "/"
+        if self.export_manifest is not None:
+            files = [
+                (key, path)
+                for path, key in self.export_manifest.listdirectory(remote_directory)
+            ]
+        else:
+            files = [
+                (None, path)
+                for path, size, etag in self.listexport()
+                if path.startswith(prefix)
+            ]
+        if not files:
+            return
+        batches = [files[i : i + batch_size] for i in range(0, len(files), batch_size)]
         try:
-            if len(parts) == 1:
-                reply = method()
-            else:
-                reply = method(parts[1])
-        except TypeError as e:
-            raise SyntaxError(e)
+            self._remove_batch(batches[0], True)
+        except UnsupportedRequest:
+            batches = [[file_] for file_ in files]
+            bulk = False
         else:
-            if method != self.do_EXPORT:
-                self.exporting = False
-            return reply
+            batches = batches[1:]
+            bulk = True
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            futures = [pool.submit(self._remove_batch, b, bulk) for b in batches]
+            _, not_done = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_EXCEPTION
+            )
+            for future in not_done:
+                future.cancel()
+            concurrent.futures.wait(futures)
+            for future in futures:
+                if not future.cancelled():
+                    future.result()
+
+    def _remove_batch(self, files, bulk):
+        if bulk:
+            self.removeexports(files)
+        else:
+            for key, path in files:
+                self.removeexport(key, path)
+        if self.export_manifest is not None:
+            for key, path in files:
+                self.export_manifest.remove(path)
 
-    def lookupMethod(self, command):
-        return getattr(self, "do_" + command.upper(), None)
+    def listexport(self):
+        """
+        Lists all files of the export, to rebuild the export manifest.
+        Only needs to be implemented if `export_manifest` or removeexporttree() is used.
 
-    def check_key(self, key):
-        if len(key.split()) != 1:
-            raise ValueError("Invalid key. Key contains whitespace character")
+        Returns
+        -------
+        iterable
+            A tuple (remote_file, size, etag) for each file, where size and etag may be None.
 
-    def do_UNKNOWN(self, *arg):
+        Raises
+        ------
+        RemoteError
+            If the files couldn't be listed.
+        """
         raise UnsupportedRequest()
 
-    def do_INITREMOTE(self):
-        try:
-            self.remote.initremote()
-        except RemoteError as e:
-            return "INITREMOTE-FAILURE {e}".format(e=e)
-        else:
-            return "INITREMOTE-SUCCESS"
 
-    def do_EXTENSIONS(self, param):
-        self.extensions = param.split(" ")
-        return "EXTENSIONS"
+class ExportDirectories(object):
+    """
+    Remembers which directories of an export have been created, so that remotes
+    which need to create directories before storing a file (eg. with mkdir or WebDAV's
+    MKCOL) only do so once per directory, even if files are stored concurrently.
 
-    def do_PREPARE(self):
-        try:
-            self.remote.prepare()
-        except RemoteError as e:
-            return "PREPARE-FAILURE {e}".format(e=e)
-        else:
-            return "PREPARE-SUCCESS"
+    Example:
+        def prepare(self):
+            self.directories = ExportDirectories(self._mkdir)
 
-    def do_TRANSFER(self, param):
-        try:
-            (method, key, file_) = param.split(" ", 2)
-        except ValueError:
-            raise SyntaxError("Expected Key File")
+        def transferexport_store(self, key, local_file, remote_file):
+            self.directories.create(remote_file)
+            ...
 
-        if not (method == "STORE" or method == "RETRIEVE"):
-            return self.do_UNKNOWN()
+        def removeexportdirectory(self, remote_directory):
+            ...
+            self.directories.forget(remote_directory)
 
-        func = getattr(self.remote, "transfer_{}".format(method.lower()), None)
-        try:
-            func(key, file_)
-        except RemoteError as e:
-            return "TRANSFER-FAILURE {method} {key} {e}".format(
-                method=method, key=key, e=e
-            )
-        else:
-            return "TRANSFER-SUCCESS {method} {key}".format(method=method, key=key)
+    ...
 
-    def do_CHECKPRESENT(self, key):
-        self.check_key(key)
-        try:
-            if self.remote.checkpresent(key):
-                return "CHECKPRESENT-SUCCESS {key}".format(key=key)
-            else:
-                return "CHECKPRESENT-FAILURE {key}".format(key=key)
-        except RemoteError as e:
-            return "CHECKPRESENT-UNKNOWN {key} {e}".format(key=key, e=e)
+    Attributes
+    ----------
+    mkdir : callable
+        Called with the relative path of each directory to be created, parents first.
+        Must not fail if the directory exists already.
+    """
 
-    def do_REMOVE(self, key):
-        self.check_key(key)
+    def __init__(self, mkdir):
+        self.mkdir = mkdir
+        self._created = set()
+        self._creating = {}
+        self._lock = threading.Lock()
 
-        try:
-            self.remote.remove(key)
-        except RemoteError as e:
-            return "REMOVE-FAILURE {key} {e}".format(key=key, e=e)
+    def create(self, remote_file):
+        """
+        Creates the directories `remote_file` is in, unless they have been created before.
+        """
+        parts = remote_file.split("/")[:-1]
+        for i in range(len(parts), 0, -1):
+            if "/".join(parts[:i]) in self._created:
+                break
         else:
-            return "REMOVE-SUCCESS {key}".format(key=key)
+            i = 0
+        for j in range(i + 1, len(parts) + 1):
+            self._mkdir("/".join(parts[:j]))
 
-    def do_LISTCONFIGS(self):
-        reply = []
-        for name, description in sorted(self.remote.listconfigs().items()):
-            if " " in name:
-                raise ValueError(
-                    "Name must not contain space characters: {}".format(name)
-                )
-            reply.append("CONFIG {} {}".format(name, description))
-        reply.append("CONFIGEND")
-        return "\n".join(reply)
+    def forget(self, remote_directory):
+        """
+        Forgets that `remote_directory` and the directories below it have been created.
+        """
+        remote_directory = remote_directory.rstrip("/")
+        prefix = remote_directory + "/"
+        with self._lock:
+            self._created = {
+                d
+                for d in self._created
+                if d != remote_directory and not d.startswith(prefix)
+            }
+
+    def _mkdir(self, directory):
+        with self._lock:
+            if directory in self._created:
+                return
+            lock = self._creating.setdefault(directory, threading.Lock())
+        # other threads storing files in the same directory wait for it
+        with lock:
+            with self._lock:
+                if directory in self._created:
+                    return
+            self.mkdir(directory)
+            with self._lock:
+                self._created.add(directory)
+                self._creating.pop(directory, None)
+
+
+class BufferPool(object):
+    """
+    A bounded pool of reusable buffers for reading files in chunks.
 
-    def do_GETCOST(self):
-        cost = self.remote.getcost()
-        try:
-            cost = int(cost)
-        except ValueError:
-            raise ValueError("Cost must be an integer")
-        return "COST {cost}".format(cost=cost)
+    At most `count` buffers of `buffer_size` bytes are ever allocated. If all of
+    them are in use, acquire() blocks until one is released, which caps the memory
+    used by concurrent transfers no matter how large the files are.
 
-    def do_GETAVAILABILITY(self):
-        reply = self.remote.getavailability()
-        if reply == "global":
-            return "AVAILABILITY GLOBAL"
-        elif reply == "local":
-            return "AVAILABILITY LOCAL"
-        else:
-            raise ValueError("Availability must be either 'global' or 'local'")
+    ...
 
-    def do_CLAIMURL(self, url):
-        if self.remote.claimurl(url):
-            return "CLAIMURL-SUCCESS"
-        else:
-            return "CLAIMURL-FAILURE"
+    Attributes
+    ----------
+    buffer_size : int
+        The size of each buffer in bytes.
+    count : int
+        The maximum number of buffers.
+    """
 
-    def do_CHECKURL(self, url):
+    def __init__(self, buffer_size=1024 * 1024, count=4):
+        self.buffer_size = buffer_size
+        self.count = count
+        self._free = []
+        self._allocated = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while not self._free and self._allocated >= self.count:
+                self._condition.wait()
+            if self._free:
+                return self._free.pop()
+            self._allocated += 1
+            return bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        with self._condition:
+            self._free.append(buffer)
+            self._condition.notify()
+
+    def read_chunks(self, local_file, progress=None):
+        """
+        Reads `local_file` into a buffer of the pool, one chunk after another.
+
+        Each chunk is a memoryview of the buffer, which is only valid until the
+        next chunk is requested. Copy it (bytes(chunk)) if it needs to be kept.
+
+        Parameters
+        ----------
+        local_file : str
+            Path of the file to read.
+        progress : callable
+            If given, called with the number of bytes read so far after each chunk,
+            eg. Master.progress.
+
+        Yields
+        ------
+        memoryview
+        """
+        buffer = self.acquire()
+        view = memoryview(buffer)
         try:
-            reply = self.remote.checkurl(url)
-        except RemoteError as e:
-            return "CHECKURL-FAILURE {e}".format(e=e).rstrip()
-        if not reply:
-            return "CHECKURL-FAILURE"
-        elif reply is True:
-            return "CHECKURL-CONTENTS UNKNOWN"
+            done = 0
+            with open(local_file, "rb", buffering=0) as f:
+                while True:
+                    n = f.readinto(buffer)
+                    if not n:
+                        break
+                    done += n
+                    yield view[:n]
+                    if progress is not None:
+                        progress(done)
+        finally:
+            view.release()
+            self.release(buffer)
+
+
+class ChunkWriter(object):
+    """
+    Writes chunks received from a remote to a local file and reports the progress.
+    Can be used as a context manager.
+    """
 
-        if len(reply) == 1 and "url" not in reply[0]:
-            entry = reply[0]
-            size = entry.get("size", "UNKNOWN")
+    def __init__(self, local_file, progress=None):
+        self.file = open(local_file, "wb")
+        self.progress = progress
+        self.bytes_written = 0
 
-            returnvalue = " ".join(("CHECKURL-CONTENTS", str(size)))
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.bytes_written += len(chunk)
+        if self.progress is not None:
+            self.progress(self.bytes_written)
+        return len(chunk)
 
-            if "filename" in entry and entry["filename"]:
-                returnvalue = " ".join((returnvalue, entry["filename"]))
-            return returnvalue
+    def close(self):
+        self.file.close()
 
-        returnvalue = "CHECKURL-MULTI"
-        for entry in reply:
-            if "url" not in entry:
-                raise ValueError("Url must be present when specifying multiple values.")
-            if " " in entry["url"]:
-                raise ValueError("Url must not contain spaces.")
+    def __enter__(self):
+        return self
 
-            size = entry.get("size", "UNKNOWN")
-            filename = entry.get("filename", "")
-            if " " in filename:
-                raise ValueError("Filename must not contain spaces.")
+    def __exit__(self, *exc):
+        self.close()
 
-            returnvalue = " ".join((returnvalue, entry["url"], str(size), filename))
-        return returnvalue
 
-    def do_WHEREIS(self, key):
-        self.check_key(key)
-        reply = self.remote.whereis(key)
-        if reply:
-            return "WHEREIS-SUCCESS {reply}".format(reply=reply)
-        else:
-            return "WHEREIS-FAILURE"
+class MultipartUpload(object):
+    """
+    Uploads a file in parts on a pool of threads, eg. for the multipart upload
+    APIs of object stores.
+
+    Each part is read with os.pread() by the thread uploading it, so at most
+    `workers` parts are held in memory at a time. The progress of all parts is
+    merged into a single, monotonic stream of progress reports, sent at most
+    every `progress_interval` seconds.
+
+    Example:
+        def transfer_store(self, key, local_file):
+            upload_id = self.client.create_multipart_upload(key)
+            MultipartUpload().upload(
+                local_file,
+                lambda number, data, report: self.client.upload_part(upload_id, number, data),
+                complete=lambda etags: self.client.complete(upload_id, etags),
+                abort=lambda: self.client.abort(upload_id),
+                progress=self.annex.progress,
+            )
 
-    def do_GETINFO(self):
-        info = self.remote.info
-        reply = []
-        for field in sorted(info):
-            reply.append("INFOFIELD {}".format(field))
-            reply.append("INFOVALUE {}".format(info[field]))
-        reply.append("INFOEND")
-        return "\n".join(reply)
+    ...
 
-    def do_ERROR(self, message):
-        self.remote.error(message)
+    Attributes
+    ----------
+    part_size : int
+        The size of each part in bytes, except for the last one.
+    workers : int
+        The number of parts uploaded at once.
+    progress_interval : float
+        The minimum number of seconds between two progress reports.
+    """
 
-    def do_EXPORTSUPPORTED(self):
-        if self.remote.exportsupported():
-            return "EXPORTSUPPORTED-SUCCESS"
-        else:
-            return "EXPORTSUPPORTED-FAILURE"
+    def __init__(self, part_size=8 * 1024 * 1024, workers=4, progress_interval=0.5):
+        if part_size < 1 or workers < 1:
+            raise ValueError("Expected a positive part size and worker count")
+        self.part_size = part_size
+        self.workers = workers
+        self.progress_interval = progress_interval
 
-    def do_EXPORT(self, name):
-        self.exporting = name
+    def parts(self, size):
+        """
+        Returns the parts of a file of `size` bytes as a list of (number, offset, length),
+        numbered from 1. An empty file consists of one empty part.
+        """
+        offsets = range(0, size, self.part_size) if size else [0]
+        return [
+            (number, offset, min(self.part_size, size - offset))
+            for number, offset in enumerate(offsets, 1)
+        ]
 
-    def do_TRANSFEREXPORT(self, param):
-        if not self.exporting:
-            raise ProtocolError("Export request without prior EXPORT")
-        try:
-            (method, key, file_) = param.split(" ", 2)
-        except ValueError:
-            raise SyntaxError("Expected Key File")
+    def upload(self, local_file, upload_part, complete=None, abort=None, progress=None):
+        """
+        Uploads `local_file` with upload_part(), one call per part.
 
-        if not (method == "STORE" or method == "RETRIEVE"):
-            return self.do_UNKNOWN()
+        Parameters
+        ----------
+        local_file : str
+            Path of the file to upload.
+        upload_part : callable
+            Called as upload_part(number, data, report) from the worker threads, where
+            data is the content of the part as bytes. It may call report(n) with the
+            number of bytes of the part sent so far. Its return value (eg. an ETag)
+            is passed on to complete().
+        complete : callable
+            Called with the list of the return values of upload_part() in the order
+            of the parts once all parts have been uploaded.
+        abort : callable
+            Called without arguments if an upload_part() or complete() failed, after
+            all other parts have finished or been cancelled.
+        progress : callable
+            Called with the total number of bytes uploaded, eg. Master.progress.
 
-        func = getattr(self.remote, "transferexport_{}".format(method.lower()), None)
+        Returns
+        -------
+        The return value of complete(), or the list of return values of upload_part()
+        if complete is None.
+
+        Raises
+        ------
+        Any exception raised by upload_part() or complete(), after abort() was called.
+        """
+        parts = self.parts(os.path.getsize(local_file))
+        aggregator = _ProgressAggregator(progress, self.progress_interval)
+        fd = os.open(local_file, os.O_RDONLY)
         try:
-            func(key, file_, self.exporting)
-        except RemoteError as e:
-            return "TRANSFER-FAILURE {method} {key} {e}".format(
-                method=method, key=key, e=e
+            with concurrent.futures.ThreadPoolExecutor(
+                min(self.workers, len(parts))
+            ) as pool:
+                futures = [
+                    pool.submit(self._upload_part, fd, upload_part, aggregator, *part)
+                    for part in parts
+                ]
+                try:
+                    done, not_done = concurrent.futures.wait(
+                        futures, return_when=concurrent.futures.FIRST_EXCEPTION
+                    )
+                    for future in not_done:
+                        future.cancel()
+                    concurrent.futures.wait(futures)
+                    results = [future.result() for future in futures]
+                    aggregator.flush()
+                    if complete is None:
+                        return results
+                    return complete(results)
+                except BaseException:
+                    if abort is not None:
+                        abort()
+                    raise
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _upload_part(fd, upload_part, aggregator, number, offset, length):
+        data = os.pread(fd, length, offset)
+        if len(data) != length:
+            raise RemoteError("File changed during upload")
+        result = upload_part(number, data, lambda n: aggregator.update(number, n))
+        aggregator.update(number, length)
+        return result
+
+
+class RangedDownload(object):
+    """
+    Downloads a file as byte ranges fetched concurrently on a pool of threads,
+    eg. from HTTP servers or object stores supporting range requests.
+
+    The local file is preallocated and each range is written to its place with
+    os.pwrite() as soon as it arrives. A failed range is retried on its own.
+    The ranges which have been written are recorded in a file next to the local
+    file, so that a download interrupted eg. by a failure or by git-annex being
+    killed continues where it stopped when it is retried.
+
+    Example:
+        def transfer_retrieve(self, key, local_file):
+            RangedDownload().download(
+                local_file,
+                self.client.size(key),
+                lambda offset, length: self.client.get(key, offset, length),
+                progress=self.annex.progress,
             )
-        else:
-            return "TRANSFER-SUCCESS {method} {key}".format(method=method, key=key)
 
-    def do_CHECKPRESENTEXPORT(self, key):
-        if not self.exporting:
-            raise ProtocolError("Export request without prior EXPORT")
-        self.check_key(key)
-        try:
-            if self.remote.checkpresentexport(key, self.exporting):
-                return "CHECKPRESENT-SUCCESS {key}".format(key=key)
-            else:
-                return "CHECKPRESENT-FAILURE {key}".format(key=key)
-        except RemoteError as e:
-            return "CHECKPRESENT-UNKNOWN {key} {e}".format(key=key, e=e)
+    ...
 
-    def do_REMOVEEXPORT(self, key):
-        if not self.exporting:
-            raise ProtocolError("Export request without prior EXPORT")
-        self.check_key(key)
+    Attributes
+    ----------
+    range_size : int
+        The size of each range in bytes, except for the last one.
+    workers : int
+        The number of ranges fetched at once.
+    retries : int
+        How often a failed range is retried before the download fails.
+    progress_interval : float
+        The minimum number of seconds between two progress reports.
+    """
 
-        try:
-            self.remote.removeexport(key, self.exporting)
-        except RemoteError as e:
-            return "REMOVE-FAILURE {key} {e}".format(key=key, e=e)
-        else:
-            return "REMOVE-SUCCESS {key}".format(key=key)
+    def __init__(
+        self, range_size=8 * 1024 * 1024, workers=4, retries=3, progress_interval=0.5
+    ):
+        if range_size < 1 or workers < 1:
+            raise ValueError("Expected a positive range size and worker count")
+        self.range_size = range_size
+        self.workers = workers
+        self.retries = retries
+        self.progress_interval = progress_interval
+
+    def download(self, local_file, size, read_range, progress=None):
+        """
+        Downloads `size` bytes to `local_file` with read_range(), one call per range.
 
-    def do_REMOVEEXPORTDIRECTORY(self, name):
-        try:
-            self.remote.removeexportdirectory(name)
-        except RemoteError:
-            return "REMOVEEXPORTDIRECTORY-FAILURE"
-        else:
-            return "REMOVEEXPORTDIRECTORY-SUCCESS"
+        Parameters
+        ----------
+        local_file : str
+            Path of the file to write.
+        size : int
+            The size of the content in bytes, eg. from the size field of the key.
+        read_range : callable
+            Called as read_range(offset, length) from the worker threads.
+            Must return the content of the range as bytes.
+            Should raise RemoteError if the range could not be received.
+        progress : callable
+            Called with the total number of bytes received, eg. Master.progress.
 
-    def do_RENAMEEXPORT(self, param):
-        if not self.exporting:
-            raise ProtocolError("Export request without prior EXPORT")
+        Raises
+        ------
+        RemoteError
+            If a range couldn't be received after `retries` retries. The ranges
+            received so far are kept to resume the download.
+        """
+        ranges = MultipartUpload(self.range_size).parts(size) if size else []
+        aggregator = _ProgressAggregator(progress, self.progress_interval)
+        journal = local_file + ".ranges"
+        header = "{} {}".format(size, self.range_size)
+        done = self._read_journal(journal, header)
+        fd = os.open(local_file, os.O_RDWR | os.O_CREAT, 0o644)
         try:
-            (key, new_name) = param.split(None, 1)
-        except ValueError:
-            raise SyntaxError("Expected TRANSFER STORE Key File")
-
+            if os.fstat(fd).st_size != size:
+                done = set()
+            if not done:
+                os.ftruncate(fd, 0)
+                self._preallocate(fd, size)
+                with open(journal, "w") as f:
+                    f.write(header + "\n")
+            for number, offset, length in ranges:
+                if number in done:
+                    aggregator.update(number, length)
+            journal_fd = os.open(journal, os.O_WRONLY | os.O_APPEND)
+            try:
+                with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+                    futures = [
+                        pool.submit(
+                            self._download_range,
+                            fd,
+                            journal_fd,
+                            read_range,
+                            aggregator,
+                            *part,
+                        )
+                        for part in ranges
+                        if part[0] not in done
+                    ]
+                    _, not_done = concurrent.futures.wait(
+                        futures, return_when=concurrent.futures.FIRST_EXCEPTION
+                    )
+                    for future in not_done:
+                        future.cancel()
+                    concurrent.futures.wait(futures)
+                    for future in futures:
+                        future.result()
+            finally:
+                os.close(journal_fd)
+        finally:
+            os.close(fd)
+        os.unlink(journal)
+        aggregator.flush()
+
+    def _download_range(
+        self, fd, journal_fd, read_range, aggregator, number, offset, length
+    ):
+        for attempt in range(self.retries + 1):
+            try:
+                data = read_range(offset, length)
+                if len(data) != length:
+                    raise RemoteError(
+                        "Expected {} bytes at offset {}, got {}".format(
+                            length, offset, len(data)
+                        )
+                    )
+                break
+            except (RemoteError, OSError):
+                if attempt == self.retries:
+                    raise
+        written = 0
+        view = memoryview(data)
+        while written < length:
+            written += os.pwrite(fd, view[written:], offset + written)
+        os.fsync(fd)
+        os.write(journal_fd, "{}\n".format(number).encode())
+        aggregator.update(number, length)
+
+    @staticmethod
+    def _preallocate(fd, size):
+        if size and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return
+            except OSError:
+                # not supported by the filesystem
+                pass
+        os.ftruncate(fd, size)
+
+    @staticmethod
+    def _read_journal(journal, header):
         try:
-            self.remote.renameexport(key, self.exporting, new_name)
-        except RemoteError:
-            return "RENAMEEXPORT-FAILURE {key}".format(key=key)
-        else:
-            return "RENAMEEXPORT-SUCCESS {key}".format(key=key)
+            with open(journal) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return set()
+        # ranges of a different size or layout can't be reused
+        if not lines or lines[0] != header:
+            return set()
+        return {int(line) for line in lines[1:] if line.isdigit()}
 
 
-class Master(object):
+class _ProgressAggregator(object):
     """
-    Metaclass for non-export remotes.
+    Merges the progress of several parts of a transfer into monotonic,
+    throttled calls of `progress` with the total.
+    """
+
+    def __init__(self, progress, interval):
+        self.progress = progress
+        self.interval = interval
+        self.total = 0
+        self._parts = {}
+        self._reported = 0
+        self._last = None
+        self._lock = threading.Lock()
+
+    def update(self, part, done):
+        with self._lock:
+            previous = self._parts.get(part, 0)
+            # a part may be retried; its progress never goes backwards
+            if done <= previous:
+                return
+            self._parts[part] = done
+            self.total += done - previous
+            now = time.monotonic()
+            if self._last is None or now - self._last >= self.interval:
+                self._last = now
+                self._report()
+
+    def flush(self):
+        with self._lock:
+            self._report()
+
+    def _report(self):
+        if self.progress is not None and self.total > self._reported:
+            self._reported = self.total
+            self.progress(self.total)
+
+
+class Compressor(object):
+    """
+    Compresses a stream of chunks on a pool of threads, for remotes behind slow links.
+
+    Each chunk is compressed independently into a frame, so that several chunks can
+    be compressed at once. The stdlib codecs release the GIL while compressing, so
+    threads are used. The output starts with a small header naming the codec,
+    which lets Decompressor restore the content without knowing the settings.
+
+    Content which doesn't compress well (eg. images, videos or archives) is detected
+    by compressing a sample of the first chunk and then stored uncompressed.
 
     ...
 
     Attributes
     ----------
-    input : io.TextIOBase
-        Where to listen for git-annex request messages.
-        Default: sys.stdin
-    output : io.TextIOBase
-        Where to send replies and special remote messages
-        Default: sys.stdout
-    remote : SpecialRemote
-        A class implementing either the SpecialRemote or the
-        ExternalSpecialRemote interface to which this master is linked.
+    codec : str
+        One of 'zlib', 'bz2' or 'lzma'.
+    level : int
+        The compression level (preset for lzma), or None for the codec's default.
+    workers : int
+        The number of chunks compressed at once.
+    sample_size : int
+        The number of bytes of the first chunk used to test the compressibility.
+    min_ratio : float
+        Content is stored uncompressed if the sample doesn't shrink below this ratio.
     """
 
-    def __init__(self, output=sys.stdout):
+    MAGIC = b"\x00ANNEXRZ"
+    CODECS = ("none", "zlib", "bz2", "lzma")
+    HEADER = struct.Struct(">8sBB")
+    FRAME = struct.Struct(">I")
+    VERSION = 1
+
+    def __init__(
+        self,
+        codec="zlib",
+        level=None,
+        workers=None,
+        sample_size=64 * 1024,
+        min_ratio=0.9,
+    ):
+        if codec not in self.CODECS[1:]:
+            raise ValueError("Unknown codec {}".format(codec))
+        if _codec_module(codec) is None:
+            raise ValueError("Codec {} is not available".format(codec))
+        self.codec = codec
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self.sample_size = sample_size
+        self.min_ratio = min_ratio
+
+    def compressible(self, data):
         """
-        Initialize the Master with an output.
-
-        Parameters
-        ----------
-        output : io.TextIOBase
-            Where to send replies and special remote messages
-            Default: sys.stdout
+        Returns True if a sample of `data` compresses well.
         """
-        self.output = output
+        sample = data[: self.sample_size]
+        if not sample:
+            return False
+        return len(zlib.compress(sample, 1)) < len(sample) * self.min_ratio
 
-    def LinkRemote(self, remote):
+    def compress(self, chunks):
         """
-        Link the Master to a remote. This must be done before calling Listen()
+        Compresses the content given by `chunks`.
 
         Parameters
         ----------
-        remote : SpecialRemote
-            A class implementing either the SpecialRemote or the
-            ExternalSpecialRemote interface to which this master will be linked.
-        """
-        self.remote = remote
-        self.protocol = Protocol(remote)
+        chunks : iterable of bytes-like objects
+            The content. Each chunk is copied before it is handed to the pool,
+            so chunks only need to be valid until the next one is requested.
 
-    def LoggingHandler(self):
+        Yields
+        ------
+        bytes-like objects
+            The compressed content, including the header.
         """
-        Gets an instance of AnnexLoggingHandler
+        chunks = iter(chunks)
+        first = next(chunks, None)
+        first = bytes(first) if first is not None else b""
+        codec = self.codec if self.compressible(first) else "none"
+        yield self.HEADER.pack(self.MAGIC, self.VERSION, self.CODECS.index(codec))
+        if codec == "none":
+            yield first
+            yield from chunks
+            return
+        compress = self._compress_function()
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            try:
+                pending.append(pool.submit(compress, first))
+                for chunk in chunks:
+                    pending.append(pool.submit(compress, bytes(chunk)))
+                    # keep the pool busy, but the number of chunks in memory bounded
+                    if len(pending) > self.workers:
+                        yield from self._frame(pending.popleft().result())
+                while pending:
+                    yield from self._frame(pending.popleft().result())
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _frame(self, data):
+        yield self.FRAME.pack(len(data))
+        yield data
+
+    def _compress_function(self):
+        level = self.level
+        if self.codec == "zlib":
+            return lambda data: zlib.compress(data, -1 if level is None else level)
+        elif self.codec == "bz2":
+            return lambda data: bz2.compress(data, 9 if level is None else level)
+        else:
+            return lambda data: lzma.compress(data, preset=level)
 
-        Returns
-        -------
-        AnnexLoggingHandler
-        """
-        return AnnexLoggingHandler(self)
 
-    def Listen(self, input=sys.stdin):
-        """
-        Listen on `input` for messages from git annex.
+class Decompressor(object):
+    """
+    Restores content compressed by Compressor while it is being received.
 
-        Parameters
-        ----------
-        input : io.TextIOBase
-            Where to listen for git-annex request messages.
-            Default: sys.stdin
+    Pass the compressed content in chunks of any size to write(); the decompressed
+    content is passed on to `writer`. Content without a Compressor header is passed
+    on unchanged, so compression can be enabled for remotes which already hold keys.
+    Call close() after the last chunk.
+    """
 
+    def __init__(self, writer):
+        self.writer = writer
+        self._buffer = bytearray()
+        self._codec = None
+
+    def write(self, chunk):
+        self._buffer += chunk
+        if self._codec is None:
+            if len(self._buffer) < Compressor.HEADER.size:
+                return len(chunk)
+            self._read_header()
+        if self._codec == "none":
+            self._flush()
+            return len(chunk)
+        offset = 0
+        frame = Compressor.FRAME
+        while len(self._buffer) - offset >= frame.size:
+            (length,) = frame.unpack_from(self._buffer, offset)
+            end = offset + frame.size + length
+            if len(self._buffer) < end:
+                break
+            data = bytes(self._buffer[offset + frame.size : end])
+            self.writer.write(self._decompress(data))
+            offset = end
+        del self._buffer[:offset]
+        return len(chunk)
+
+    def close(self):
+        """
         Raises
-        ----------
-        NotLinkedError
-            If there is no remote linked to this master.
+        ------
+        RemoteError
+            If the compressed content is truncated.
         """
-        if not (hasattr(self, "remote") and hasattr(self, "protocol")):
-            raise NotLinkedError("Please execute LinkRemote(remote) first.")
+        if self._codec is None:
+            self._codec = "none"
+            self._flush()
+        elif self._buffer and self._codec != "none":
+            raise RemoteError("Compressed content is truncated")
+
+    def _read_header(self):
+        magic, version, codec = Compressor.HEADER.unpack_from(self._buffer)
+        if magic != Compressor.MAGIC:
+            self._codec = "none"
+            return
+        if version != Compressor.VERSION or codec >= len(Compressor.CODECS):
+            raise RemoteError("Unsupported compression format")
+        self._codec = Compressor.CODECS[codec]
+        if _codec_module(self._codec) is None:
+            raise RemoteError("Codec {} is not available".format(self._codec))
+        del self._buffer[: Compressor.HEADER.size]
+
+    def _flush(self):
+        if self._buffer:
+            self.writer.write(bytes(self._buffer))
+            self._buffer.clear()
+
+    def _decompress(self, data):
+        try:
+            return _codec_module(self._codec).decompress(data)
+        except (zlib.error, OSError, EOFError, ValueError) as e:
+            raise RemoteError("Compressed content is corrupted: {}".format(e))
 
-        self.input = input
-        self._send(self.protocol.version)
-        while True:
-            # due to a bug in python 2 we can't use an iterator here: https://bugs.python.org/issue1633941
-            line = self.input.readline()
-            if not line:
-                break
-            line = line.rstrip()
-            try:
-                reply = self.protocol.command(line)
-                if reply:
-                    self._send(reply)
-            except UnsupportedRequest:
-                self._send("UNSUPPORTED-REQUEST")
-            except Exception as e:
-                for line in traceback.format_exc().splitlines():
-                    self.debug(line)
-                self.error(e)
-                raise SystemExit
 
-    def _ask(self, request, reply_keyword, reply_count):
-        self._send(request)
-        line = self.input.readline().rstrip().split(" ", reply_count)
-        if line and line[0] == reply_keyword:
-            line.extend([""] * (reply_count + 1 - len(line)))
-            return line[1:]
-        else:
-            raise UnexpectedMessage(
-                "Expected {reply_keyword} and {reply_count} values. Got {line}".format(
-                    reply_keyword=reply_keyword, reply_count=reply_count, line=line
-                )
-            )
+def _codec_module(codec):
+    return {"none": zlib, "zlib": zlib, "bz2": bz2, "lzma": lzma}.get(codec)
 
-    def _askvalues(self, request):
-        self._send(request)
-        reply = []
-        while True:
-            # due to a bug in python 2 we can't use an iterator here: https://bugs.python.org/issue1633941
-            line = self.input.readline()
-            line = line.rstrip()
-            line = line.split(" ", 1)
-            if len(line) == 2 and line[0] == "VALUE":
-                reply.append(line[1])
-            elif len(line) == 1 and line[0] == "VALUE":
-                return reply
-            else:
-                raise UnexpectedMessage("Expected VALUE {value}")
 
-    def _askvalue(self, request):
-        (reply,) = self._ask(request, "VALUE", 1)
-        return reply
+class ProgressFile(object):
+    """
+    Wraps a file object and reports the progress of a transfer as a library
+    (eg. boto3, requests or paramiko) reads from or writes to it.
 
-    def getconfig(self, setting):
-        """
-        Gets one of the special remote's configuration settings,
-        which can have been passed by the user when running `git annex initremote`,
-        `git annex enableremote` or can have been set by a previous setconfig(). Can be run at any time.
-        It's recommended that special remotes that use this implement listconfigs().
+    Progress is only reported after another `percent` of the size has been
+    transferred, or after `interval` seconds if the size is unknown or an interval
+    is given. Seeking back (eg. when a library retries) never makes the reported
+    progress go backwards. Everything else is passed on to the wrapped file.
 
-        Parameters
-        ----------
-        setting : str
-            Which setting to get
+    Example:
+        def transfer_store(self, key, local_file):
+            with open(local_file, "rb") as f:
+                self.bucket.upload_fileobj(ProgressFile(f, self.annex.progress, key=key), key)
 
-        Returns
-        -------
-        str
-            The requested setting. If the setting is not set, the value will an empty string.
+    ...
 
-        Raises
-        ----------
-        UnexpectedMessage
-            If git-annex does not respond correctly to this request, which is very unlikely.
-        """
-        return self._askvalue("GETCONFIG {}".format(setting))
+    Attributes
+    ----------
+    file : file object
+        The wrapped file.
+    progress : callable
+        Called with the number of bytes transferred, eg. Master.progress.
+    size : int
+        The total size of the transfer. Defaults to the size field of `key`, if any.
+    percent : float
+        The granularity of the reports as a percentage of the size.
+    interval : float
+        The granularity of the reports in seconds. Used if the size is unknown
+        (defaulting to 1 second then) or if given explicitly.
+    """
 
-    def setconfig(self, setting, value):
+    def __init__(self, file, progress, size=None, key=None, percent=1, interval=None):
+        self.file = file
+        self.progress = progress
+        self.size = size if size is not None or key is None else _keysize(key)
+        self.percent = percent
+        if interval is None and not self.size:
+            interval = 1
+        self.interval = interval
+        self.position = 0
+        self.reported = 0
+        self._last = time.monotonic()
+
+    def read(self, *args):
+        data = self.file.read(*args)
+        self._advance(len(data), not data)
+        return data
+
+    def read1(self, *args):
+        data = self.file.read1(*args)
+        self._advance(len(data), not data)
+        return data
+
+    def readline(self, *args):
+        data = self.file.readline(*args)
+        self._advance(len(data), not data)
+        return data
+
+    def readinto(self, buffer):
+        n = self.file.readinto(buffer)
+        self._advance(n or 0, not n)
+        return n
+
+    def write(self, data):
+        n = self.file.write(data)
+        self._advance(len(data) if n is None else n)
+        return n
+
+    def seek(self, *args):
+        self.position = self.file.seek(*args)
+        return self.position
+
+    def __iter__(self):
+        for line in self.file:
+            self._advance(len(line))
+            yield line
+        self.flush_progress()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def flush_progress(self):
         """
-        Sets one of the special remote's configuration settings.
-        Normally this is sent during initremote(), which allows these settings to be
-        stored in the git-annex branch, so will be available if the same special remote
-        is used elsewhere. (If sent after initremote(), the changed configuration will
-        only be available while the remote is running.)
-
-        Parameters
-        ----------
-        setting : str
-            The name of the setting
-        value : str
-            The value of the setting
+        Reports the progress if it changed since the last report.
         """
-        self._send("SETCONFIG {} {}".format(setting, value))
+        if self.position > self.reported:
+            self.reported = self.position
+            self._last = time.monotonic()
+            self.progress(self.reported)
 
-    def getstate(self, key):
+    def close(self):
+        self.flush_progress()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _advance(self, n, eof=False):
+        self.position += n
+        if eof or (self.size and self.position >= self.size):
+            self.flush_progress()
+        elif self.size and self.interval is None:
+            if self.position - self.reported >= self.size * self.percent / 100:
+                self.flush_progress()
+        elif time.monotonic() - self._last >= self.interval:
+            self.flush_progress()
+
+
+class StreamingRemote(SpecialRemote):
+    """
+    Metaclass for remotes that transfer keys as streams of chunks instead of files.
+
+    transfer_store() and transfer_retrieve() are implemented on top of
+    store_stream() and retrieve_stream(). The chunks are read into buffers of
+    `buffer_pool`, which is shared by all transfers of the class and bounds the
+    memory they use. Progress is reported to git-annex after each chunk.
+
+    If `compressor` is set, the content is compressed before it is passed to
+    store_stream() and decompressed while it is received by retrieve_stream().
+
+    ...
+
+    Attributes
+    ----------
+    buffer_pool : BufferPool
+        The pool the chunks are read into.
+    compressor : Compressor
+        Compresses the stored content, or None.
+    """
+
+    buffer_pool = BufferPool()
+    compressor = None
+
+    @abstractmethod
+    def store_stream(self, key, chunks, size):
         """
-        Gets any state that has been stored for the key via setstate().
+        Store the content given by `chunks` to a unique location derived from `key`.
 
         Parameters
         ----------
         key : str
-            The key for which to get the state
-
-        Returns
-        -------
-        str
-            The requested state. If the state is not set, the value will an empty string.
+            The Key to be stored in the remote.
+        chunks : iterator of memoryview
+            The content of the key. Each chunk is only valid until the next one is requested.
+        size : int
+            The total size of the content in bytes,
+            or None if it is compressed and thus not known in advance.
 
         Raises
-        ----------
-        UnexpectedMessage
-            If git-annex does not respond correctly to this request, which is very unlikely.
+        ------
+        RemoteError
+            If the content could not be stored to the remote.
         """
-        return self._askvalue("GETSTATE {key}".format(key=key))
 
-    def setstate(self, key, value):
+    @abstractmethod
+    def retrieve_stream(self, key, writer):
         """
-        Can be used to store some form of state for a Key. The state stored can be anything
-        this remote needs to store, in any format. It is stored in the git-annex branch.
-        Note that this means that if multiple repositories are using the same special
-        remote, and store different state, whichever one stored the state last will win.
-        Also, it's best to avoid storing much state, since this will bloat the git-annex
-        branch. Most remotes will not need to store any state.
+        Get the content identified by `key` from the remote and pass it to `writer`.
 
         Parameters
         ----------
         key : str
-            The key for which to store the state
-        value : str
-            The state for the key to store
-        """
-        self._send("SETSTATE {key} {value}".format(key=key, value=value))
+            The Key to get from the remote.
+        writer : ChunkWriter
+            Call writer.write(chunk) with each chunk of the content, in order.
 
-    def debug(self, *args):
+        Raises
+        ------
+        RemoteError
+            If the content could not be received from the remote.
         """
-        Tells git-annex to display the message if --debug is enabled.
 
-        Parameters
-        ----------
-        message : str
-            The message to be displayed to the user
-        """
+    def transfer_store(self, key, local_file):
+        chunks = self.buffer_pool.read_chunks(local_file, self.annex.progress)
+        try:
+            if self.compressor is None:
+                self.store_stream(key, chunks, os.path.getsize(local_file))
+                return
+            compressed = self.compressor.compress(chunks)
+            try:
+                self.store_stream(key, compressed, None)
+            finally:
+                compressed.close()
+        finally:
+            chunks.close()
 
-        self._send("DEBUG", *args)
+    def transfer_retrieve(self, key, local_file):
+        with ChunkWriter(local_file, self.annex.progress) as writer:
+            if self.compressor is None:
+                self.retrieve_stream(key, writer)
+                return
+            decompressor = Decompressor(writer)
+            self.retrieve_stream(key, decompressor)
+            decompressor.close()
 
-    def error(self, *args):
-        """
-        Generic error. Can be sent at any time if things get too messed up to continue.
-        When possible, raise a RemoteError inside the respective functions.
-        The special remote program should exit after sending this, as git-annex will
-        not talk to it any further.
 
-        Parameters
+class ContentDefinedChunker(object):
+    """
+    Splits content into chunks at positions determined by the content itself,
+    using a rolling (gear) hash. An insertion or deletion only changes the chunks
+    around it, so near-duplicate files mostly consist of the same chunks.
+
+    ...
+
+    Attributes
+    ----------
+    min_size : int
+        No chunk except the last one is smaller than this.
+    avg_size : int
+        The average chunk size. Must be a power of two.
+    max_size : int
+        No chunk is larger than this.
+    """
+
+    # fixed so that the same content always results in the same chunks
+    GEAR = [
+        int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "big")
+        for i in range(256)
+    ]
+
+    def __init__(
+        self, min_size=256 * 1024, avg_size=1024 * 1024, max_size=4 * 1024 * 1024
+    ):
+        if avg_size & (avg_size - 1) or not 0 < min_size <= avg_size <= max_size:
+            raise ValueError(
+                "Expected min_size <= avg_size <= max_size and avg_size a power of two"
+            )
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self._mask = avg_size - 1
+
+    def chunks(self, f):
+        """
+        Yields the chunks of the binary file object `f` as bytes.
+        """
+        buffer = b""
+        eof = False
+        while True:
+            if not eof and len(buffer) < self.max_size:
+                data = f.read(self.max_size)
+                eof = not data
+                buffer += data
+                continue
+            if not buffer:
+                return
+            cut = self.cut(buffer)
+            yield buffer[:cut]
+            buffer = buffer[cut:]
+
+    def cut(self, data):
+        """
+        Returns the length of the first chunk of `data`.
+        """
+        end = min(len(data), self.max_size)
+        if end <= self.min_size:
+            return end
+        gear = self.GEAR
+        mask = self._mask
+        h = 0
+        for i in range(self.min_size, end):
+            h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFFFFFFFFFF
+            if not h & mask:
+                return i + 1
+        return end
+
+
+class DedupRemote(SpecialRemote):
+    """
+    Metaclass for remotes that store keys deduplicated as content-defined chunks.
+
+    transfer_store() splits the content with `chunker` and only uploads chunks
+    the remote doesn't have yet, named by their SHA256 hash. The list of chunks
+    of a key (its manifest) is stored with put_manifest(), which by default uses
+    git-annex's per-key state (setstate()). Remotes with many or large keys should
+    store manifests on the remote side instead, as they bloat the git-annex branch.
+
+    A key is present once its manifest has been stored, which happens only after
+    all of its chunks have been stored. remove() only removes the manifest, as the
+    chunks may be shared with other keys.
+
+    ...
+
+    Attributes
+    ----------
+    chunker : ContentDefinedChunker
+        Splits the content into chunks.
+    """
+
+    chunker = ContentDefinedChunker()
+
+    @abstractmethod
+    def put_chunk(self, chunk_id, data):
+        """
+        Store `data` under the name `chunk_id`.
+
+        Raises
+        ------
+        RemoteError
+            If the chunk could not be stored.
+        """
+
+    @abstractmethod
+    def get_chunk(self, chunk_id):
+        """
+        Returns the data stored under `chunk_id` as bytes.
+
+        Raises
+        ------
+        RemoteError
+            If the chunk could not be received.
+        """
+
+    @abstractmethod
+    def has_chunk(self, chunk_id):
+        """
+        Returns True if a chunk named `chunk_id` is stored in the remote.
+
+        Raises
+        ------
+        RemoteError
+            If the presence of the chunk couldn't be determined.
+        """
+
+    def put_manifest(self, key, manifest):
+        """
+        Stores the manifest of a key, a string without whitespace.
+        """
+        self.annex.setstate(key, manifest)
+
+    def get_manifest(self, key):
+        """
+        Returns the manifest of a key, or an empty string if there is none.
+        """
+        return self.annex.getstate(key)
+
+    def transfer_store(self, key, local_file):
+        chunk_ids = []
+        seen = set()
+        done = 0
+        with open(local_file, "rb") as f:
+            for data in self.chunker.chunks(f):
+                chunk_id = hashlib.sha256(data).hexdigest()
+                if chunk_id not in seen and not self.has_chunk(chunk_id):
+                    self.put_chunk(chunk_id, data)
+                seen.add(chunk_id)
+                chunk_ids.append(chunk_id)
+                done += len(data)
+                self.annex.progress(done)
+        self.put_manifest(key, "{}:{}".format(done, ",".join(chunk_ids)))
+
+    def transfer_retrieve(self, key, local_file):
+        size, chunk_ids = self._parse_manifest(key)
+        done = 0
+        with open(local_file, "wb") as f:
+            for chunk_id in chunk_ids:
+                data = self.get_chunk(chunk_id)
+                if hashlib.sha256(data).hexdigest() != chunk_id:
+                    raise RemoteError("Chunk {} is corrupted".format(chunk_id))
+                f.write(data)
+                done += len(data)
+                self.annex.progress(done)
+        if done != size:
+            raise RemoteError("Expected {} bytes, got {}".format(size, done))
+
+    def checkpresent(self, key):
+        return bool(self.get_manifest(key))
+
+    def remove(self, key):
+        if self.get_manifest(key):
+            self.put_manifest(key, "")
+
+    def _parse_manifest(self, key):
+        manifest = self.get_manifest(key)
+        if not manifest:
+            raise RemoteError("Key {} not found".format(key))
+        size, chunk_ids = manifest.split(":", 1)
+        return int(size), [c for c in chunk_ids.split(",") if c]
+
+
+class PackingRemote(SpecialRemote):
+    """
+    Metaclass for remotes that store many small keys, packing them into larger
+    objects to save per-object latency and costs.
+
+    transfer_store() doesn't upload a key on its own. Keys stored at the same time
+    (eg. with EnableJobs()) are staged and sealed together into a pack, which is
+    uploaded with put_pack(). transfer_store() only returns once the pack holding
+    its key is stored, so a key is never reported as stored or present before
+    it is durable. While a pack is being uploaded, the next keys are collected,
+    and a pack is sealed early once `pack_size` bytes are staged.
+
+    Where each key is stored (its index entry) is stored with put_index(), which by
+    default uses git-annex's per-key state (setstate()). transfer_retrieve() reads
+    the key from its pack with get_range(). remove() only removes the index entry;
+    the space in the pack is not reclaimed.
+
+    ...
+
+    Attributes
+    ----------
+    pack_size : int
+        A pack is sealed once this many bytes are staged.
+    max_delay : float
+        How many seconds to wait for more keys before a pack is sealed. With the
+        default of 0, a pack is sealed as soon as no other pack is being uploaded.
+    staging_directory : str
+        Where packs are assembled before they are uploaded. Defaults to the system's
+        temporary directory.
+    """
+
+    pack_size = 64 * 1024 * 1024
+    max_delay = 0
+    staging_directory = None
+
+    def __init__(self, annex):
+        super().__init__(annex)
+        self._packer = threading.Condition()
+        self._staged = []
+        self._staged_size = 0
+        self._sealing = False
+
+    @abstractmethod
+    def put_pack(self, pack_id, local_file):
+        """
+        Store the pack at `local_file` under the name `pack_id`.
+
+        Raises
+        ------
+        RemoteError
+            If the pack could not be stored.
+        """
+
+    @abstractmethod
+    def get_range(self, pack_id, offset, length):
+        """
+        Returns `length` bytes at `offset` of the pack `pack_id` as bytes.
+
+        Raises
+        ------
+        RemoteError
+            If the range could not be received.
+        """
+
+    def put_index(self, key, entry):
+        """
+        Stores the index entry of a key, a string without whitespace.
+        """
+        self.annex.setstate(key, entry)
+
+    def get_index(self, key):
+        """
+        Returns the index entry of a key, or an empty string if there is none.
+        """
+        return self.annex.getstate(key)
+
+    def transfer_store(self, key, local_file):
+        staged = _StagedKey(local_file)
+        with self._packer:
+            self._staged.append(staged)
+            self._staged_size += staged.size
+            self._packer.notify_all()
+            deadline = time.monotonic() + self.max_delay
+            while staged.result is None:
+                remaining = deadline - time.monotonic()
+                if self._sealing or (
+                    remaining > 0 and self._staged_size < self.pack_size
+                ):
+                    self._packer.wait(remaining if remaining > 0 else None)
+                    continue
+                batch = self._staged
+                self._staged = []
+                self._staged_size = 0
+                self._sealing = True
+                self._packer.release()
+                try:
+                    self._seal(batch)
+                finally:
+                    self._packer.acquire()
+                    self._sealing = False
+                    self._packer.notify_all()
+        if isinstance(staged.result, Exception):
+            raise RemoteError(staged.result)
+        self.put_index(key, staged.result)
+
+    def transfer_retrieve(self, key, local_file):
+        pack_id, offset, length = self._parse_index(key)
+        data = self.get_range(pack_id, offset, length)
+        if len(data) != length:
+            raise RemoteError("Expected {} bytes, got {}".format(length, len(data)))
+        with open(local_file, "wb") as f:
+            f.write(data)
+        self.annex.progress(length)
+
+    def checkpresent(self, key):
+        return bool(self.get_index(key))
+
+    def remove(self, key):
+        if self.get_index(key):
+            self.put_index(key, "")
+
+    def _seal(self, batch):
+        fd, path = tempfile.mkstemp(prefix="pack-", dir=self.staging_directory)
+        try:
+            h = hashlib.sha256()
+            offsets = []
+            offset = 0
+            with os.fdopen(fd, "wb") as pack:
+                for staged in batch:
+                    with open(staged.local_file, "rb") as f:
+                        for data in iter(lambda: f.read(1024 * 1024), b""):
+                            h.update(data)
+                            pack.write(data)
+                    length = pack.tell() - offset
+                    offsets.append((offset, length))
+                    offset += length
+            pack_id = h.hexdigest()
+            self.put_pack(pack_id, path)
+        except Exception as e:
+            for staged in batch:
+                staged.result = e
+            return
+        finally:
+            os.unlink(path)
+        for staged, (offset, length) in zip(batch, offsets):
+            staged.result = "{}:{}:{}".format(pack_id, offset, length)
+
+    def _parse_index(self, key):
+        entry = self.get_index(key)
+        if not entry:
+            raise RemoteError("Key {} not found".format(key))
+        pack_id, offset, length = entry.split(":")
+        return (pack_id, int(offset), int(length))
+
+
+class _StagedKey(object):
+    def __init__(self, local_file):
+        self.local_file = local_file
+        self.size = os.path.getsize(local_file)
+        # the index entry once the pack is stored, or the exception if that failed
+        self.result = None
+
+
+class Protocol(object):
+    """
+    Helper class handling the receiving part of the protocol (git-annex to remote)
+    It parses the requests coming from git-annex and calls the respective
+    method of the remote object.
+
+    It is not further documented as it was never intended to be part of the public API.
+    """
+
+    def __init__(self, remote):
+        self.remote = remote
+        self.version = "VERSION 1"
+        self.exporting = False
+        self.extensions = list()
+        self.remote_extensions = ["UNAVAILABLERESPONSE"]
+
+    def command(self, line):
+        line = line.strip()
+        parts = line.split(" ", 1)
+        if not parts:
+            raise ProtocolError("Got empty line")
+
+        method = self.lookupMethod(parts[0]) or self.do_UNKNOWN
+
+        breaker = self.circuit_breaker()
+        command = parts[0].upper()
+        if breaker is not None and command in CircuitBreaker.REQUESTS:
+            if not breaker.allow():
+                self.exporting = False
+                return self.unavailable_reply(command, parts[1:])
+            try:
+                reply = self.call_method(method, parts)
+            except BaseException:
+                breaker.release()
+                raise
+            breaker.record(breaker.is_failure(reply))
+            return reply
+        elif breaker is not None and command == "GETAVAILABILITY":
+            if breaker.is_open and "UNAVAILABLERESPONSE" in self.extensions:
+                return "AVAILABILITY UNAVAILABLE"
+        return self.call_method(method, parts)
+
+    def call_method(self, method, parts):
+        try:
+            if len(parts) == 1:
+                reply = method()
+            else:
+                reply = method(parts[1])
+        except TypeError as e:
+            raise SyntaxError(e)
+        else:
+            if method != self.do_EXPORT:
+                self.exporting = False
+            return reply
+
+    def lookupMethod(self, command):
+        return getattr(self, "do_" + command.upper(), None)
+
+    def check_key(self, key):
+        if len(key.split()) != 1:
+            raise ValueError("Invalid key. Key contains whitespace character")
+
+    def do_UNKNOWN(self, *arg):
+        raise UnsupportedRequest()
+
+    def do_INITREMOTE(self):
+        try:
+            self.remote.initremote()
+        except RemoteError as e:
+            return "INITREMOTE-FAILURE {e}".format(e=e)
+        else:
+            return "INITREMOTE-SUCCESS"
+
+    def do_EXTENSIONS(self, param):
+        self.extensions = param.split(" ")
+        supported = [e for e in self.remote_extensions if e in self.extensions]
+        return " ".join(["EXTENSIONS"] + supported)
+
+    def do_PREPARE(self):
+        try:
+            self.remote.prepare()
+        except RemoteError as e:
+            return "PREPARE-FAILURE {e}".format(e=e)
+        else:
+            return "PREPARE-SUCCESS"
+
+    def do_TRANSFER(self, param):
+        try:
+            (method, key, file_) = param.split(" ", 2)
+        except ValueError:
+            raise SyntaxError("Expected Key File")
+
+        if not (method == "STORE" or method == "RETRIEVE"):
+            return self.do_UNKNOWN()
+
+        func = getattr(self.remote, "transfer_{}".format(method.lower()), None)
+        cache = getattr(self.remote, "content_cache", None)
+        if not isinstance(cache, ContentCache) or method != "RETRIEVE":
+            cache = None
+        elif cache.retrieve(key, file_, self.remote.annex.progress):
+            return "TRANSFER-SUCCESS {method} {key}".format(method=method, key=key)
+        start = time.monotonic()
+        try:
+            func(key, file_)
+        except RemoteError as e:
+            return "TRANSFER-FAILURE {method} {key} {e}".format(
+                method=method, key=key, e=e
+            )
+        else:
+            if cache is not None:
+                cache.store(key, file_)
+            if method == "STORE":
+                self.forget_whereis(key)
+            estimator = getattr(self.remote, "cost_estimator", None)
+            if estimator is not None:
+                size = _keysize(key)
+                if size is None:
+                    try:
+                        size = os.path.getsize(file_)
+                    except OSError:
+                        pass
+                estimator.record_transfer(size, time.monotonic() - start)
+            return "TRANSFER-SUCCESS {method} {key}".format(method=method, key=key)
+
+    def do_CHECKPRESENT(self, key):
+        self.check_key(key)
+        start = time.monotonic()
+        try:
+            present = self.remote.checkpresent(key)
+        except RemoteError as e:
+            return "CHECKPRESENT-UNKNOWN {key} {e}".format(key=key, e=e)
+        estimator = getattr(self.remote, "cost_estimator", None)
+        if estimator is not None:
+            estimator.record_latency(time.monotonic() - start)
+        if present:
+            return "CHECKPRESENT-SUCCESS {key}".format(key=key)
+        else:
+            return "CHECKPRESENT-FAILURE {key}".format(key=key)
+
+    def do_REMOVE(self, key):
+        self.check_key(key)
+
+        try:
+            self.remote.remove(key)
+        except RemoteError as e:
+            return "REMOVE-FAILURE {key} {e}".format(key=key, e=e)
+        else:
+            self.forget_whereis(key)
+            return "REMOVE-SUCCESS {key}".format(key=key)
+
+    def do_LISTCONFIGS(self):
+        reply = []
+        for name, description in sorted(self.remote.listconfigs().items()):
+            if " " in name:
+                raise ValueError(
+                    "Name must not contain space characters: {}".format(name)
+                )
+            reply.append("CONFIG {} {}".format(name, description))
+        reply.append("CONFIGEND")
+        return "\n".join(reply)
+
+    def do_GETCOST(self):
+        cost = self.remote.getcost()
+        try:
+            cost = int(cost)
+        except ValueError:
+            raise ValueError("Cost must be an integer")
+        return "COST {cost}".format(cost=cost)
+
+    def do_GETAVAILABILITY(self):
+        reply = self.remote.getavailability()
+        if reply == "global":
+            return "AVAILABILITY GLOBAL"
+        elif reply == "local":
+            return "AVAILABILITY LOCAL"
+        elif reply == "unavailable":
+            if "UNAVAILABLERESPONSE" in self.extensions:
+                return "AVAILABILITY UNAVAILABLE"
+            # git-annex doesn't know this answer, the remote is still a remote
+            return "AVAILABILITY GLOBAL"
+        else:
+            raise ValueError(
+                "Availability must be either 'global', 'local' or 'unavailable'"
+            )
+
+    def do_CLAIMURL(self, url):
+        claims = getattr(self.remote, "url_claims", None)
+        if not isinstance(claims, UrlClaims):
+            claimed = self.remote.claimurl(url)
+        elif claims.match(url):
+            claimed = True
+        else:
+            try:
+                claimed = self.remote.claimurl(url)
+            except UnsupportedRequest:
+                claimed = False
+        if claimed:
+            return "CLAIMURL-SUCCESS"
+        else:
+            return "CLAIMURL-FAILURE"
+
+    def do_CHECKURL(self, url):
+        try:
+            reply = self.remote.checkurl(url)
+        except RemoteError as e:
+            return "CHECKURL-FAILURE {e}".format(e=e).rstrip()
+        if not reply:
+            return "CHECKURL-FAILURE"
+        elif reply is True:
+            return "CHECKURL-CONTENTS UNKNOWN"
+
+        # reply may be a generator, so only look ahead as far as needed
+        entries = iter(reply)
+        head = list(itertools.islice(entries, 2))
+        if not head:
+            return "CHECKURL-FAILURE"
+        if len(head) == 1 and "url" not in head[0]:
+            entry = self.resolve_sizes(head)[0]
+            size = entry.get("size", "UNKNOWN")
+
+            returnvalue = " ".join(("CHECKURL-CONTENTS", str(size)))
+
+            if "filename" in entry and entry["filename"]:
+                returnvalue = " ".join((returnvalue, entry["filename"]))
+            return returnvalue
+
+        # collected in a list and joined once, as repeated concatenation is quadratic
+        parts = ["CHECKURL-MULTI"]
+        for entry in self.resolve_sizes(itertools.chain(head, entries)):
+            parts.append(self.checkurl_entry(entry))
+        return " ".join(parts)
+
+    def resolve_sizes(self, entries):
+        entries = list(entries)
+        lazy = [i for i, entry in enumerate(entries) if callable(entry.get("size"))]
+        if not lazy:
+            return entries
+        pool = concurrent.futures.ThreadPoolExecutor(
+            min(self.remote.checkurl_workers, len(lazy))
+        )
+        futures = {i: pool.submit(entries[i]["size"]) for i in lazy}
+        done, _ = concurrent.futures.wait(
+            futures.values(), timeout=self.remote.checkurl_timeout
+        )
+        # don't wait for lookups which are stuck
+        pool.shutdown(wait=False, cancel_futures=True)
+        for i, future in futures.items():
+            size = "UNKNOWN"
+            if future in done:
+                try:
+                    size = future.result()
+                except RemoteError:
+                    pass
+            entries[i] = dict(entries[i], size=size)
+        return entries
+
+    def checkurl_entry(self, entry):
+        if "url" not in entry:
+            raise ValueError("Url must be present when specifying multiple values.")
+        if " " in entry["url"]:
+            raise ValueError("Url must not contain spaces.")
+
+        size = entry.get("size", "UNKNOWN")
+        filename = entry.get("filename", "")
+        if " " in filename:
+            raise ValueError("Filename must not contain spaces.")
+
+        return "{} {} {}".format(entry["url"], size, filename)
+
+    def do_WHEREIS(self, key):
+        self.check_key(key)
+        cache = getattr(self.remote, "whereis_cache", None)
+        if isinstance(cache, WhereisCache):
+            reply = cache.lookup(key, self.remote.whereis)
+        else:
+            reply = self.remote.whereis(key)
+        if reply:
+            return "WHEREIS-SUCCESS {reply}".format(reply=reply)
+        else:
+            return "WHEREIS-FAILURE"
+
+    def do_GETINFO(self):
+        info = self.remote.info
+        reply = []
+        for field in sorted(info):
+            reply.append("INFOFIELD {}".format(field))
+            reply.append("INFOVALUE {}".format(info[field]))
+        reply.append("INFOEND")
+        return "\n".join(reply)
+
+    def do_ERROR(self, message):
+        self.remote.error(message)
+
+    def do_EXPORTSUPPORTED(self):
+        if self.remote.exportsupported():
+            return "EXPORTSUPPORTED-SUCCESS"
+        else:
+            return "EXPORTSUPPORTED-FAILURE"
+
+    def do_EXPORT(self, name):
+        self.exporting = name
+
+    def do_TRANSFEREXPORT(self, param):
+        if not self.exporting:
+            raise ProtocolError("Export request without prior EXPORT")
+        try:
+            (method, key, file_) = param.split(" ", 2)
+        except ValueError:
+            raise SyntaxError("Expected Key File")
+
+        if not (method == "STORE" or method == "RETRIEVE"):
+            return self.do_UNKNOWN()
+
+        func = getattr(self.remote, "transferexport_{}".format(method.lower()), None)
+        manifest = self.export_manifest()
+        if manifest is not None and method == "STORE" and self.copy_export(key):
+            self.forget_whereis(key)
+            return "TRANSFER-SUCCESS {method} {key}".format(method=method, key=key)
+        try:
+            result = func(key, file_, self.exporting)
+        except RemoteError as e:
+            return "TRANSFER-FAILURE {method} {key} {e}".format(
+                method=method, key=key, e=e
+            )
+        else:
+            if method == "STORE":
+                self.forget_whereis(key)
+            if manifest is not None and method == "STORE":
+                size = _keysize(key)
+                if size is None:
+                    size = os.path.getsize(file_)
+                etag = result if isinstance(result, str) else None
+                manifest.add(self.exporting, key, size, etag)
+            return "TRANSFER-SUCCESS {method} {key}".format(method=method, key=key)
+
+    def copy_export(self, key):
+        """
+        Exports `key` by copying it from another path it is already exported to.
+        Returns False if that isn't possible, so that it has to be uploaded.
+        """
+        manifest = self.export_manifest()
+        for source in manifest.find(key):
+            if source == self.exporting:
+                continue
+            try:
+                result = self.remote.copyexport(key, source, self.exporting)
+            except UnsupportedRequest:
+                return False
+            except RemoteError:
+                # the manifest may be outdated
+                continue
+            entry = manifest.get(source)
+            size = entry[1] if entry else _keysize(key)
+            etag = result if isinstance(result, str) else None
+            manifest.add(self.exporting, key, size, etag)
+            return True
+        return False
+
+    def do_CHECKPRESENTEXPORT(self, key):
+        if not self.exporting:
+            raise ProtocolError("Export request without prior EXPORT")
+        self.check_key(key)
+        try:
+            present = None
+            manifest = self.export_manifest()
+            if manifest is not None:
+                present = manifest.checkpresent(key, self.exporting)
+                if present is None and not manifest.complete:
+                    self.rebuild_export_manifest(manifest)
+                    present = manifest.checkpresent(key, self.exporting)
+            if present is None:
+                present = self.remote.checkpresentexport(key, self.exporting)
+            if present:
+                return "CHECKPRESENT-SUCCESS {key}".format(key=key)
+            else:
+                return "CHECKPRESENT-FAILURE {key}".format(key=key)
+        except RemoteError as e:
+            return "CHECKPRESENT-UNKNOWN {key} {e}".format(key=key, e=e)
+
+    def do_REMOVEEXPORT(self, key):
+        if not self.exporting:
+            raise ProtocolError("Export request without prior EXPORT")
+        self.check_key(key)
+
+        try:
+            self.remote.removeexport(key, self.exporting)
+        except RemoteError as e:
+            return "REMOVE-FAILURE {key} {e}".format(key=key, e=e)
+        else:
+            self.forget_whereis(key)
+            manifest = self.export_manifest()
+            if manifest is not None:
+                manifest.remove(self.exporting)
+            return "REMOVE-SUCCESS {key}".format(key=key)
+
+    def do_REMOVEEXPORTDIRECTORY(self, name):
+        try:
+            self.remote.removeexportdirectory(name)
+        except RemoteError:
+            return "REMOVEEXPORTDIRECTORY-FAILURE"
+        else:
+            manifest = self.export_manifest()
+            if manifest is not None:
+                manifest.removedirectory(name)
+            return "REMOVEEXPORTDIRECTORY-SUCCESS"
+
+    def do_RENAMEEXPORT(self, param):
+        if not self.exporting:
+            raise ProtocolError("Export request without prior EXPORT")
+        try:
+            (key, new_name) = param.split(None, 1)
+        except ValueError:
+            raise SyntaxError("Expected TRANSFER STORE Key File")
+
+        try:
+            self.remote.renameexport(key, self.exporting, new_name)
+        except RemoteError:
+            return "RENAMEEXPORT-FAILURE {key}".format(key=key)
+        else:
+            self.forget_whereis(key)
+            manifest = self.export_manifest()
+            if manifest is not None:
+                manifest.rename(self.exporting, new_name)
+            return "RENAMEEXPORT-SUCCESS {key}".format(key=key)
+
+    def circuit_breaker(self):
+        breaker = getattr(self.remote, "circuit_breaker", None)
+        return breaker if isinstance(breaker, CircuitBreaker) else None
+
+    def unavailable_reply(self, command, parameters):
+        """
+        The reply to a request which is failed without asking the remote,
+        because its circuit breaker is open.
+        """
+        parameters = parameters[0].split(" ") if parameters else []
+        if command in ("TRANSFER", "TRANSFEREXPORT"):
+            if len(parameters) < 2:
+                raise SyntaxError("Expected Key File")
+            return "TRANSFER-FAILURE {} {} {}".format(
+                parameters[0], parameters[1], CircuitBreaker.MESSAGE
+            )
+        if not parameters:
+            raise SyntaxError("Expected Key")
+        if command in ("CHECKPRESENT", "CHECKPRESENTEXPORT"):
+            return "CHECKPRESENT-UNKNOWN {} {}".format(
+                parameters[0], CircuitBreaker.MESSAGE
+            )
+        return "REMOVE-FAILURE {} {}".format(parameters[0], CircuitBreaker.MESSAGE)
+
+    def forget_whereis(self, key):
+        cache = getattr(self.remote, "whereis_cache", None)
+        if isinstance(cache, WhereisCache):
+            cache.invalidate(key)
+
+    def export_manifest(self):
+        manifest = getattr(self.remote, "export_manifest", None)
+        return manifest if isinstance(manifest, ExportManifest) else None
+
+    def rebuild_export_manifest(self, manifest):
+        try:
+            files = self.remote.listexport()
+        except UnsupportedRequest:
+            return
+        manifest.rebuild(files)
+
+
+class ConcurrencyController(object):
+    """
+    Adapts the number of requests of a lane that may run at the same time (AIMD).
+
+    The limit is raised by one after every window of `limit` successful requests
+    in which the limit was actually reached and the throughput did not drop.
+    It is cut down by `decrease_factor` when a request fails or its latency
+    exceeds `latency_spike` times the average latency. Requests that were
+    already running when the limit was cut don't cut it again.
+
+    With `per_byte`, which is meant for transfers, latency is measured in seconds
+    per byte and throughput in bytes per second, so that a large file isn't taken
+    for a latency spike. Requests of unknown size don't contribute to either.
+
+    ...
+
+    Attributes
+    ----------
+    maximum : int
+        The upper bound of the limit, usually the number of worker threads of the lane.
+    minimum : int
+        The lower bound of the limit.
+    limit : float
+        The current limit. Only its integer part is effective.
+    active : int
+        The number of requests currently running.
+    latency : float
+        The exponentially weighted average latency of successful requests
+        in seconds (or seconds per byte with `per_byte`).
+    """
+
+    def __init__(
+        self,
+        maximum,
+        minimum=1,
+        initial=None,
+        decrease_factor=0.5,
+        latency_spike=2.0,
+        smoothing=0.2,
+        tolerance=0.1,
+        per_byte=False,
+        clock=time.monotonic,
+    ):
+        if not 1 <= minimum <= maximum:
+            raise ValueError("Expected 1 <= minimum <= maximum")
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(min(maximum, max(minimum, initial or minimum)))
+        self.decrease_factor = decrease_factor
+        self.latency_spike = latency_spike
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.per_byte = per_byte
+        self.clock = clock
+        self.active = 0
+        self.latency = None
+        self._samples = 0
+        self._epoch = 0
+        self._throughput = None
+        self._condition = threading.Condition()
+        self._start_window()
+
+    def acquire(self):
+        """
+        Blocks until another request may run.
+
+        Returns
+        -------
+        int
+            A token to be passed to release().
+        """
+        with self._condition:
+            while self.active >= int(self.limit):
+                self._condition.wait()
+            self.active += 1
+            if self.active >= int(self.limit):
+                self._saturated = True
+            return self._epoch
+
+    def release(self, token, latency, failed=False, size=None):
+        """
+        Records the outcome of a request started with acquire().
+
+        Parameters
+        ----------
+        token : int
+            The value returned by acquire().
+        latency : float
+            The duration of the request in seconds.
+        failed : bool
+            True if the request failed.
+        size : int
+            The number of bytes transferred by the request, if known.
+        """
+        with self._condition:
+            self.active -= 1
+            if self.per_byte:
+                latency = latency / size if size else None
+            spike = (
+                not failed
+                and latency is not None
+                and self._samples >= 5
+                and latency > self.latency * self.latency_spike
+            )
+            if failed or spike:
+                if token == self._epoch:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self._epoch += 1
+                    self._throughput = None
+                    self._start_window()
+            else:
+                if latency is not None:
+                    self._record_latency(latency)
+                self._window_count += 1
+                self._window_amount += (size or 0) if self.per_byte else 1
+                if self._window_count >= int(self.limit):
+                    self._close_window()
+            self._condition.notify_all()
+
+    def metrics(self):
+        """
+        Returns
+        -------
+        dict
+            The current state in the form of {'limit': int, 'maximum': int, 'active': int, 'latency': float}
+        """
+        with self._condition:
+            return {
+                "limit": int(self.limit),
+                "maximum": self.maximum,
+                "active": self.active,
+                "latency": self.latency,
+            }
+
+    def _record_latency(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += (latency - self.latency) * self.smoothing
+        self._samples += 1
+
+    def _close_window(self):
+        elapsed = max(self.clock() - self._window_start, 1e-9)
+        throughput = self._window_amount / elapsed
+        if self._saturated and (
+            self._throughput is None
+            or throughput >= self._throughput * (1 - self.tolerance)
+        ):
+            self.limit = min(self.maximum, int(self.limit) + 1)
+        self._throughput = throughput
+        self._start_window()
+
+    def _start_window(self):
+        self._window_start = self.clock()
+        self._window_count = 0
+        self._window_amount = 0
+        self._saturated = self.active >= int(self.limit)
+
+
+class CircuitBreaker(object):
+    """
+    Fails the requests of a remote right away while it seems to be unreachable,
+    instead of letting each of them wait for its own connection timeout.
+
+    Set it as `circuit_breaker` of a remote. After `threshold` consecutive
+    requests failed (TRANSFER-FAILURE, CHECKPRESENT-UNKNOWN or REMOVE-FAILURE),
+    the circuit opens: transfers, checkpresent and remove requests fail without
+    calling the remote, and GETAVAILABILITY is answered with UNAVAILABLE if
+    git-annex supports it. After `cooldown` seconds a single request is let
+    through as a probe; if it succeeds the circuit closes again, otherwise it
+    stays open for another `cooldown` seconds.
+
+    ...
+
+    Attributes
+    ----------
+    threshold : int
+        The number of consecutive failures after which the circuit opens.
+    cooldown : float
+        The number of seconds the circuit stays open before a request is let through.
+    failures : int
+        The number of consecutive failures so far.
+    """
+
+    # requests which are failed while the circuit is open
+    REQUESTS = (
+        "TRANSFER",
+        "CHECKPRESENT",
+        "REMOVE",
+        "TRANSFEREXPORT",
+        "CHECKPRESENTEXPORT",
+        "REMOVEEXPORT",
+    )
+
+    FAILURE_REPLIES = ("TRANSFER-FAILURE", "CHECKPRESENT-UNKNOWN", "REMOVE-FAILURE")
+
+    MESSAGE = "Remote unavailable"
+
+    def __init__(self, threshold=5, cooldown=30, clock=time.monotonic):
+        if threshold < 1:
+            raise ValueError("Expected threshold >= 1")
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = 0
+        self._opened = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        """
+        True while requests are failed without calling the remote.
+        """
+        with self._lock:
+            return self._opened is not None
+
+    def allow(self):
+        """
+        Returns True if a request may be passed on to the remote. Every allowed
+        request must be followed by a call of record() or release().
+        """
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._probing or self.clock() - self._opened < self.cooldown:
+                return False
+            self._probing = True
+            return True
+
+    def record(self, failed):
+        """
+        Records the outcome of an allowed request.
+        """
+        with self._lock:
+            probe = self._probing
+            self._probing = False
+            if not failed:
+                self.failures = 0
+                self._opened = None
+                return
+            self.failures += 1
+            if probe or self.failures >= self.threshold:
+                self._opened = self.clock()
+
+    def release(self):
+        """
+        Ends an allowed request whose outcome says nothing about the remote,
+        eg. because it isn't supported.
+        """
+        with self._lock:
+            self._probing = False
+
+    def is_failure(self, reply):
+        """
+        Decides whether a reply means that the remote couldn't be reached.
+        """
+        return bool(reply) and reply.split(" ", 1)[0] in self.FAILURE_REPLIES
+
+
+class JobScheduler(object):
+    """
+    Distributes the requests of concurrent git-annex jobs (ASYNC protocol extension)
+    onto lanes of worker threads, so that cheap requests like CHECKPRESENT or REMOVE
+    don't have to wait behind large transfers.
+
+    Every request is assigned to a lane by classify(). Each lane has its own queue
+    and a fixed number of worker threads. Subclasses can override classify() to
+    implement their own scheduling policy.
+
+    ...
+
+    Attributes
+    ----------
+    workers : dict
+        The number of worker threads for each lane in the form of {'lane': count, ...}
+    small_transfer_size : int
+        Transfers of keys with a size field (-s) of at most this many bytes
+        are scheduled on the 'small_transfer' lane instead of the 'transfer' lane.
+    controllers : dict
+        If adaptive concurrency is enabled, the ConcurrencyController of each lane.
+        Otherwise all worker threads of a lane are used all the time.
+    """
+
+    DEFAULT_LANES = {
+        "control": 1,
+        "metadata": 4,
+        "small_transfer": 2,
+        "transfer": 2,
+        "export": 1,
+    }
+
+    METADATA_REQUESTS = (
+        "CHECKPRESENT",
+        "REMOVE",
+        "CHECKPRESENTEXPORT",
+        "REMOVEEXPORT",
+        "WHEREIS",
+        "CLAIMURL",
+        "CHECKURL",
+        "GETCOST",
+        "GETAVAILABILITY",
+    )
+
+    # requests changing the structure of an export; the export files themselves
+    # are stored and checked on the transfer and metadata lanes
+    EXPORT_REQUESTS = (
+        "EXPORT",
+        "REMOVEEXPORTDIRECTORY",
+        "RENAMEEXPORT",
+    )
+
+    # replies which indicate that the remote raised a RemoteError
+    FAILURE_REPLIES = (
+        "INITREMOTE-FAILURE",
+        "PREPARE-FAILURE",
+        "TRANSFER-FAILURE",
+        "CHECKPRESENT-UNKNOWN",
+        "REMOVE-FAILURE",
+        "REMOVEEXPORTDIRECTORY-FAILURE",
+        "RENAMEEXPORT-FAILURE",
+        "CHECKURL-FAILURE",
+        "WHEREIS-FAILURE",
+    )
+
+    # lanes whose requests are measured per byte by their ConcurrencyController
+    TRANSFER_LANES = ("small_transfer", "transfer")
+
+    def __init__(self, lanes=None, small_transfer_size=1024 * 1024, adaptive=False):
+        """
+        Parameters
+        ----------
+        lanes : dict
+            Worker counts overriding those in DEFAULT_LANES, in the form of {'lane': count, ...}
+        small_transfer_size : int
+            The size in bytes up to which a transfer is considered small.
+        adaptive : bool
+            If True, the number of concurrently running requests of each lane is adapted
+            to the observed latency and errors, using the worker count as upper bound.
+        """
+        self.workers = dict(self.DEFAULT_LANES)
+        if lanes:
+            self.workers.update(lanes)
+        for lane, count in self.workers.items():
+            if count < 1:
+                raise ValueError("Lane {} needs at least one worker".format(lane))
+        self.small_transfer_size = small_transfer_size
+        self.controllers = {}
+        if adaptive:
+            for lane, count in self.workers.items():
+                self.controllers[lane] = ConcurrencyController(
+                    count, per_byte=lane in self.TRANSFER_LANES
+                )
+        self._queues = {}
+        self._threads = []
+
+    def classify(self, request):
+        """
+        Decides on which lane a request is to be run.
+
+        Parameters
+        ----------
+        request : str
+            The request line without the job prefix, eg. "TRANSFER STORE Key File"
+
+        Returns
+        -------
+        str
+            The name of the lane.
+        """
+        parts = request.split(" ", 3)
+        command = parts[0].upper()
+        if command in ("TRANSFER", "TRANSFEREXPORT"):
+            size = _keysize(parts[2]) if len(parts) > 2 else None
+            if size is not None and size <= self.small_transfer_size:
+                return "small_transfer"
+            return "transfer"
+        elif command in self.EXPORT_REQUESTS:
+            return "export"
+        elif command in self.METADATA_REQUESTS:
+            return "metadata"
+        else:
+            return "control"
+
+    def start(self, handler):
+        """
+        Starts the worker threads. Each of them calls handler(job, request)
+        for the requests submitted to its lane.
+        """
+        for lane, count in self.workers.items():
+            self._queues[lane] = queue.Queue()
+            for i in range(count):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(lane, handler),
+                    name="annexremote-{}-{}".format(lane, i),
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, job, request):
+        self._queues[self.classify(request)].put((job, request))
+
+    def shutdown(self):
+        """
+        Waits for all submitted requests to finish and stops the worker threads.
+        """
+        for lane, count in self.workers.items():
+            for _ in range(count):
+                self._queues[lane].put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def request_size(self, request):
+        """
+        Returns the size of the key of a transfer request, if known.
+        """
+        parts = request.split(" ", 3)
+        if parts[0].upper() in ("TRANSFER", "TRANSFEREXPORT") and len(parts) > 2:
+            return _keysize(parts[2])
+        return None
+
+    def is_failure(self, reply):
+        """
+        Decides whether a reply means that the request failed because of the remote.
+        """
+        return bool(reply) and reply.split(" ", 1)[0] in self.FAILURE_REPLIES
+
+    def metrics(self):
+        """
+        Returns
+        -------
+        dict
+            The state of each lane in the form of {'lane': {'limit': int, 'maximum': int, ...}, ...}
+            See ConcurrencyController.metrics(). Lanes without a controller
+            only report their worker count as limit.
+        """
+        metrics = {}
+        for lane, count in self.workers.items():
+            if lane in self.controllers:
+                metrics[lane] = self.controllers[lane].metrics()
+            else:
+                metrics[lane] = {"limit": count, "maximum": count}
+        return metrics
+
+    def _work(self, lane, handler):
+        lane_queue = self._queues[lane]
+        controller = self.controllers.get(lane)
+        while True:
+            item = lane_queue.get()
+            if item is None:
+                break
+            if controller is None:
+                handler(*item)
+                continue
+            token = controller.acquire()
+            start = time.monotonic()
+            failed = True
+            try:
+                reply = handler(*item)
+                failed = self.is_failure(reply)
+            finally:
+                controller.release(
+                    token,
+                    time.monotonic() - start,
+                    failed,
+                    self.request_size(item[1]),
+                )
+
+
+class _Job(object):
+    """
+    State of a single git-annex job in ASYNC mode.
+    """
+
+    def __init__(self, number, protocol):
+        self.number = number
+        self.protocol = protocol
+        self.busy = False
+        self.waiting = False
+        self.pending = []
+        self.replies = queue.Queue()
+
+
+class Master(object):
+    """
+    Metaclass for non-export remotes.
+
+    ...
+
+    Attributes
+    ----------
+    input : io.TextIOBase
+        Where to listen for git-annex request messages.
+        Default: sys.stdin
+    output : io.TextIOBase
+        Where to send replies and special remote messages
+        Default: sys.stdout
+    remote : SpecialRemote
+        A class implementing either the SpecialRemote or the
+        ExternalSpecialRemote interface to which this master is linked.
+    """
+
+    # messages of git-annex which answer a query of the remote
+    REPLIES = ("VALUE", "CREDS")
+
+    # requests of git-annex which don't get a reply
+    UNANSWERED = ("EXPORT", "ERROR")
+
+    def __init__(self, output=sys.stdout):
+        """
+        Initialize the Master with an output.
+
+        Parameters
+        ----------
+        output : io.TextIOBase
+            Where to send replies and special remote messages
+            Default: sys.stdout
+        """
+        self.output = output
+        self.scheduler = None
+        self._jobs = {}
+        self._jobs_lock = threading.Condition()
+        self._local = threading.local()
+        self._output_lock = threading.RLock()
+        self._fatal = False
+        self.recorder = None
+        self.profiler = None
+
+    def LinkRemote(self, remote):
+        """
+        Link the Master to a remote. This must be done before calling Listen()
+
+        Parameters
+        ----------
+        remote : SpecialRemote
+            A class implementing either the SpecialRemote or the
+            ExternalSpecialRemote interface to which this master will be linked.
+        """
+        self.remote = remote
+        self.protocol = Protocol(remote)
+
+    def LoggingHandler(self):
+        """
+        Gets an instance of AnnexLoggingHandler
+
+        Returns
+        -------
+        AnnexLoggingHandler
+        """
+        return AnnexLoggingHandler(self)
+
+    def EnableJobs(
+        self,
+        lanes=None,
+        small_transfer_size=1024 * 1024,
+        adaptive=False,
+        scheduler=None,
+    ):
+        """
+        Allows git-annex to send concurrent requests (ASYNC protocol extension).
+        The requests are run on lanes of worker threads as described in JobScheduler,
+        so the linked remote must be safe to use from several threads at once.
+        This must be done before calling Listen()
+
+        Parameters
+        ----------
+        lanes : dict
+            Worker counts per lane in the form of {'lane': count, ...}.
+            See JobScheduler.DEFAULT_LANES for the available lanes.
+        small_transfer_size : int
+            The size in bytes up to which a transfer is scheduled on the 'small_transfer' lane.
+        adaptive : bool
+            If True, the number of concurrently running requests of each lane is raised
+            while the latency stays flat and cut down on errors or latency spikes.
+            The worker counts are used as upper bounds. See ConcurrencyController.
+        scheduler : JobScheduler
+            A custom scheduler to use instead of the default one. If given, the other
+            parameters are ignored.
+        """
+        if scheduler is None:
+            scheduler = JobScheduler(lanes, small_transfer_size, adaptive)
+        self.scheduler = scheduler
+
+    def Listen(self, input=sys.stdin):
+        """
+        Listen on `input` for messages from git annex.
+
+        Parameters
+        ----------
+        input : io.TextIOBase
+            Where to listen for git-annex request messages.
+            Default: sys.stdin
+
+        Raises
+        ----------
+        NotLinkedError
+            If there is no remote linked to this master.
+        """
+        if not (hasattr(self, "remote") and hasattr(self, "protocol")):
+            raise NotLinkedError("Please execute LinkRemote(remote) first.")
+
+        self.input = input
+        if os.environ.get("ANNEXREMOTE_RECORD"):
+            self.recorder = SessionRecorder(os.environ["ANNEXREMOTE_RECORD"])
+        if os.environ.get("ANNEXREMOTE_PROFILE"):
+            self.profiler = RequestProfiler(
+                os.environ["ANNEXREMOTE_PROFILE"],
+                memory=bool(os.environ.get("ANNEXREMOTE_PROFILE_MEMORY")),
+            )
+        if self.scheduler is not None:
+            if "ASYNC" not in self.protocol.remote_extensions:
+                self.protocol.remote_extensions.append("ASYNC")
+            self.scheduler.start(self._run_job)
+        self._send(self.protocol.version)
+        try:
+            while not self._fatal:
+                # due to a bug in python 2 we can't use an iterator here: https://bugs.python.org/issue1633941
+                line = self._readinput()
+                if not line:
+                    break
+                line = line.rstrip()
+                try:
+                    if self.scheduler is not None and line.startswith("J "):
+                        self._dispatch_job(line)
+                        continue
+                    reply = self._command(self.protocol, line)
+                    if reply:
+                        self._send(reply)
+                except UnsupportedRequest:
+                    self._send("UNSUPPORTED-REQUEST")
+                except Exception as e:
+                    for line in traceback.format_exc().splitlines():
+                        self.debug(line)
+                    self.error(e)
+                    raise SystemExit
+        finally:
+            if self.scheduler is not None:
+                self._drain_jobs()
+                self.scheduler.shutdown()
+            if self.recorder is not None:
+                self.recorder.close()
+                self.recorder = None
+            if self.profiler is not None:
+                self.profiler.dump()
+                self.profiler = None
+        self.profiler = None
+        if self._fatal:
+            raise SystemExit
+
+    def _dispatch_job(self, line):
+        try:
+            _, number, request = line.split(" ", 2)
+        except ValueError:
+            raise SyntaxError("Expected J Number Request")
+
+        job = self._jobs.get(number)
+        if job is None:
+            protocol = Protocol(self.remote)
+            protocol.extensions = self.protocol.extensions
+            job = self._jobs[number] = _Job(number, protocol)
+
+        command = request.split(" ", 1)[0]
+        with self._jobs_lock:
+            if job.waiting or command in self.REPLIES:
+                # the answer to a query of the running request
+                job.replies.put(request)
+                return
+            elif job.busy:
+                # git-annex runs a job's requests one after another, but
+                # EXPORT is followed by its request without waiting for a reply
+                job.pending.append(request)
+                return
+            elif command not in self.UNANSWERED:
+                job.busy = True
+                self.scheduler.submit(job, request)
+                return
+        reply = self._command(job.protocol, request)
+        if reply:
+            self._send(reply)
+
+    def _drain_jobs(self):
+        # let running requests finish, but fail those still waiting for an answer
+        with self._jobs_lock:
+            self._jobs_lock.wait_for(
+                lambda: all(not job.busy or job.waiting for job in self._jobs.values())
+            )
+            for job in self._jobs.values():
+                if job.busy:
+                    job.replies.put(None)
+            self._jobs_lock.wait_for(
+                lambda: not any(job.busy for job in self._jobs.values())
+            )
+
+    def _run_job(self, job, request):
+        self._local.job = job
+        try:
+            reply = self._command(job.protocol, request)
+        except UnsupportedRequest:
+            reply = "UNSUPPORTED-REQUEST"
+        except BaseException as e:
+            for line in traceback.format_exc().splitlines():
+                self.debug(line)
+            if not isinstance(e, SystemExit):
+                self.error(e)
+            self._fatal = True
+            reply = None
+        # the job must be free before git-annex gets the reply and sends its next request
+        with self._jobs_lock:
+            if self._fatal:
+                job.pending = []
+            following = job.pending.pop(0) if job.pending else None
+            job.busy = following is not None
+            self._jobs_lock.notify_all()
+        if reply:
+            self._send(reply)
+        self._local.job = None
+        if following is not None:
+            self.scheduler.submit(job, following)
+        return reply
+
+    def _command(self, protocol, line):
+        if self.profiler is None:
+            return protocol.command(line)
+        return self.profiler.run(protocol.command, line)
+
+    def _readline(self):
+        job = getattr(self._local, "job", None)
+        if job is None:
+            return self._readinput()
+        line = job.replies.get()
+        if line is None:
+            return ""
+        return line
+
+    def _readinput(self):
+        line = self.input.readline()
+        if line and self.recorder is not None:
+            self.recorder.record("<", line.rstrip("\n"))
+        return line
+
+    def _query(self, request):
+        job = getattr(self._local, "job", None)
+        if job is not None:
+            with self._jobs_lock:
+                job.waiting = True
+                self._jobs_lock.notify_all()
+        self._send(request)
+
+    def _query_done(self):
+        job = getattr(self._local, "job", None)
+        if job is not None:
+            with self._jobs_lock:
+                job.waiting = False
+
+    def _ask(self, request, reply_keyword, reply_count):
+        self._query(request)
+        try:
+            line = self._readline().rstrip().split(" ", reply_count)
+        finally:
+            self._query_done()
+        if line and line[0] == reply_keyword:
+            line.extend([""] * (reply_count + 1 - len(line)))
+            return line[1:]
+        else:
+            raise UnexpectedMessage(
+                "Expected {reply_keyword} and {reply_count} values. Got {line}".format(
+                    reply_keyword=reply_keyword, reply_count=reply_count, line=line
+                )
+            )
+
+    def _askvalues(self, request):
+        return list(self._itervalues(request))
+
+    def _itervalues(self, request):
+        # the request is sent right away, the values are read as they are consumed
+        self._query(request)
+        values = self._values()
+        # enter the generator, so closing it before the first value still drains
+        next(values)
+        return values
+
+    def _values(self):
+        finished = False
+        try:
+            yield
+            while True:
+                line = self._readline()
+                line = line.rstrip()
+                line = line.split(" ", 1)
+                if len(line) == 2 and line[0] == "VALUE":
+                    yield line[1]
+                elif len(line) == 1 and line[0] == "VALUE":
+                    finished = True
+                    return
+                else:
+                    finished = True
+                    raise UnexpectedMessage("Expected VALUE {value}")
+        finally:
+            if not finished:
+                # stopped early, skip the remaining values up to the terminator
+                # so the next reply is not taken for one of them
+                while True:
+                    line = self._readline().rstrip()
+                    if not line.startswith("VALUE "):
+                        break
+            self._query_done()
+
+    def _askvalue(self, request):
+        (reply,) = self._ask(request, "VALUE", 1)
+        return reply
+
+    def getconfig(self, setting):
+        """
+        Gets one of the special remote's configuration settings,
+        which can have been passed by the user when running `git annex initremote`,
+        `git annex enableremote` or can have been set by a previous setconfig(). Can be run at any time.
+        It's recommended that special remotes that use this implement listconfigs().
+
+        Parameters
+        ----------
+        setting : str
+            Which setting to get
+
+        Returns
+        -------
+        str
+            The requested setting. If the setting is not set, the value will an empty string.
+
+        Raises
+        ----------
+        UnexpectedMessage
+            If git-annex does not respond correctly to this request, which is very unlikely.
+        """
+        return self._askvalue("GETCONFIG {}".format(setting))
+
+    def setconfig(self, setting, value):
+        """
+        Sets one of the special remote's configuration settings.
+        Normally this is sent during initremote(), which allows these settings to be
+        stored in the git-annex branch, so will be available if the same special remote
+        is used elsewhere. (If sent after initremote(), the changed configuration will
+        only be available while the remote is running.)
+
+        Parameters
+        ----------
+        setting : str
+            The name of the setting
+        value : str
+            The value of the setting
+        """
+        self._send("SETCONFIG {} {}".format(setting, value))
+
+    def getstate(self, key):
+        """
+        Gets any state that has been stored for the key via setstate().
+
+        Parameters
+        ----------
+        key : str
+            The key for which to get the state
+
+        Returns
+        -------
+        str
+            The requested state. If the state is not set, the value will an empty string.
+
+        Raises
+        ----------
+        UnexpectedMessage
+            If git-annex does not respond correctly to this request, which is very unlikely.
+        """
+        return self._askvalue("GETSTATE {key}".format(key=key))
+
+    def setstate(self, key, value):
+        """
+        Can be used to store some form of state for a Key. The state stored can be anything
+        this remote needs to store, in any format. It is stored in the git-annex branch.
+        Note that this means that if multiple repositories are using the same special
+        remote, and store different state, whichever one stored the state last will win.
+        Also, it's best to avoid storing much state, since this will bloat the git-annex
+        branch. Most remotes will not need to store any state.
+
+        Parameters
+        ----------
+        key : str
+            The key for which to store the state
+        value : str
+            The state for the key to store
+        """
+        self._send("SETSTATE {key} {value}".format(key=key, value=value))
+
+    def debug(self, *args):
+        """
+        Tells git-annex to display the message if --debug is enabled.
+
+        Parameters
+        ----------
+        message : str
+            The message to be displayed to the user
+        """
+
+        self._send("DEBUG", *args)
+
+    def error(self, *args):
+        """
+        Generic error. Can be sent at any time if things get too messed up to continue.
+        When possible, raise a RemoteError inside the respective functions.
+        The special remote program should exit after sending this, as git-annex will
+        not talk to it any further.
+
+        Parameters
         ----------
         error_msg : str
             The error message to be sent to git-annex
@@ -1041,311 +3401,1789 @@ class Master(object):
         any number of times during the transfer process, but it's wasteful to update
         the progress until at least another 1% of the file has been sent.
         This is highly recommended for *_store(). (It is optional but good for *_retrieve().)
+        ProgressFile wraps a file object and calls this throttled as it is read or written.
 
         Parameters
         ----------
         progress : int
             The current progress of the transfer in bytes.
         """
-        self._send("PROGRESS {progress}".format(progress=int(progress)))
+        self._send("PROGRESS {progress}".format(progress=int(progress)))
+
+    def dirhash(self, key):
+        """
+        Gets a two level hash associated with a Key. Something like "aB/Cd".
+        This is always the same for any given Key, so can be used for eg,
+        creating hash directory structures to store Keys in. This is the
+        same directory hash that git-annex uses inside .git/annex/objects/
+
+        Parameters
+        ----------
+        key : str
+            The key for which to get the hash
+
+        Returns
+        -------
+        str
+            The two level hash. (eg. "aB/Cd")
+
+        Raises
+        ----------
+        UnexpectedMessage
+            If git-annex does not respond correctly to this request, which is very unlikely.
+        """
+        return self._askvalue("DIRHASH {key}".format(key=key))
+
+    def dirhash_lower(self, key):
+        """
+        Gets a two level hash associated with a Key, using only lower-case.
+        Something like "abc/def".
+        This is always the same for any given Key, so can be used for eg,
+        creating hash directory structures to store Keys in. This is the
+        same directory hash that is used by eg, the directory special remote.
+
+        Parameters
+        ----------
+        key : str
+            The key for which to get the hash
+
+        Returns
+        -------
+        str
+            The two level hash. (eg. "abc/def")
+
+        Raises
+        ----------
+        UnexpectedMessage
+            If git-annex does not respond correctly to this request, which is very unlikely.
+        """
+        return self._askvalue("DIRHASH-LOWER {key}".format(key=key))
+
+    def setcreds(self, setting, user, password):
+        """
+        When some form of user and password is needed to access a special
+        remote, this can be used to securely store them for later use.
+        (Like setconfig(), this is normally sent only during initremote().)
+        Note that creds are normally only stored in the remote's
+        configuration when it's surely safe to do so; when gpg encryption
+        is used, in which case the creds will be encrypted using it.
+        If creds are not stored in the configuration, they'll only be stored
+        in a local file. (embedcreds can be set to yes by the user or by
+        setconfig() to force the creds to be stored in the remote's configuration).
+
+        Parameters
+        ----------
+        setting : str
+            Indicates which value in a remote's configuration
+            can be used to store the creds.
+        user : str
+            The username to be stored
+        password : str
+            The password to be stored
+        """
+        self._send("SETCREDS", setting, user, password)
+
+    def getcreds(self, setting):
+        """
+        Gets any creds that were previously stored in the remote's
+        configuration or a file.
+
+        Parameters
+        ----------
+        setting : str
+            Indicates which value in a remote's configuration
+            where the credentials are stored.
+
+        Returns
+        ----------
+        dict of str : str
+            A dict containing username of password in the form:
+            {'user': "username", 'password': "password"}
+            If there are no credentials found, both 'user' and 'password' are empty.
+            Note: In version 2.0, a named tuple will be used instead of a dict.
+
+        Raises
+        ----------
+        UnexpectedMessage
+            If git-annex does not respond correctly to this request, which is very unlikely.
+        """
+        (user, password) = self._ask(
+            "GETCREDS {setting}".format(setting=setting), "CREDS", 2
+        )
+        # TODO: (v2.0) use namedtuple instead of dict
+        return {"user": user, "password": password}
+
+    def getuuid(self):
+        """
+        Queries for the UUID of the special remote being used.
+
+        Returns
+        ----------
+        str
+            The UUID of the special remote
+
+        """
+        return self._askvalue("GETUUID")
+
+    def getgitdir(self):
+        """
+        Queries for the path to the git directory of the repository that
+        is using the external special remote.
+
+        Returns
+        ----------
+        str
+            The (relative) path to the git directory
+        """
+
+        return self._askvalue("GETGITDIR")
+
+    def setwanted(self, prefcontent):
+        """
+        Can be used to set the preferred content of a repository. Normally
+        this is not configured by a special remote, but it may make sense
+        in some situations to hint at the kind of content that should be
+        stored in the special remote.
+        Note that if an unparsable expression is set, git-annex will ignore it.
+
+        Parameters
+        ----------
+        prefcontent : str
+            The PreferredContentExpression,
+            see https://git-annex.branchable.com/git-annex-preferred-content/
+        """
+        self._send("SETWANTED", prefcontent)
+
+    def getwanted(self):
+        """
+        Gets the current preferred content setting of the repository.
+
+        Returns
+        ----------
+        str
+            The PreferredContentExpression,
+            see https://git-annex.branchable.com/git-annex-preferred-content/
+
+        Raises
+        ----------
+        UnexpectedMessage
+            If git-annex does not respond correctly to this request, which is very unlikely.
+        """
+        return self._askvalue("GETWANTED")
+
+    def seturlpresent(self, key, url):
+        """
+        Records a URL where the Key can be downloaded from.
+        Note that this does not make git-annex think that the url is present
+        on the web special remote.
+        Keep in mind that this stores the url in the git-annex branch. This
+        can result in bloat to the branch if the url is large and/or does not
+        delta pack well with other information (such as the names of keys)
+        already stored in the branch.
+
+        Parameters
+        ----------
+        key : str
+            The key for which to record a URL
+        url : str
+            The URL from which the key can be downloaded
+        """
+        self._send("SETURLPRESENT", key, url)
+
+    def seturlmissing(self, key, url):
+        """
+        Records that the key can no longer be downloaded from the specified URL.
+
+        Parameters
+        ----------
+        key : str
+            The key for which to delete the URL
+        url : str
+            The URL which is no longer accessible
+        """
+        self._send("SETURLMISSING", key, url)
+
+    def seturipresent(self, key, uri):
+        """
+        Records a URI where the Key can be downloaded from.
+        For example, "ipfs:ADDRESS" is used for the ipfs special remote;
+        its CLAIMURL handler checks for such URIS and claims them.
+
+        Parameters
+        ----------
+        key : str
+            The key for which to record a URI
+        uri : str
+            The URI from which the key can be downloaded
+        """
+        self._send("SETURIPRESENT", key, uri)
+
+    def seturimissing(self, key, uri):
+        """
+        Records that the key can no longer be downloaded from the specified URI.
+
+        Parameters
+        ----------
+        key : str
+            The key for which to delete the URI
+        uri : str
+            The URI which is no longer accessible
+        """
+        self._send("SETURIMISSING", key, uri)
 
-    def dirhash(self, key):
+    def geturls(self, key, prefix):
         """
-        Gets a two level hash associated with a Key. Something like "aB/Cd".
-        This is always the same for any given Key, so can be used for eg,
-        creating hash directory structures to store Keys in. This is the
-        same directory hash that git-annex uses inside .git/annex/objects/
+        Gets the recorded URLs where a key can be downloaded from.
 
         Parameters
         ----------
         key : str
-            The key for which to get the hash
+            The key for which to get the URLs
+        prefix : str
+            Only urls that start with the prefix will be returned.
+            The Prefix may be empty to get all urls.
 
         Returns
-        -------
-        str
-            The two level hash. (eg. "aB/Cd")
+        ----------
+        list of str
+            The URLs from which the key can be downloaded
 
         Raises
         ----------
         UnexpectedMessage
             If git-annex does not respond correctly to this request, which is very unlikely.
         """
-        return self._askvalue("DIRHASH {key}".format(key=key))
+        return self._askvalues("GETURLS {key} {prefix}".format(key=key, prefix=prefix))
 
-    def dirhash_lower(self, key):
+    def geturls_iter(self, key, prefix):
         """
-        Gets a two level hash associated with a Key, using only lower-case.
-        Something like "abc/def".
-        This is always the same for any given Key, so can be used for eg,
-        creating hash directory structures to store Keys in. This is the
-        same directory hash that is used by eg, the directory special remote.
+        Like geturls(), but yields the URLs as git-annex sends them, so a remote
+        that only needs the first suitable one does not wait for the rest.
+
+        The request is sent when this is called. If the iteration is stopped early,
+        the remaining URLs are read and discarded when the iterator is closed or
+        garbage collected. Close it (or use contextlib.closing) before sending any
+        other message to git-annex.
 
         Parameters
         ----------
         key : str
-            The key for which to get the hash
+            The key for which to get the URLs
+        prefix : str
+            Only urls that start with the prefix will be returned.
+            The Prefix may be empty to get all urls.
 
         Returns
-        -------
-        str
-            The two level hash. (eg. "abc/def")
+        ----------
+        iterator of str
+            The URLs from which the key can be downloaded
 
         Raises
         ----------
         UnexpectedMessage
             If git-annex does not respond correctly to this request, which is very unlikely.
         """
-        return self._askvalue("DIRHASH-LOWER {key}".format(key=key))
+        return self._itervalues(
+            "GETURLS {key} {prefix}".format(key=key, prefix=prefix)
+        )
 
-    def setcreds(self, setting, user, password):
+    def info(self, message):
         """
-        When some form of user and password is needed to access a special
-        remote, this can be used to securely store them for later use.
-        (Like setconfig(), this is normally sent only during initremote().)
-        Note that creds are normally only stored in the remote's
-        configuration when it's surely safe to do so; when gpg encryption
-        is used, in which case the creds will be encrypted using it.
-        If creds are not stored in the configuration, they'll only be stored
-        in a local file. (embedcreds can be set to yes by the user or by
-        setconfig() to force the creds to be stored in the remote's configuration).
+        Tells git-annex to display the message to the user.
+        When git-annex is in --json mode, the message will be emitted immediately
+        in its own json object, with an "info" field.
+
+        Important: This is a protocol extension and may raise a ProtocolError if
+        the particular version of git-annex does not support it. Remotes using info()
+        should always prepare to handle the exception.
 
         Parameters
         ----------
-        setting : str
-            Indicates which value in a remote's configuration
-            can be used to store the creds.
-        user : str
-            The username to be stored
-        password : str
-            The password to be stored
+        message : str
+            The message to be displayed to the user
+
+        Raises
+        ----------
+        ProtocolError
+            If INFO is not available in this version of git-annex.
         """
-        self._send("SETCREDS", setting, user, password)
+        if "INFO" in self.protocol.extensions:
+            self._send("INFO", message)
+        else:
+            raise ProtocolError("INFO not available")
 
-    def getcreds(self, setting):
+    def getgitremotename(self):
         """
-        Gets any creds that were previously stored in the remote's
-        configuration or a file.
+        Gets the name of the git remote that represents this special remote.
+        This can be used, for example, to look up git configuration belonging to that
+        git remote. This name will often be the same as what is passed to git-annex
+        initremote and enableremote, but it is possible for git remotes to be renamed,
+        and this will provide the remote's current name.
+
+        Important: This is a protocol extension and may raise a ProtocolError if
+        the particular version of git-annex does not support it. Remotes using
+        getgetremotename() should always prepare to handle the exception.
+
+        Returns
+        ----------
+        str
+            The name of the git remote that represents this special remote
+
+        Raises
+        ----------
+        ProtocolError
+            If GETGITREMOTENAME is not available in this version of git-annex.
+        """
+        if "GETGITREMOTENAME" in self.protocol.extensions:
+            return self._askvalue("GETGITREMOTENAME")
+        else:
+            raise ProtocolError("GETGITREMOTENAME not available")
+
+    def _send(self, *args, **kwargs):
+        job = getattr(self._local, "job", None)
+        message = kwargs.get("sep", " ").join(str(arg) for arg in args)
+        with self._output_lock:
+            for line in message.split("\n"):
+                if job is not None:
+                    line = "J {} {}".format(job.number, line)
+                print(line, file=self.output)
+                if self.recorder is not None:
+                    self.recorder.record(">", line)
+            self.output.flush()
+
+
+class RequestProfiler(object):
+    """
+    Collects cProfile statistics (and optionally tracemalloc snapshots)
+    per request type, eg. TRANSFER-STORE or CHECKPRESENT.
+
+    Master profiles its requests if the environment variable ANNEXREMOTE_PROFILE
+    is set to a directory. "{pid}" in the path is replaced by the process id.
+    At the end of the session, the statistics of each request type are written
+    to `<type>.pstats` in that directory and can be read with the pstats module.
+
+    If ANNEXREMOTE_PROFILE_MEMORY is set as well, the peak memory allocated
+    during each request is traced. The maximum peak per request type is written
+    to `memory.txt` and a snapshot taken at the end of the request with the
+    highest peak to `<type>.tracemalloc` (see tracemalloc.Snapshot.load()).
+
+    Only one request is profiled at a time. With concurrent jobs,
+    requests that run while another one is being profiled are not profiled,
+    and memory peaks are those of the whole process.
+    """
+
+    def __init__(self, directory, memory=False):
+        self.directory = directory.replace("{pid}", str(os.getpid()))
+        os.makedirs(self.directory, exist_ok=True)
+        self.memory = memory
+        self.profiles = {}
+        self.peaks = {}
+        self.counts = {}
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self._tracing = memory and not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start()
+
+    @staticmethod
+    def request_type(line):
+        parts = line.split(" ", 2)
+        if parts[0].upper() in ("TRANSFER", "TRANSFEREXPORT") and len(parts) > 1:
+            return "-".join(parts[:2]).upper()
+        return parts[0].upper()
+
+    def run(self, func, line):
+        if not self._lock.acquire(blocking=False):
+            return func(line)
+        try:
+            request_type = self.request_type(line)
+            self.counts[request_type] = self.counts.get(request_type, 0) + 1
+            profile = self.profiles.setdefault(request_type, cProfile.Profile())
+            if self.memory:
+                tracemalloc.reset_peak()
+                start, _ = tracemalloc.get_traced_memory()
+            profile.enable()
+            try:
+                return func(line)
+            finally:
+                profile.disable()
+                if self.memory:
+                    self._record_peak(request_type, start)
+        finally:
+            self._lock.release()
+
+    def _record_peak(self, request_type, start):
+        _, peak = tracemalloc.get_traced_memory()
+        peak -= start
+        if peak > self.peaks.get(request_type, -1):
+            self.peaks[request_type] = peak
+            self._snapshots[request_type] = tracemalloc.take_snapshot()
+
+    def dump(self):
+        for request_type, profile in self.profiles.items():
+            profile.dump_stats(
+                os.path.join(self.directory, "{}.pstats".format(request_type))
+            )
+        if self.memory:
+            with open(os.path.join(self.directory, "memory.txt"), "w") as f:
+                for request_type in sorted(self.peaks):
+                    f.write(
+                        "{} {} {}\n".format(
+                            request_type,
+                            self.counts[request_type],
+                            self.peaks[request_type],
+                        )
+                    )
+            for request_type, snapshot in self._snapshots.items():
+                snapshot.dump(
+                    os.path.join(self.directory, "{}.tracemalloc".format(request_type))
+                )
+        if self._tracing:
+            tracemalloc.stop()
+
+
+def _splitjob(line):
+    """
+    Splits a line into its job number (None if not part of a job) and the message.
+    """
+    if line.startswith("J "):
+        parts = line.split(" ", 2)
+        return parts[1], parts[2] if len(parts) == 3 else ""
+    return None, line
+
+
+class SessionRecorder(object):
+    """
+    Writes a transcript of all lines exchanged with git-annex to a file.
+
+    Master records a session if the environment variable ANNEXREMOTE_RECORD
+    is set to the path of the transcript. "{pid}" in the path is replaced by
+    the process id, as git-annex may start several remote processes at once.
+    Each line of the transcript consists of the seconds since the start of the
+    session, the direction ('<' for lines from git-annex and '>' for lines to
+    git-annex) and the line itself, separated by a space.
+    The transcript is only readable by the current user and the user and
+    password of CREDS and SETCREDS lines are masked.
+    The transcript can be fed into a remote with SessionReplay.
+    """
+
+    MASK = "***"
+
+    def __init__(self, path):
+        path = path.replace("{pid}", str(os.getpid()))
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        self.file = os.fdopen(fd, "w")
+        self.start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def mask(self, line):
+        job, message = _splitjob(line)
+        parts = message.split(" ")
+        if parts[0] == "CREDS":
+            message = " ".join(["CREDS", self.MASK, self.MASK])
+        elif parts[0] == "SETCREDS":
+            message = " ".join(parts[:2] + [self.MASK, self.MASK])
+        else:
+            return line
+        return message if job is None else "J {} {}".format(job, message)
+
+    def record(self, direction, line):
+        line = self.mask(line)
+        with self._lock:
+            self.file.write(
+                "{:.6f} {} {}\n".format(time.monotonic() - self.start, direction, line)
+            )
+            self.file.flush()
 
+    def close(self):
+        self.file.close()
+
+
+class SessionReplay(object):
+    """
+    Feeds a transcript written by SessionRecorder into a remote.
+
+    It acts as both input and output of a Master: the requests of the recorded
+    session are sent to the remote in their original order. When the remote
+    queries git-annex (eg. GETCONFIG), the reply is taken from the recording.
+    The next request of a job is only sent after the remote replied to the
+    previous one, just like git-annex does.
+
+    If the remote sends a query that was not recorded, it gets an ERROR reply
+    instead, which makes the query fail with UnexpectedMessage.
+
+    Example:
+        replay = SessionReplay("transcript.log")
+        master = Master()
+        remote = MyRemote(master)
+        master.LinkRemote(remote)
+        duration = replay.run(master)
+
+    ...
+
+    Attributes
+    ----------
+    realtime : bool
+        If True, no request is sent earlier than in the recorded session.
+        Otherwise the session is replayed as fast as the remote can handle it.
+    output : list of str
+        The lines the remote sent during the replay.
+    """
+
+    QUERIES = (
+        "GETCONFIG",
+        "GETCREDS",
+        "GETUUID",
+        "GETGITDIR",
+        "GETWANTED",
+        "GETSTATE",
+        "DIRHASH",
+        "DIRHASH-LOWER",
+        "GETURLS",
+        "GETGITREMOTENAME",
+    )
+
+    # messages to git-annex that don't end a request
+    NOTIFICATIONS = (
+        "VERSION",
+        "PROGRESS",
+        "DEBUG",
+        "INFO",
+        "ERROR",
+        "SETCONFIG",
+        "SETCREDS",
+        "SETSTATE",
+        "SETWANTED",
+        "SETURLPRESENT",
+        "SETURLMISSING",
+        "SETURIPRESENT",
+        "SETURIMISSING",
+    )
+
+    # requests git-annex doesn't expect a reply to
+    UNANSWERED = ("EXPORT", "ERROR")
+
+    def __init__(self, transcript, realtime=False):
+        """
         Parameters
         ----------
-        setting : str
-            Indicates which value in a remote's configuration
-            where the credentials are stored.
+        transcript : str
+            Path to the transcript to replay.
+        realtime : bool
+            If True, replay at the original speed instead of the maximum speed.
+        """
+        self.realtime = realtime
+        self.output = []
+        self._requests = []
+        self._answers = {}
+        self._replies = []
+        self._busy = set()
+        self._buffer = ""
+        self._condition = threading.Condition()
+        self._start = time.monotonic()
+        self._load(transcript)
+
+    def _load(self, transcript):
+        last_query = {}
+        with open(transcript) as f:
+            for event in f:
+                offset, direction, line = event.rstrip("\n").split(" ", 2)
+                job, message = _splitjob(line)
+                command = message.split(" ", 1)[0]
+                if direction == ">":
+                    if command in self.QUERIES:
+                        answers = self._answers.setdefault(message, [])
+                        answers.append([])
+                        last_query[job] = answers[-1]
+                elif command in ("VALUE", "CREDS"):
+                    # replies that can't be matched to a query are dropped
+                    if job in last_query:
+                        last_query[job].append(message)
+                else:
+                    self._requests.append((float(offset), line))
+        self._requests.reverse()
+
+    def run(self, master):
+        """
+        Replays the session into the remote linked to `master`.
 
         Returns
+        -------
+        float
+            The duration of the replay in seconds.
+        """
+        master.output = self
+        self._start = time.monotonic()
+        master.Listen(self)
+        return time.monotonic() - self._start
+
+    def readline(self):
+        with self._condition:
+            while True:
+                if self._replies:
+                    return self._replies.pop(0) + "\n"
+                if not self._requests:
+                    if self._busy:
+                        self._condition.wait()
+                        continue
+                    return ""
+                offset, line = self._requests[-1]
+                job, message = _splitjob(line)
+                if job in self._busy:
+                    self._condition.wait()
+                    continue
+                if self.realtime:
+                    delay = self._start + offset - time.monotonic()
+                    if delay > 0:
+                        self._condition.wait(delay)
+                        continue
+                self._requests.pop()
+                if message.split(" ", 1)[0] not in self.UNANSWERED:
+                    self._busy.add(job)
+                return line + "\n"
+
+    def write(self, data):
+        with self._condition:
+            self._buffer += data
+            while "\n" in self._buffer:
+                line, self._buffer = self._buffer.split("\n", 1)
+                self._handle_output(line)
+            self._condition.notify_all()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _handle_output(self, line):
+        self.output.append(line)
+        job, message = _splitjob(line)
+        command = message.split(" ", 1)[0]
+        if command in self.QUERIES:
+            answers = self._answers.get(message)
+            replies = None
+            if answers:
+                # repeated queries get the recorded replies in order, then the last one again
+                replies = answers.pop(0) if len(answers) > 1 else answers[0]
+            if not replies:
+                replies = ["ERROR No recorded reply to {}".format(message)]
+            prefix = "" if job is None else "J {} ".format(job)
+            self._replies.extend(prefix + reply for reply in replies)
+        elif command == "ERROR":
+            # the remote gives up, so git-annex wouldn't send anything further
+            self._requests = []
+            self._busy.clear()
+        elif command not in self.NOTIFICATIONS:
+            self._busy.discard(job)
+
+
+class _DaemonProtocol(Protocol):
+    """
+    Protocol of a RemoteServer connection. PREPARE reuses a prepared remote
+    of the same UUID from the server's pool instead of preparing a new one.
+    """
+
+    def __init__(self, remote, server):
+        super().__init__(remote)
+        self.server = server
+        self.uuid = None
+
+    def do_PREPARE(self):
+        master = self.remote.annex
+        uuid = master.getuuid()
+        remote = self.server.checkout(uuid)
+        if remote is None:
+            reply = super().do_PREPARE()
+            if reply == "PREPARE-SUCCESS":
+                self.uuid = uuid
+            return reply
+        remote.annex = master
+        master.remote = self.remote = remote
+        self.uuid = uuid
+        return "PREPARE-SUCCESS"
+
+
+class RemoteServer(object):
+    """
+    Long-lived process that serves remote sessions on a Unix socket, so that
+    the cost of prepare() (authentication, TLS setup, ...) is only paid once
+    instead of for every git-annex command.
+
+    git-annex starts the remote program as usual, which then only relays
+    its input and output to the server (see RemoteShim and daemon_main()).
+    The server runs each session in its own thread with a new instance of
+    the remote. Once prepared, the instance is kept in a pool per remote
+    UUID and used again by later sessions instead of being prepared anew.
+    Instances unused for `idle_timeout` seconds are dropped, and the server
+    exits when it has been idle for that long.
+
+    Remotes used this way must not depend on the working directory or
+    environment of the process git-annex started. Paths of local files are
+    made absolute by the shim. Concurrent jobs (EnableJobs) are not supported.
+
+    ...
+
+    Attributes
+    ----------
+    factory : callable
+        Creates a new remote for a Master, usually the remote class itself.
+    path : str
+        Path of the Unix socket.
+    idle_timeout : float
+        Seconds after which unused remotes are dropped and an idle server exits.
+    """
+
+    def __init__(self, factory, path, idle_timeout=300):
+        self.factory = factory
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.pool = {}
+        self.connections = 0
+        self._last_activity = time.monotonic()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def checkout(self, uuid):
+        """
+        Takes a prepared remote for `uuid` from the pool, or returns None if there is none.
+        """
+        with self._lock:
+            self._expire()
+            idle = self.pool.get(uuid)
+            if idle:
+                remote, _ = idle.pop()
+                return remote
+            return None
+
+    def checkin(self, uuid, remote):
+        """
+        Returns a prepared remote to the pool.
+        """
+        with self._lock:
+            self.pool.setdefault(uuid, []).append((remote, time.monotonic()))
+
+    def serve(self):
+        """
+        Accepts sessions until the server has been idle for `idle_timeout` seconds
+        or shutdown() is called.
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(umask)
+        server.listen()
+        server.settimeout(max(0.01, min(0.25, self.idle_timeout)))
+        try:
+            while not self._stopped.is_set():
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    with self._lock:
+                        self._expire()
+                        idle = time.monotonic() - self._last_activity
+                        if not self.connections and idle > self.idle_timeout:
+                            break
+                    continue
+                with self._lock:
+                    self.connections += 1
+                threading.Thread(
+                    target=self._session, args=(conn,), daemon=True
+                ).start()
+        finally:
+            server.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def spawn(self):
+        """
+        Runs serve() in a detached child process.
+        """
+        if os.fork():
+            return
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        try:
+            self.serve()
+        finally:
+            os._exit(0)
+
+    def shutdown(self):
+        self._stopped.set()
+
+    def _session(self, conn):
+        try:
+            with conn, conn.makefile("r") as rfile, conn.makefile("w") as wfile:
+                master = Master(wfile)
+                master.LinkRemote(self.factory(master))
+                master.protocol = _DaemonProtocol(master.remote, self)
+                try:
+                    master.Listen(rfile)
+                except SystemExit:
+                    # a failed session leaves the remote in an unknown state
+                    return
+                if master.protocol.uuid is not None:
+                    self.checkin(master.protocol.uuid, master.remote)
+        finally:
+            with self._lock:
+                self.connections -= 1
+                self._last_activity = time.monotonic()
+
+    def _expire(self):
+        deadline = time.monotonic() - self.idle_timeout
+        for uuid in list(self.pool):
+            self.pool[uuid] = [
+                (remote, used) for remote, used in self.pool[uuid] if used > deadline
+            ]
+            if not self.pool[uuid]:
+                del self.pool[uuid]
+
+
+class RemoteShim(object):
+    """
+    Relays a git-annex session to a RemoteServer.
+
+    Local file names in TRANSFER and TRANSFEREXPORT requests and the reply to
+    GETGITDIR are made absolute, as the server runs in another directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.cwd = os.getcwd()
+        self._gitdir_queries = set()
+
+    def connect(self):
+        """
+        Raises
+        ------
+        OSError
+            If no server is listening on the socket.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def relay(self, input=sys.stdin, output=sys.stdout, sock=None):
+        """
+        Relays `input` to the server and its replies to `output` until the server
+        closes the connection.
+        """
+        if sock is None:
+            sock = self.connect()
+        with sock, sock.makefile("r") as rfile, sock.makefile("w") as wfile:
+
+            def forward():
+                try:
+                    while True:
+                        line = input.readline()
+                        if not line:
+                            break
+                        wfile.write(self.rewrite_request(line.rstrip("\n")) + "\n")
+                        wfile.flush()
+                    sock.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+
+            threading.Thread(target=forward, daemon=True).start()
+            for line in rfile:
+                job, message = _splitjob(line.rstrip("\n"))
+                if message == "GETGITDIR":
+                    self._gitdir_queries.add(job)
+                output.write(line)
+                output.flush()
+
+    def rewrite_request(self, line):
+        job, message = _splitjob(line)
+        parts = message.split(" ", 3)
+        if parts[0] in ("TRANSFER", "TRANSFEREXPORT") and len(parts) == 4:
+            parts[3] = os.path.join(self.cwd, parts[3])
+        elif parts[0] == "VALUE" and job in self._gitdir_queries:
+            self._gitdir_queries.discard(job)
+            parts = ["VALUE", os.path.join(self.cwd, message[len("VALUE ") :])]
+        else:
+            return line
+        message = " ".join(parts)
+        return message if job is None else "J {} {}".format(job, message)
+
+
+def daemon_main(factory, path=None, idle_timeout=300):
+    """
+    Runs a remote through a RemoteServer shared across git-annex invocations.
+
+    Relays the session to the server listening on `path`, starting it first if
+    necessary. Falls back to running the remote in this process if Unix sockets
+    or fork() are not available.
+
+    Example:
+        if __name__ == "__main__":
+            daemon_main(MyRemote)
+
+    Parameters
+    ----------
+    factory : callable
+        Creates a new remote for a Master, usually the remote class itself.
+    path : str
+        Path of the Unix socket. Defaults to a file named after the program
+        in a directory only accessible by the current user.
+    idle_timeout : float
+        Seconds after which unused remotes are dropped and an idle server exits.
+    """
+    if not (hasattr(socket, "AF_UNIX") and hasattr(os, "fork")):
+        master = Master()
+        master.LinkRemote(factory(master))
+        master.Listen()
+        return
+
+    if path is None:
+        directory = os.path.join(
+            os.environ.get("XDG_RUNTIME_DIR") or "/tmp",
+            "annexremote-{}".format(os.getuid()),
+        )
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        path = os.path.join(directory, os.path.basename(sys.argv[0]) + ".sock")
+
+    shim = RemoteShim(path)
+    try:
+        sock = shim.connect()
+    except OSError:
+        RemoteServer(factory, path, idle_timeout).spawn()
+        for _ in range(100):
+            time.sleep(0.05)
+            try:
+                sock = shim.connect()
+                break
+            except OSError as e:
+                error = e
+        else:
+            raise error
+    shim.relay(sock=sock)
+
+
+class TokenCache(object):
+    """
+    Caches session tokens derived from credentials on disk, so that a login done
+    in prepare() can be reused by the following git-annex commands.
+
+    The tokens are stored in `<gitdir>/annex/annexremote/tokens/<uuid>.json`, only
+    readable by the current user, and shared by all processes of the remote.
+    A token that is about to expire is refreshed in a background thread while
+    the old one is still handed out.
+
+    Example:
+        def prepare(self):
+            self.tokens = TokenCache(self.annex)
+            self.token = self.tokens.get("api", self._login)
+
+        def _login(self):
+            creds = self.annex.getcreds("mycreds")
+            response = ...  # authenticate with creds['user'] and creds['password']
+            return response.token, response.expires_in
+
+    ...
+
+    Attributes
+    ----------
+    annex : Master
+        The Master used to look up the git directory and the UUID of the remote.
+    refresh_margin : float
+        Tokens expiring within this many seconds are refreshed in the background.
+    directory : str
+        Where the tokens are stored. Defaults to a directory inside the git directory.
+    """
+
+    def __init__(self, annex, refresh_margin=60, directory=None):
+        self.annex = annex
+        self.refresh_margin = refresh_margin
+        self.directory = directory
+        self._path = None
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, name, login, fingerprint=None):
+        """
+        Returns the cached token `name` or gets a new one with login().
+
+        Parameters
         ----------
-        dict of str : str
-            A dict containing username of password in the form:
-            {'user': "username", 'password': "password"}
-            If there are no credentials found, both 'user' and 'password' are empty.
-            Note: In version 2.0, a named tuple will be used instead of a dict.
+        name : str
+            Identifies the token, as a remote may need several of them.
+        login : callable
+            Called without arguments to get a new token. Must return a tuple
+            (token, lifetime) where token can be anything JSON can encode and
+            lifetime is the number of seconds the token stays valid.
+            Should raise RemoteError if the login failed.
+        fingerprint : str
+            If given, a cached token is only used if it was stored with the same
+            fingerprint, eg. a hash of the credentials it was derived from.
+
+        Returns
+        -------
+        The token.
+
+        Raises
+        ------
+        RemoteError
+            If login() failed.
+        """
+        path = self.path()
+        entry = self._read(path).get(name)
+        now = time.time()
+        if (
+            entry is None
+            or entry["expires"] <= now
+            or entry.get("fingerprint") != fingerprint
+        ):
+            return self._login(path, name, login, fingerprint)
+        if entry["expires"] - now < self.refresh_margin:
+            self._refresh(path, name, login, fingerprint)
+        return entry["token"]
+
+    def invalidate(self, name):
+        """
+        Removes the token `name`, eg. because the server rejected it.
+        """
+        path = self.path()
+        with self._locked(path):
+            tokens = self._read(path)
+            if tokens.pop(name, None) is not None:
+                self._write(path, tokens)
+
+    def path(self):
+        if self._path is None:
+            directory = self.directory
+            if directory is None:
+                directory = os.path.join(
+                    os.path.abspath(self.annex.getgitdir()),
+                    "annex",
+                    "annexremote",
+                    "tokens",
+                )
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            self._path = os.path.join(directory, "{}.json".format(self.annex.getuuid()))
+        return self._path
+
+    def _login(self, path, name, login, fingerprint):
+        token, lifetime = login()
+        with self._locked(path):
+            tokens = self._read(path)
+            tokens[name] = {
+                "token": token,
+                "expires": time.time() + lifetime,
+                "fingerprint": fingerprint,
+            }
+            self._write(path, tokens)
+        return token
+
+    def _refresh(self, path, name, login, fingerprint):
+        with self._lock:
+            if name in self._refreshing:
+                return
+            self._refreshing.add(name)
+
+        def refresh():
+            try:
+                self._login(path, name, login, fingerprint)
+            except Exception:
+                # the token is still valid; the next get() logs in again if needed
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing.discard(name)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def _locked(self, path):
+        return _FileLock(path + ".lock")
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write(path, tokens):
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(tokens, f)
+        os.replace(tmp, path)
+
+
+class CostEstimator(object):
+    """
+    Keeps a rolling estimate of the latency and throughput of a remote, measured
+    from real requests, and maps it onto git-annex's cost scale. This lets git-annex
+    prefer the faster of several remotes holding the same content.
+
+    The latency is measured from CHECKPRESENT requests, the throughput from
+    transfers. The estimate is stored in `<gitdir>/annex/annexremote/costs/<uuid>.json`
+    and shared by all processes of the remote, so it survives the short-lived
+    processes git-annex starts.
+
+    Example:
+        def __init__(self, annex):
+            super().__init__(annex)
+            self.cost_estimator = CostEstimator(annex)
+
+    ...
+
+    Attributes
+    ----------
+    annex : Master
+        The Master used to look up the git directory and the UUID of the remote.
+    min_cost : int
+        The cost of an infinitely fast remote. Defaults to cheapRemoteCost.
+    max_cost : int
+        The highest cost reported. Defaults to veryExpensiveRemoteCost.
+    default_cost : int
+        The cost reported as long as nothing has been measured. Defaults to expensiveRemoteCost.
+    reference_size : int
+        The cost is based on the time needed to transfer this many bytes.
+    cost_per_second : float
+        How much the cost rises per second needed for the reference transfer.
+    smoothing : float
+        The weight of a new measurement in the rolling estimate, between 0 and 1.
+    flush_interval : float
+        Latency measurements are written to disk at most this often, in seconds.
+        Transfers are written immediately.
+    directory : str
+        Where the estimate is stored. Defaults to a directory inside the git directory.
+    """
 
-        Raises
-        ----------
-        UnexpectedMessage
-            If git-annex does not respond correctly to this request, which is very unlikely.
+    def __init__(
+        self,
+        annex,
+        min_cost=100,
+        max_cost=1000,
+        default_cost=200,
+        reference_size=10 * 1024 * 1024,
+        cost_per_second=10,
+        smoothing=0.2,
+        flush_interval=10,
+        directory=None,
+    ):
+        if not min_cost <= default_cost <= max_cost:
+            raise ValueError("Expected min_cost <= default_cost <= max_cost")
+        self.annex = annex
+        self.min_cost = min_cost
+        self.max_cost = max_cost
+        self.default_cost = default_cost
+        self.reference_size = reference_size
+        self.cost_per_second = cost_per_second
+        self.smoothing = smoothing
+        self.flush_interval = flush_interval
+        self.directory = directory
+        self._path = None
+        self._estimate = None
+        self._pending = []
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record_latency(self, seconds):
         """
-        (user, password) = self._ask(
-            "GETCREDS {setting}".format(setting=setting), "CREDS", 2
-        )
-        # TODO: (v2.0) use namedtuple instead of dict
-        return {"user": user, "password": password}
+        Records the duration of a request which hardly transferred any data.
+        """
+        self._record("latency", seconds, time.monotonic() - self._flushed)
 
-    def getuuid(self):
+    def record_transfer(self, size, seconds):
         """
-        Queries for the UUID of the special remote being used.
+        Records a transfer of `size` bytes which took `seconds`.
+        Transfers of unknown or zero size are ignored.
+        """
+        if size and seconds > 0:
+            self._record("throughput", size / seconds, None)
 
+    def estimate(self):
+        """
         Returns
-        ----------
-        str
-            The UUID of the special remote
-
+        -------
+        dict
+            The estimate in the form of {'latency': seconds, 'throughput': bytes per second}.
+            Values which haven't been measured yet are missing.
         """
-        return self._askvalue("GETUUID")
-
-    def getgitdir(self):
+        with self._lock:
+            if self._estimate is None:
+                self._estimate = TokenCache._read(self.path())
+            estimate = dict(self._estimate)
+            for name, value in self._pending:
+                self._update(estimate, name, value)
+            return estimate
+
+    def cost(self):
         """
-        Queries for the path to the git directory of the repository that
-        is using the external special remote.
-
         Returns
-        ----------
-        str
-            The (relative) path to the git directory
+        -------
+        int
+            The estimated seconds needed to transfer `reference_size` bytes,
+            mapped onto the range from `min_cost` to `max_cost`.
         """
+        estimate = self.estimate()
+        if "throughput" not in estimate:
+            return self.default_cost
+        seconds = (
+            estimate.get("latency", 0) + self.reference_size / estimate["throughput"]
+        )
+        cost = self.min_cost + seconds * self.cost_per_second
+        return int(min(self.max_cost, max(self.min_cost, cost)))
 
-        return self._askvalue("GETGITDIR")
-
-    def setwanted(self, prefcontent):
+    def flush(self):
         """
-        Can be used to set the preferred content of a repository. Normally
-        this is not configured by a special remote, but it may make sense
-        in some situations to hint at the kind of content that should be
-        stored in the special remote.
-        Note that if an unparsable expression is set, git-annex will ignore it.
-
-        Parameters
-        ----------
-        prefcontent : str
-            The PreferredContentExpression,
-            see https://git-annex.branchable.com/git-annex-preferred-content/
+        Merges the measurements of this process into the stored estimate.
         """
-        self._send("SETWANTED", prefcontent)
+        with self._lock:
+            self._flush()
+
+    def path(self):
+        if self._path is None:
+            directory = self.directory
+            if directory is None:
+                directory = os.path.join(
+                    os.path.abspath(self.annex.getgitdir()),
+                    "annex",
+                    "annexremote",
+                    "costs",
+                )
+            os.makedirs(directory, exist_ok=True)
+            self._path = os.path.join(directory, "{}.json".format(self.annex.getuuid()))
+        return self._path
+
+    def _record(self, name, value, since_flush):
+        with self._lock:
+            self._pending.append((name, value))
+            if since_flush is None or since_flush >= self.flush_interval:
+                self._flush()
+
+    def _flush(self):
+        path = self.path()
+        with _FileLock(path + ".lock"):
+            # other processes may have updated the estimate in the meantime
+            estimate = TokenCache._read(path)
+            for name, value in self._pending:
+                self._update(estimate, name, value)
+            TokenCache._write(path, estimate)
+        self._estimate = estimate
+        self._pending = []
+        self._flushed = time.monotonic()
+
+    def _update(self, estimate, name, value):
+        if name in estimate:
+            estimate[name] += (value - estimate[name]) * self.smoothing
+        else:
+            estimate[name] = value
 
-    def getwanted(self):
-        """
-        Gets the current preferred content setting of the repository.
 
-        Returns
-        ----------
-        str
-            The PreferredContentExpression,
-            see https://git-annex.branchable.com/git-annex-preferred-content/
+class ContentCache(object):
+    """
+    A local cache of key contents shared by all repositories and processes on a
+    machine, eg. for CI jobs that retrieve the same keys over and over again.
 
-        Raises
-        ----------
-        UnexpectedMessage
-            If git-annex does not respond correctly to this request, which is very unlikely.
+    Set it as `content_cache` of a remote to have TRANSFER RETRIEVE requests served
+    from the cache if possible. Otherwise transfer_retrieve() is called and the
+    retrieved file is added to the cache.
+
+    Files are served by reflink where the filesystem supports it, otherwise by
+    hardlink (if enabled) or by copying. They are added to the cache atomically
+    under a temporary name, so other processes never see partial files. If the
+    cache grows beyond `max_size`, the least recently used files are removed.
+
+    ...
+
+    Attributes
+    ----------
+    directory : str
+        Where the cached files are stored.
+    max_size : int
+        The maximum total size of the cached files in bytes.
+    verify : bool
+        If True, the content of keys of a hashing backend (eg. SHA256E) is checked
+        against the hash before it is served. Corrupted files are removed.
+    hardlink : bool
+        If True, files are served by hardlink if they can't be reflinked.
+        Note that the served file then shares its inode with the cached one.
+    """
+
+    HASHES = {
+        "MD5": "md5",
+        "SHA1": "sha1",
+        "SHA224": "sha224",
+        "SHA256": "sha256",
+        "SHA384": "sha384",
+        "SHA512": "sha512",
+        "SHA3_224": "sha3_224",
+        "SHA3_256": "sha3_256",
+        "SHA3_384": "sha3_384",
+        "SHA3_512": "sha3_512",
+    }
+
+    # ioctl request cloning a file on Linux (btrfs, xfs, ...)
+    FICLONE = 0x40049409
+
+    def __init__(self, directory, max_size=10 * 1024**3, verify=False, hardlink=True):
+        self.directory = directory
+        self.max_size = max_size
+        self.verify = verify
+        self.hardlink = hardlink
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
         """
-        return self._askvalue("GETWANTED")
+        Returns the path of the cached content of `key`.
+        """
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.directory, name[:2], name)
 
-    def seturlpresent(self, key, url):
+    def retrieve(self, key, local_file, progress=None):
         """
-        Records a URL where the Key can be downloaded from.
-        Note that this does not make git-annex think that the url is present
-        on the web special remote.
-        Keep in mind that this stores the url in the git-annex branch. This
-        can result in bloat to the branch if the url is large and/or does not
-        delta pack well with other information (such as the names of keys)
-        already stored in the branch.
+        Puts the cached content of `key` at `local_file`.
 
         Parameters
         ----------
-        key : str
-            The key for which to record a URL
-        url : str
-            The URL from which the key can be downloaded
-        """
-        self._send("SETURLPRESENT", key, url)
+        progress : callable
+            If given, called with the size of the content on success, eg. Master.progress.
 
-    def seturlmissing(self, key, url):
+        Returns
+        -------
+        bool
+            False if the key is not cached (or its cached content is corrupted).
         """
-        Records that the key can no longer be downloaded from the specified URL.
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return False
+        try:
+            if self.verify and not self.check(key, path):
+                os.unlink(path)
+                return False
+            self._link(path, local_file)
+            # mark as recently used
+            os.utime(path)
+            size = os.path.getsize(local_file)
+        except OSError:
+            return False
+        if progress is not None:
+            progress(size)
+        return True
 
-        Parameters
-        ----------
-        key : str
-            The key for which to delete the URL
-        url : str
-            The URL which is no longer accessible
+    def store(self, key, local_file):
         """
-        self._send("SETURLMISSING", key, url)
+        Adds `local_file` to the cache as content of `key`. Errors are ignored,
+        as the cache is only an optimization.
+        """
+        path = self.path(key)
+        tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            if os.path.getsize(local_file) > self.max_size:
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._link(local_file, tmp)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+        self._evict()
 
-    def seturipresent(self, key, uri):
+    def check(self, key, path):
         """
-        Records a URI where the Key can be downloaded from.
-        For example, "ipfs:ADDRESS" is used for the ipfs special remote;
-        its CLAIMURL handler checks for such URIS and claims them.
+        Returns False if the file at `path` doesn't match the hash of `key`.
+        Keys of non-hashing backends (eg. WORM or URL) always match.
+        """
+        algorithm, digest = self.key_hash(key)
+        if algorithm is None:
+            return True
+        h = hashlib.new(algorithm)
+        with open(path, "rb") as f:
+            for data in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(data)
+        return h.hexdigest() == digest
+
+    @classmethod
+    def key_hash(cls, key):
+        """
+        Returns the hashlib name of the hash algorithm of `key` and the hash as a tuple,
+        or (None, None) if the backend of `key` is not a known hashing backend.
+        """
+        backend, _, rest = key.partition("-")
+        if backend not in cls.HASHES and backend.endswith("E"):
+            backend = backend[:-1]
+        if backend not in cls.HASHES or "--" not in rest:
+            return (None, None)
+        # the extension of *E backends follows the hash
+        digest = rest.split("--", 1)[1].split(".", 1)[0]
+        return (cls.HASHES[backend], digest.lower())
+
+    def _link(self, source, target):
+        try:
+            os.unlink(target)
+        except FileNotFoundError:
+            pass
+        if fcntl is not None:
+            try:
+                with open(source, "rb") as src, open(target, "wb") as dst:
+                    fcntl.ioctl(dst.fileno(), self.FICLONE, src.fileno())
+                return
+            except OSError:
+                os.unlink(target)
+        if self.hardlink:
+            try:
+                os.link(source, target)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(source, target)
+
+    def _evict(self):
+        with _FileLock(os.path.join(self.directory, ".lock")):
+            entries = []
+            total = 0
+            for subdirectory in os.scandir(self.directory):
+                if not subdirectory.is_dir():
+                    continue
+                for entry in os.scandir(subdirectory.path):
+                    if entry.name.endswith(".tmp"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                total -= size
+
+
+class WhereisCache(object):
+    """
+    Remembers the replies of whereis(), so that `git annex whereis` over many keys
+    doesn't ask the backend again for keys it asked about recently.
 
-        Parameters
-        ----------
-        key : str
-            The key for which to record a URI
-        uri : str
-            The URI from which the key can be downloaded
+    Set it as `whereis_cache` of a remote. The entry of a key is dropped when the
+    key is stored or removed by the same process, and replies are kept at most
+    `ttl` seconds, so changes made elsewhere show up eventually.
+
+    ...
+
+    Attributes
+    ----------
+    max_entries : int
+        The maximum number of keys remembered. The least recently used are dropped first.
+    ttl : float
+        The number of seconds a reply is remembered.
+    """
+
+    def __init__(self, max_entries=10000, ttl=300, clock=time.monotonic):
+        if max_entries < 1:
+            raise ValueError("Expected max_entries >= 1")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = collections.OrderedDict()
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, key, whereis):
         """
-        self._send("SETURIPRESENT", key, uri)
+        Returns the remembered reply for `key`, or calls `whereis(key)` and remembers its reply.
+        Exceptions raised by `whereis` are passed on and not remembered.
+        """
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+            epoch = self._epoch
+        reply = whereis(key)
+        with self._lock:
+            # don't remember a reply which might be outdated by a store or remove
+            # which happened while it was computed
+            if epoch == self._epoch:
+                self._entries[key] = (now + self.ttl, reply)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return reply
 
-    def seturimissing(self, key, uri):
+    def invalidate(self, key):
         """
-        Records that the key can no longer be downloaded from the specified URI.
+        Forgets the reply for `key`.
+        """
+        with self._lock:
+            self._epoch += 1
+            self._entries.pop(key, None)
 
-        Parameters
-        ----------
-        key : str
-            The key for which to delete the URI
-        uri : str
-            The URI which is no longer accessible
+    def clear(self):
         """
-        self._send("SETURIMISSING", key, uri)
+        Forgets all replies.
+        """
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
 
-    def geturls(self, key, prefix):
+
+class UrlClaims(object):
+    """
+    The urls a remote claims, compiled into a single regular expression so that
+    CLAIMURL requests are answered without calling into the remote.
+
+    Set it as `url_claims` of a remote. Urls it doesn't match are passed on to
+    claimurl(); if the remote doesn't implement it, they aren't claimed.
+
+    ...
+
+    Attributes
+    ----------
+    prefixes : tuple of str
+        Urls starting with one of these are claimed, eg. "https://example.com/".
+    schemes : tuple of str
+        Urls of one of these schemes are claimed, eg. "s3". Compared case-insensitively.
+    patterns : tuple of str
+        Urls matching one of these regular expressions (from the start of the url,
+        like re.match) are claimed.
+    """
+
+    def __init__(self, prefixes=(), schemes=(), patterns=()):
+        self.prefixes = tuple(prefixes)
+        self.schemes = tuple(schemes)
+        self.patterns = tuple(patterns)
+        alternatives = [re.escape(prefix) for prefix in self.prefixes]
+        if self.schemes:
+            alternatives.append(
+                "(?i:{}):".format("|".join(re.escape(s) for s in self.schemes))
+            )
+        alternatives.extend("(?:{})".format(pattern) for pattern in self.patterns)
+        if alternatives:
+            self._regex = re.compile("|".join(alternatives))
+        else:
+            self._regex = None
+
+    def match(self, url):
         """
-        Gets the recorded URLs where a key can be downloaded from.
+        Returns True if `url` is claimed.
+        """
+        return self._regex is not None and self._regex.match(url) is not None
 
-        Parameters
-        ----------
-        key : str
-            The key for which to get the URLs
-        prefix : str
-            Only urls that start with the prefix will be returned.
-            The Prefix may be empty to get all urls.
 
-        Returns
-        ----------
-        list of str
-            The URLs from which the key can be downloaded
+class ExportManifest(object):
+    """
+    A local index of the files exported to a remote, in the form of
+    remote path -> (key, size, etag).
 
-        Raises
-        ----------
-        UnexpectedMessage
-            If git-annex does not respond correctly to this request, which is very unlikely.
+    If it is set as `export_manifest` of an ExportRemote, it is updated after each
+    successful TRANSFEREXPORT STORE, REMOVEEXPORT, RENAMEEXPORT and
+    REMOVEEXPORTDIRECTORY, and CHECKPRESENTEXPORT is answered from it. If a path
+    is missing from the manifest, the manifest is rebuilt once from the remote's
+    listexport(), if implemented; otherwise the remote is asked.
+
+    The manifest is an SQLite database stored in
+    `<gitdir>/annex/annexremote/exports/<uuid>.sqlite`, which is shared by all
+    processes of the remote.
+
+    Example:
+        def __init__(self, annex):
+            super().__init__(annex)
+            self.export_manifest = ExportManifest(annex)
+
+    ...
+
+    Attributes
+    ----------
+    annex : Master
+        The Master used to look up the git directory and the UUID of the remote.
+    directory : str
+        Where the manifest is stored. Defaults to a directory inside the git directory.
+    """
+
+    def __init__(self, annex, directory=None):
+        self.annex = annex
+        self.directory = directory
+        self._path = None
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def path(self):
+        if self._path is None:
+            directory = self.directory
+            if directory is None:
+                directory = os.path.join(
+                    os.path.abspath(self.annex.getgitdir()),
+                    "annex",
+                    "annexremote",
+                    "exports",
+                )
+            os.makedirs(directory, exist_ok=True)
+            self._path = os.path.join(
+                directory, "{}.sqlite".format(self.annex.getuuid())
+            )
+        return self._path
+
+    def get(self, remote_file):
         """
-        return self._askvalues("GETURLS {key} {prefix}".format(key=key, prefix=prefix))
+        Returns the tuple (key, size, etag) exported to `remote_file`, or None.
+        The key is None for files added by rebuild().
+        """
+        rows = self._query(
+            "SELECT key, size, etag FROM files WHERE path = ?", (remote_file,)
+        )
+        return rows[0] if rows else None
 
-    def info(self, message):
+    def find(self, key):
         """
-        Tells git-annex to display the message to the user.
-        When git-annex is in --json mode, the message will be emitted immediately
-        in its own json object, with an "info" field.
+        Returns the list of paths `key` is exported to.
+        """
+        rows = self._query("SELECT path FROM files WHERE key = ?", (key,))
+        return [row[0] for row in rows]
 
-        Important: This is a protocol extension and may raise a ProtocolError if
-        the particular version of git-annex does not support it. Remotes using info()
-        should always prepare to handle the exception.
+    def listdirectory(self, remote_directory):
+        """
+        Returns the list of (path, key) of all files below `remote_directory`.
+        """
+        prefix = remote_directory.rstrip("/") + "/"
+        return self._query(
+            "SELECT path, key FROM files WHERE substr(path, 1, ?) = ?",
+            (len(prefix), prefix),
+        )
 
-        Parameters
-        ----------
-        message : str
-            The message to be displayed to the user
+    def add(self, remote_file, key, size=None, etag=None):
+        self._execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            (remote_file, key, size, etag),
+        )
 
-        Raises
-        ----------
-        ProtocolError
-            If INFO is not available in this version of git-annex.
+    def remove(self, remote_file):
+        self._execute("DELETE FROM files WHERE path = ?", (remote_file,))
+
+    def rename(self, remote_file, new_remote_file):
+        self._execute(
+            "UPDATE OR REPLACE files SET path = ? WHERE path = ?",
+            (new_remote_file, remote_file),
+        )
+
+    def removedirectory(self, remote_directory):
+        prefix = remote_directory.rstrip("/") + "/"
+        self._execute(
+            "DELETE FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)
+        )
+
+    def rebuild(self, files):
         """
-        if "INFO" in self.protocol.extensions:
-            self._send("INFO", message)
-        else:
-            raise ProtocolError("INFO not available")
+        Replaces the manifest with `files`, an iterable of (path, size, etag)
+        as returned by ExportRemote.listexport(). Keys already known for a path
+        of the same size are kept.
+        """
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute("CREATE TEMP TABLE listing (path, size, etag)")
+                try:
+                    connection.executemany(
+                        "INSERT INTO listing VALUES (?, ?, ?)", files
+                    )
+                    connection.execute(
+                        "DELETE FROM files WHERE path NOT IN (SELECT path FROM listing)"
+                    )
+                    connection.execute(
+                        "INSERT OR REPLACE INTO files "
+                        "SELECT l.path, CASE WHEN f.size IS l.size THEN f.key END, l.size, l.etag "
+                        "FROM listing l LEFT JOIN files f ON f.path = l.path"
+                    )
+                    connection.execute(
+                        "INSERT OR REPLACE INTO meta VALUES ('complete', 1)"
+                    )
+                finally:
+                    connection.execute("DROP TABLE listing")
+
+    @property
+    def complete(self):
+        """
+        True once the manifest has been rebuilt from a listing of the remote,
+        so that paths missing from it are known to be missing on the remote.
+        """
+        return bool(self._query("SELECT value FROM meta WHERE name = 'complete'"))
 
-    def getgitremotename(self):
+    def checkpresent(self, key, remote_file):
         """
-        Gets the name of the git remote that represents this special remote.
-        This can be used, for example, to look up git configuration belonging to that
-        git remote. This name will often be the same as what is passed to git-annex
-        initremote and enableremote, but it is possible for git remotes to be renamed,
-        and this will provide the remote's current name.
+        Returns True or False if the manifest knows whether `key` is exported
+        to `remote_file`, otherwise None.
+        """
+        entry = self.get(remote_file)
+        if entry is None:
+            return False if self.complete else None
+        exported_key, size, etag = entry
+        if exported_key is not None:
+            return exported_key == key
+        expected_size = _keysize(key)
+        if size is not None and expected_size is not None:
+            return size == expected_size
+        return None
+
+    def _connect(self):
+        if self._connection is None:
+            connection = sqlite3.connect(
+                self.path(), timeout=60, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS files "
+                    "(path TEXT PRIMARY KEY, key TEXT, size INTEGER, etag TEXT)"
+                )
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS files_key ON files (key)"
+                )
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)"
+                )
+            self._connection = connection
+        return self._connection
 
-        Important: This is a protocol extension and may raise a ProtocolError if
-        the particular version of git-annex does not support it. Remotes using
-        getgetremotename() should always prepare to handle the exception.
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._connect().execute(sql, parameters).fetchall()
 
-        Returns
-        ----------
-        str
-            The name of the git remote that represents this special remote
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(sql, parameters)
 
-        Raises
-        ----------
-        ProtocolError
-            If GETGITREMOTENAME is not available in this version of git-annex.
-        """
-        if "GETGITREMOTENAME" in self.protocol.extensions:
-            return self._askvalue("GETGITREMOTENAME")
-        else:
-            raise ProtocolError("GETGITREMOTENAME not available")
 
-    def _send(self, *args, **kwargs):
-        print(*args, file=self.output, **kwargs)
-        self.output.flush()
+class _FileLock(object):
+    """
+    Exclusive lock on a file, shared between processes where fcntl is available.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+
+import io
+import threading
+import unittest
+
+import utils
+
+RemoteError = utils.annexremote.RemoteError
+JobScheduler = utils.annexremote.JobScheduler
+ConcurrencyController = utils.annexremote.ConcurrencyController
+ExportDirectories = utils.annexremote.ExportDirectories
+
+
+class TestAsyncJobs(utils.GitAnnexTestCase):
+    def setUp(self):
+        super().setUp()
+        self.annex.EnableJobs()
+
+    def test_ExtensionsAsync(self):
+        self.annex.Listen(io.StringIO("EXTENSIONS INFO ASYNC"))
+        self.assertEqual(utils.second_buffer_line(self.output), "EXTENSIONS ASYNC")
+
+    def test_ExtensionsWithoutAsync(self):
+        self.annex.Listen(io.StringIO("EXTENSIONS INFO"))
+        self.assertEqual(utils.second_buffer_line(self.output), "EXTENSIONS")
+
+    def test_JobReply(self):
+        self.remote.checkpresent.return_value = True
+        self.annex.Listen(io.StringIO("J 1 CHECKPRESENT Key"))
+        self.remote.checkpresent.assert_called_once_with("Key")
+        self.assertEqual(
+            utils.second_buffer_line(self.output), "J 1 CHECKPRESENT-SUCCESS Key"
+        )
+
+    def test_JobMultilineReply(self):
+        self.remote.info = {"Name": "Value"}
+        self.annex.Listen(io.StringIO("J 3 GETINFO"))
+        self.assertEqual(
+            utils.buffer_lines(self.output)[1:],
+            ["J 3 INFOFIELD Name", "J 3 INFOVALUE Value", "J 3 INFOEND"],
+        )
+
+    def test_JobQuery(self):
+        def transfer_store(key, file_):
+            self.annex.progress(1024)
+            if self.annex.getconfig("directory") != "/foo":
+                raise RemoteError("wrong directory")
+
+        self.remote.transfer_store.side_effect = transfer_store
+        self.annex.Listen(io.StringIO("J 1 TRANSFER STORE Key File\nJ 1 VALUE /foo\n"))
+        self.assertEqual(
+            utils.buffer_lines(self.output)[1:],
+            [
+                "J 1 PROGRESS 1024",
+                "J 1 GETCONFIG directory",
+                "J 1 TRANSFER-SUCCESS STORE Key",
+            ],
+        )
+
+    def test_JobQueryStopEarly(self):
+        def transfer_retrieve(key, file_):
+            urls = self.annex.geturls_iter(key, "Prefix")
+            if next(urls) != "Url1":
+                raise RemoteError("wrong url")
+            urls.close()
+            if self.annex.getconfig("directory") != "/foo":
+                raise RemoteError("wrong directory")
+
+        self.remote.transfer_retrieve.side_effect = transfer_retrieve
+        self.annex.Listen(
+            io.StringIO(
+                "J 1 TRANSFER RETRIEVE Key File\nJ 1 VALUE Url1\nJ 1 VALUE Url2\n"
+                "J 1 VALUE\nJ 1 VALUE /foo\n"
+            )
+        )
+        self.assertEqual(
+            utils.buffer_lines(self.output)[1:],
+            [
+                "J 1 GETURLS Key Prefix",
+                "J 1 GETCONFIG directory",
+                "J 1 TRANSFER-SUCCESS RETRIEVE Key",
+            ],
+        )
+
+    def test_MetadataNotBlockedByTransfer(self):
+        transfer_started = threading.Event()
+        checkpresent_done = threading.Event()
+
+        def transfer_store(key, file_):
+            transfer_started.set()
+            if not checkpresent_done.wait(5):
+                raise RemoteError("CHECKPRESENT was blocked")
+
+        def checkpresent(key):
+            transfer_started.wait(5)
+            checkpresent_done.set()
+            return True
+
+        self.remote.transfer_store.side_effect = transfer_store
+        self.remote.checkpresent.side_effect = checkpresent
+        self.annex.Listen(
+            io.StringIO("J 1 TRANSFER STORE Key1 File\nJ 2 CHECKPRESENT Key2\n")
+        )
+        self.assertEqual(
+            utils.buffer_lines(self.output)[1:],
+            ["J 2 CHECKPRESENT-SUCCESS Key2", "J 1 TRANSFER-SUCCESS STORE Key1"],
+        )
+
+    def test_JobExport(self):
+        self.annex.Listen(
+            io.StringIO(
+                "J 1 EXPORT Name\nJ 1 TRANSFEREXPORT STORE Key File\n"
+                "J 2 EXPORT Other\nJ 2 CHECKPRESENTEXPORT Key\n"
+            )
+        )
+        self.remote.transferexport_store.assert_called_once_with("Key", "File", "Name")
+        self.remote.checkpresentexport.assert_called_once_with("Key", "Other")
+        lines = utils.buffer_lines(self.output)[1:]
+        self.assertIn("J 1 TRANSFER-SUCCESS STORE Key", lines)
+        self.assertIn("J 2 CHECKPRESENT-FAILURE Key", lines)
+
+    def test_JobExportWhileBusy(self):
+        exported = []
+        self.remote.transferexport_store.side_effect = (
+            lambda key, file_, name: exported.append(name)
+        )
+        self.annex.Listen(
+            io.StringIO(
+                "J 1 EXPORT Name1\nJ 1 TRANSFEREXPORT STORE Key1 File\n"
+                "J 1 EXPORT Name2\nJ 1 TRANSFEREXPORT STORE Key2 File\n"
+            )
+        )
+        self.assertEqual(exported, ["Name1", "Name2"])
+        self.assertEqual(
+            utils.buffer_lines(self.output)[1:],
+            ["J 1 TRANSFER-SUCCESS STORE Key1", "J 1 TRANSFER-SUCCESS STORE Key2"],
+        )
+
+    def test_JobExportsInParallel(self):
+        started = threading.Barrier(2, timeout=5)
+        names = []
+
+        def transferexport_store(key, file_, name):
+            # both jobs must be running at once to pass the barrier
+            started.wait()
+            names.append(name)
+
+        self.remote.transferexport_store.side_effect = transferexport_store
+        self.annex.Listen(
+            io.StringIO(
+                "J 1 EXPORT Name1\nJ 1 TRANSFEREXPORT STORE Key1 File\n"
+                "J 2 EXPORT Name2\nJ 2 TRANSFEREXPORT STORE Key2 File\n"
+            )
+        )
+        self.assertEqual(sorted(names), ["Name1", "Name2"])
+        self.assertEqual(
+            sorted(utils.buffer_lines(self.output)[1:]),
+            ["J 1 TRANSFER-SUCCESS STORE Key1", "J 2 TRANSFER-SUCCESS STORE Key2"],
+        )
+
+    def test_JobError(self):
+        self.remote.checkpresent.side_effect = ValueError("Broken")
+        with self.assertRaises(SystemExit):
+            self.annex.Listen(io.StringIO("J 1 CHECKPRESENT Key"))
+        self.assertEqual(utils.last_buffer_line(self.output), "J 1 ERROR Broken")
+
+
+class TestJobScheduler(unittest.TestCase):
+    def test_Classify(self):
+        scheduler = JobScheduler(small_transfer_size=1000)
+        self.assertEqual(scheduler.classify("CHECKPRESENT Key"), "metadata")
+        self.assertEqual(scheduler.classify("REMOVE Key"), "metadata")
+        self.assertEqual(scheduler.classify("PREPARE"), "control")
+        self.assertEqual(
+            scheduler.classify("TRANSFEREXPORT STORE SHA256E-s10--abc File"),
+            "small_transfer",
+        )
+        self.assertEqual(scheduler.classify("CHECKPRESENTEXPORT Key"), "metadata")
+        self.assertEqual(scheduler.classify("RENAMEEXPORT Key New"), "export")
+        self.assertEqual(
+            scheduler.classify("TRANSFER STORE SHA256E-s1000--abc.txt File"),
+            "small_transfer",
+        )
+        self.assertEqual(
+            scheduler.classify("TRANSFER RETRIEVE SHA256E-s1001--abc.txt File"),
+            "transfer",
+        )
+        self.assertEqual(
+            scheduler.classify("TRANSFER STORE WORM-m123--abc File"), "transfer"
+        )
+
+    def test_InvalidWorkerCount(self):
+        with self.assertRaises(ValueError):
+            JobScheduler(lanes={"transfer": 0})
+
+    def test_MetricsWithoutController(self):
+        scheduler = JobScheduler(lanes={"transfer": 3})
+        self.assertEqual(scheduler.metrics()["transfer"], {"limit": 3, "maximum": 3})
+
+    def test_AdaptiveMetrics(self):
+        scheduler = JobScheduler(lanes={"transfer": 3}, adaptive=True)
+        self.assertEqual(scheduler.metrics()["transfer"]["limit"], 1)
+        self.assertEqual(scheduler.metrics()["transfer"]["maximum"], 3)
+
+    def test_RequestSize(self):
+        scheduler = JobScheduler()
+        self.assertEqual(
+            scheduler.request_size("TRANSFER STORE SHA256E-s1000--abc File"), 1000
+        )
+        self.assertIsNone(scheduler.request_size("TRANSFER STORE WORM--abc File"))
+        self.assertIsNone(scheduler.request_size("CHECKPRESENT SHA256E-s1000--abc"))
+
+    def test_TransferLanesPerByte(self):
+        scheduler = JobScheduler(adaptive=True)
+        self.assertTrue(scheduler.controllers["transfer"].per_byte)
+        self.assertFalse(scheduler.controllers["metadata"].per_byte)
+
+    def test_IsFailure(self):
+        scheduler = JobScheduler()
+        self.assertTrue(scheduler.is_failure("TRANSFER-FAILURE STORE Key Error"))
+        self.assertTrue(scheduler.is_failure("CHECKPRESENT-UNKNOWN Key Error"))
+        self.assertTrue(scheduler.is_failure("CHECKURL-FAILURE Error"))
+        self.assertTrue(scheduler.is_failure("WHEREIS-FAILURE"))
+        self.assertFalse(scheduler.is_failure("CHECKPRESENT-FAILURE Key"))
+        self.assertFalse(scheduler.is_failure(None))
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestConcurrencyController(unittest.TestCase):
+    def _run(self, controller, count, latency=0.01, failed=False, size=None):
+        tokens = [controller.acquire() for _ in range(count)]
+        for token in tokens:
+            controller.release(token, latency, failed, size)
+
+    def test_AdditiveIncrease(self):
+        clock = FakeClock()
+        controller = ConcurrencyController(4, clock=clock)
+        clock.now += 1
+        self._run(controller, 1)
+        self.assertEqual(controller.metrics()["limit"], 2)
+        clock.now += 1
+        self._run(controller, 2)
+        self.assertEqual(controller.metrics()["limit"], 3)
+
+    def test_NoIncreaseWhenThroughputDrops(self):
+        clock = FakeClock()
+        controller = ConcurrencyController(4, clock=clock)
+        clock.now += 1
+        self._run(controller, 1)
+        self.assertEqual(controller.metrics()["limit"], 2)
+        # two requests in ten seconds are less than one per second before
+        clock.now += 10
+        self._run(controller, 2)
+        self.assertEqual(controller.metrics()["limit"], 2)
+        clock.now += 1
+        self._run(controller, 2)
+        self.assertEqual(controller.metrics()["limit"], 3)
+
+    def test_IncreaseBoundedByMaximum(self):
+        controller = ConcurrencyController(2)
+        for _ in range(5):
+            self._run(controller, int(controller.limit))
+        self.assertEqual(controller.metrics()["limit"], 2)
+
+    def test_NoIncreaseWhenNotSaturated(self):
+        controller = ConcurrencyController(4, initial=2)
+        for _ in range(4):
+            self._run(controller, 1)
+        self.assertEqual(controller.metrics()["limit"], 2)
+
+    def test_MultiplicativeDecreaseOnError(self):
+        controller = ConcurrencyController(8, initial=8)
+        self._run(controller, 8, failed=True)
+        # only the first failure of the requests running at that time counts
+        self.assertEqual(controller.metrics()["limit"], 4)
+        self._run(controller, 4, failed=True)
+        self.assertEqual(controller.metrics()["limit"], 2)
+
+    def test_DecreaseBoundedByMinimum(self):
+        controller = ConcurrencyController(8, minimum=2, initial=2)
+        self._run(controller, 1, failed=True)
+        self.assertEqual(controller.metrics()["limit"], 2)
+
+    def test_DecreaseOnLatencySpike(self):
+        controller = ConcurrencyController(8, initial=4)
+        for _ in range(5):
+            self._run(controller, 1)
+        self._run(controller, 1, latency=1)
+        self.assertEqual(controller.metrics()["limit"], 2)
+        self.assertAlmostEqual(controller.metrics()["latency"], 0.01)
+
+    def test_PerByteMixedSizes(self):
+        controller = ConcurrencyController(8, initial=4, per_byte=True)
+        for _ in range(5):
+            self._run(controller, 1, latency=0.01, size=1024 * 1024)
+        # a thousand times the data in a thousand times the time is no spike
+        self._run(controller, 1, latency=10, size=1024 * 1024 * 1024)
+        self.assertEqual(controller.metrics()["limit"], 4)
+        # neither is a transfer of unknown size
+        self._run(controller, 1, latency=100)
+        self.assertEqual(controller.metrics()["limit"], 4)
+        self._run(controller, 1, latency=1, size=1024 * 1024)
+        self.assertEqual(controller.metrics()["limit"], 2)
+
+    def test_PerByteThroughput(self):
+        clock = FakeClock()
+        controller = ConcurrencyController(4, per_byte=True, clock=clock)
+        clock.now += 1
+        self._run(controller, 1, size=1000)
+        self.assertEqual(controller.metrics()["limit"], 2)
+        # more requests per second, but fewer bytes
+        clock.now += 1
+        self._run(controller, 2, size=100)
+        self.assertEqual(controller.metrics()["limit"], 2)
+
+    def test_InvalidBounds(self):
+        with self.assertRaises(ValueError):
+            ConcurrencyController(2, minimum=3)
+
+
+class TestExportDirectories(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.created = []
+        self.directories = ExportDirectories(self.created.append)
+
+    def test_Create(self):
+        self.directories.create("a/b/file1")
+        self.directories.create("a/b/file2")
+        self.directories.create("a/c/file")
+        self.directories.create("file")
+        self.assertEqual(self.created, ["a", "a/b", "a/c"])
+
+    def test_Forget(self):
+        self.directories.create("a/b/file")
+        self.directories.forget("a/b")
+        self.directories.create("a/b/c/file")
+        self.assertEqual(self.created, ["a", "a/b", "a/b", "a/b/c"])
+
+    def test_Concurrent(self):
+        release = threading.Event()
+
+        def mkdir(directory):
+            release.wait(5)
+            self.created.append(directory)
+
+        self.directories.mkdir = mkdir
+        threads = [
+            threading.Thread(target=self.directories.create, args=("dir/file",))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(self.created, ["dir"])
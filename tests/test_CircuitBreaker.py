@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import io
+import unittest
+
+import utils
+
+RemoteError = utils.annexremote.RemoteError
+CircuitBreaker = utils.annexremote.CircuitBreaker
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreakerProtocol(utils.GitAnnexTestCase):
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock()
+        self.remote.circuit_breaker = CircuitBreaker(
+            threshold=2, cooldown=30, clock=self.clock
+        )
+        self.remote.checkpresent.side_effect = RemoteError("timed out")
+
+    def _listen(self, *lines):
+        self.output.seek(0)
+        self.output.truncate()
+        self.annex.Listen(io.StringIO("\n".join(lines)))
+        return utils.buffer_lines(self.output)[1:]
+
+    def test_ExtensionsUnavailableResponse(self):
+        self.assertEqual(
+            self._listen("EXTENSIONS INFO UNAVAILABLERESPONSE"),
+            ["EXTENSIONS UNAVAILABLERESPONSE"],
+        )
+
+    def test_Open(self):
+        replies = self._listen(
+            "CHECKPRESENT Key1",
+            "CHECKPRESENT Key2",
+            "CHECKPRESENT Key3",
+            "TRANSFER STORE Key4 File",
+            "REMOVE Key5",
+        )
+        self.assertEqual(
+            replies,
+            [
+                "CHECKPRESENT-UNKNOWN Key1 timed out",
+                "CHECKPRESENT-UNKNOWN Key2 timed out",
+                "CHECKPRESENT-UNKNOWN Key3 Remote unavailable",
+                "TRANSFER-FAILURE STORE Key4 Remote unavailable",
+                "REMOVE-FAILURE Key5 Remote unavailable",
+            ],
+        )
+        self.assertEqual(self.remote.checkpresent.call_count, 2)
+        self.remote.transfer_store.assert_not_called()
+        self.remote.remove.assert_not_called()
+
+    def test_NotCountedRequests(self):
+        self.remote.checkpresent.side_effect = None
+        self.remote.checkpresent.return_value = False
+        self._listen("CHECKPRESENT Key1", "CHECKPRESENT Key2", "CHECKPRESENT Key3")
+        self.assertEqual(self.remote.checkpresent.call_count, 3)
+        self.assertFalse(self.remote.circuit_breaker.is_open)
+
+    def test_SuccessResets(self):
+        self.remote.checkpresent.side_effect = [RemoteError("timed out"), True] * 2
+        self._listen(*["CHECKPRESENT Key"] * 4)
+        self.assertEqual(self.remote.checkpresent.call_count, 4)
+
+    def test_Probe(self):
+        self._listen("CHECKPRESENT Key1", "CHECKPRESENT Key2")
+        self.clock.now = 30
+        self.assertEqual(
+            self._listen("CHECKPRESENT Key3", "CHECKPRESENT Key4"),
+            [
+                "CHECKPRESENT-UNKNOWN Key3 timed out",
+                "CHECKPRESENT-UNKNOWN Key4 Remote unavailable",
+            ],
+        )
+        self.clock.now = 60
+        self.remote.checkpresent.side_effect = None
+        self.remote.checkpresent.return_value = True
+        self.assertEqual(
+            self._listen("CHECKPRESENT Key5", "CHECKPRESENT Key6"),
+            ["CHECKPRESENT-SUCCESS Key5", "CHECKPRESENT-SUCCESS Key6"],
+        )
+
+    def test_GetavailabilityUnavailable(self):
+        self.remote.getavailability.return_value = "global"
+        self.assertEqual(
+            self._listen(
+                "EXTENSIONS UNAVAILABLERESPONSE",
+                "CHECKPRESENT Key1",
+                "CHECKPRESENT Key2",
+                "GETAVAILABILITY",
+            )[-1],
+            "AVAILABILITY UNAVAILABLE",
+        )
+        self.remote.getavailability.assert_not_called()
+
+    def test_GetavailabilityWithoutExtension(self):
+        self.remote.getavailability.return_value = "global"
+        replies = self._listen(
+            "CHECKPRESENT Key1", "CHECKPRESENT Key2", "GETAVAILABILITY"
+        )
+        self.assertEqual(replies[-1], "AVAILABILITY GLOBAL")
+
+    def test_RemoteUnavailable(self):
+        self.remote.getavailability.return_value = "unavailable"
+        self.assertEqual(
+            self._listen("EXTENSIONS UNAVAILABLERESPONSE", "GETAVAILABILITY")[-1],
+            "AVAILABILITY UNAVAILABLE",
+        )
+
+    def test_RemoteUnavailableWithoutExtension(self):
+        self.remote.getavailability.return_value = "unavailable"
+        self.assertEqual(self._listen("GETAVAILABILITY"), ["AVAILABILITY GLOBAL"])
+
+    def test_Jobs(self):
+        self.annex.EnableJobs()
+        self.remote.circuit_breaker.threshold = 1
+        self._listen("J 1 CHECKPRESENT Key1")
+        self.assertEqual(
+            self._listen("J 1 TRANSFER RETRIEVE Key2 File"),
+            ["J 1 TRANSFER-FAILURE RETRIEVE Key2 Remote unavailable"],
+        )
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(threshold=3, cooldown=10, clock=self.clock)
+
+    def _fail(self, count):
+        for _ in range(count):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record(True)
+
+    def test_Threshold(self):
+        self._fail(2)
+        self.assertFalse(self.breaker.is_open)
+        self._fail(1)
+        self.assertTrue(self.breaker.is_open)
+        self.assertFalse(self.breaker.allow())
+
+    def test_SingleProbe(self):
+        self._fail(3)
+        self.clock.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(False)
+        self.assertFalse(self.breaker.is_open)
+        self.assertEqual(self.breaker.failures, 0)
+        self.assertTrue(self.breaker.allow())
+
+    def test_FailedProbe(self):
+        self._fail(3)
+        self.clock.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(True)
+        self.clock.now = 19
+        self.assertFalse(self.breaker.allow())
+        self.clock.now = 20
+        self.assertTrue(self.breaker.allow())
+
+    def test_Release(self):
+        self._fail(3)
+        self.clock.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.release()
+        self.assertTrue(self.breaker.is_open)
+        self.assertTrue(self.breaker.allow())
+
+    def test_InvalidThreshold(self):
+        with self.assertRaises(ValueError):
+            CircuitBreaker(threshold=0)
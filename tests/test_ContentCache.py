@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import io
+import os
+import tempfile
+
+import utils
+
+ContentCache = utils.annexremote.ContentCache
+
+
+class TestContentCache(utils.GitAnnexTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.cache = ContentCache(os.path.join(self.tempdir.name, "cache"))
+        self.remote.content_cache = self.cache
+        self.file = os.path.join(self.tempdir.name, "file")
+        self.key = "SHA256E-s7--{}.txt".format(hashlib.sha256(b"content").hexdigest())
+
+        def transfer_retrieve(key, file_):
+            with open(file_, "wb") as f:
+                f.write(b"content")
+
+        self.remote.transfer_retrieve.side_effect = transfer_retrieve
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    def _retrieve(self, key=None):
+        self.annex.Listen(
+            io.StringIO("TRANSFER RETRIEVE {} {}".format(key or self.key, self.file))
+        )
+        with open(self.file, "rb") as f:
+            return f.read()
+
+    def test_Miss(self):
+        self.assertEqual(self._retrieve(), b"content")
+        self.remote.transfer_retrieve.assert_called_once_with(self.key, self.file)
+        self.assertTrue(os.path.isfile(self.cache.path(self.key)))
+
+    def test_Hit(self):
+        self._retrieve()
+        os.unlink(self.file)
+        self.assertEqual(self._retrieve(), b"content")
+        self.assertEqual(self.remote.transfer_retrieve.call_count, 1)
+        self.assertEqual(
+            utils.buffer_lines(self.output)[-2:],
+            ["PROGRESS 7", "TRANSFER-SUCCESS RETRIEVE {}".format(self.key)],
+        )
+
+    def test_StoreNotCached(self):
+        with open(self.file, "wb") as f:
+            f.write(b"content")
+        self.annex.Listen(
+            io.StringIO("TRANSFER STORE {} {}".format(self.key, self.file))
+        )
+        self.assertFalse(os.path.exists(self.cache.path(self.key)))
+
+    def test_FailureNotCached(self):
+        self.remote.transfer_retrieve.side_effect = utils.annexremote.RemoteError(
+            "Failed"
+        )
+        self.annex.Listen(
+            io.StringIO("TRANSFER RETRIEVE {} {}".format(self.key, self.file))
+        )
+        self.assertFalse(os.path.exists(self.cache.path(self.key)))
+
+    def test_Verify(self):
+        self.cache.verify = True
+        self._retrieve()
+        with open(self.cache.path(self.key), "r+b") as f:
+            f.write(b"corrupt")
+        os.unlink(self.file)
+        self.assertEqual(self._retrieve(), b"content")
+        self.assertEqual(self.remote.transfer_retrieve.call_count, 2)
+
+    def test_KeyHash(self):
+        self.assertEqual(
+            ContentCache.key_hash("SHA256E-s7--ABC.tar.gz"), ("sha256", "abc")
+        )
+        self.assertEqual(ContentCache.key_hash("MD5-s7--abc"), ("md5", "abc"))
+        self.assertEqual(ContentCache.key_hash("WORM-s7-m1--file"), (None, None))
+
+    def test_Eviction(self):
+        self.cache.max_size = 20
+        for i in range(3):
+            with open(self.file, "wb") as f:
+                f.write(bytes(10))
+            self.cache.store("Key{}".format(i), self.file)
+            os.utime(self.cache.path("Key{}".format(i)), (i, i))
+        self.assertFalse(os.path.exists(self.cache.path("Key0")))
+        self.assertTrue(os.path.exists(self.cache.path("Key1")))
+        self.assertTrue(os.path.exists(self.cache.path("Key2")))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import io
+import tempfile
+
+import utils
+
+CostEstimator = utils.annexremote.CostEstimator
+
+MiB = 1024 * 1024
+
+
+class TestCostEstimator(utils.MinimalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    def _estimator(self, **kwargs):
+        self.annex.input = io.StringIO("VALUE uuid\n")
+        estimator = CostEstimator(self.annex, directory=self.tempdir.name, **kwargs)
+        estimator.path()
+        return estimator
+
+    def test_DefaultCost(self):
+        self.remote.cost_estimator = self._estimator()
+        self.annex.Listen(io.StringIO("GETCOST"))
+        self.assertEqual(utils.last_buffer_line(self.output), "COST 200")
+
+    def test_Unsupported(self):
+        self.annex.Listen(io.StringIO("GETCOST"))
+        self.assertEqual(utils.last_buffer_line(self.output), "UNSUPPORTED-REQUEST")
+
+    def test_Cost(self):
+        estimator = self._estimator()
+        estimator.record_transfer(10 * MiB, 1)
+        self.assertEqual(estimator.cost(), 110)
+        estimator.record_latency(0.5)
+        self.assertEqual(estimator.cost(), 115)
+
+    def test_Bounds(self):
+        slow = self._estimator(max_cost=500)
+        slow.record_transfer(MiB, 100)
+        self.assertEqual(slow.cost(), 500)
+        fast = self._estimator(min_cost=50, default_cost=50)
+        fast.record_transfer(1000 * MiB, 0.001)
+        self.assertEqual(fast.cost(), 50)
+
+    def test_InvalidBounds(self):
+        with self.assertRaises(ValueError):
+            CostEstimator(self.annex, min_cost=200, max_cost=100)
+
+    def test_Rolling(self):
+        estimator = self._estimator(smoothing=0.5)
+        estimator.record_transfer(100, 1)
+        estimator.record_transfer(300, 1)
+        self.assertEqual(estimator.estimate(), {"throughput": 200})
+
+    def test_Persisted(self):
+        self._estimator().record_transfer(10 * MiB, 1)
+        self.assertEqual(self._estimator().cost(), 110)
+
+    def test_MergedAcrossProcesses(self):
+        first = self._estimator(smoothing=0.5)
+        second = self._estimator(smoothing=0.5)
+        first.estimate()
+        first.record_transfer(100, 1)
+        second.record_transfer(300, 1)
+        first.record_transfer(400, 1)
+        self.assertEqual(first.estimate(), {"throughput": 300})
+
+    def test_LatencyFlushedLazily(self):
+        estimator = self._estimator(flush_interval=3600)
+        estimator.record_latency(0.5)
+        self.assertEqual(estimator.estimate(), {"latency": 0.5})
+        self.assertEqual(self._estimator().estimate(), {})
+        estimator.flush()
+        self.assertEqual(self._estimator().estimate(), {"latency": 0.5})
+
+    def test_MeasuredRequests(self):
+        self.remote.cost_estimator = self._estimator(flush_interval=0)
+        self.annex.Listen(
+            io.StringIO("TRANSFER STORE SHA256E-s1000--abc File\nCHECKPRESENT Key\n")
+        )
+        self.assertEqual(
+            sorted(self.remote.cost_estimator.estimate()), ["latency", "throughput"]
+        )
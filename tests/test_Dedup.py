@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import random
+import tempfile
+import unittest
+
+import utils
+
+annexremote = utils.annexremote
+
+
+class ChunkStoreRemote(annexremote.DedupRemote):
+    chunker = annexremote.ContentDefinedChunker(64, 256, 1024)
+
+    def __init__(self, annex):
+        super().__init__(annex)
+        self.chunks = {}
+        self.manifests = {}
+        self.uploaded = 0
+
+    def initremote(self):
+        pass
+
+    def prepare(self):
+        pass
+
+    def put_chunk(self, chunk_id, data):
+        self.chunks[chunk_id] = data
+        self.uploaded += len(data)
+
+    def get_chunk(self, chunk_id):
+        return self.chunks[chunk_id]
+
+    def has_chunk(self, chunk_id):
+        return chunk_id in self.chunks
+
+    def put_manifest(self, key, manifest):
+        self.manifests[key] = manifest
+
+    def get_manifest(self, key):
+        return self.manifests.get(key, "")
+
+
+class TestDedupRemote(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.output = io.StringIO()
+        self.annex = annexremote.Master(self.output)
+        self.remote = ChunkStoreRemote(self.annex)
+        self.annex.LinkRemote(self.remote)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.data = random.Random(0).randbytes(20000)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    def _file(self, name, data):
+        path = os.path.join(self.tempdir.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def _listen(self, request):
+        self.annex.Listen(io.StringIO(request))
+        return utils.last_buffer_line(self.output)
+
+    def test_StoreAndRetrieve(self):
+        path = self._file("file", self.data)
+        self.assertEqual(
+            self._listen("TRANSFER STORE Key1 {}".format(path)),
+            "TRANSFER-SUCCESS STORE Key1",
+        )
+        target = os.path.join(self.tempdir.name, "retrieved")
+        self.assertEqual(
+            self._listen("TRANSFER RETRIEVE Key1 {}".format(target)),
+            "TRANSFER-SUCCESS RETRIEVE Key1",
+        )
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_NearDuplicateSkipsChunks(self):
+        self._listen("TRANSFER STORE Key1 {}".format(self._file("a", self.data)))
+        uploaded = self.remote.uploaded
+        changed = self.data[:10000] + b"inserted" + self.data[10000:]
+        self._listen("TRANSFER STORE Key2 {}".format(self._file("b", changed)))
+        self.assertLess(self.remote.uploaded - uploaded, 3 * 1024)
+
+    def test_CheckpresentAndRemove(self):
+        self.assertEqual(self._listen("CHECKPRESENT Key1"), "CHECKPRESENT-FAILURE Key1")
+        self._listen("TRANSFER STORE Key1 {}".format(self._file("a", self.data)))
+        self.assertEqual(self._listen("CHECKPRESENT Key1"), "CHECKPRESENT-SUCCESS Key1")
+        self.assertEqual(self._listen("REMOVE Key1"), "REMOVE-SUCCESS Key1")
+        self.assertEqual(self._listen("CHECKPRESENT Key1"), "CHECKPRESENT-FAILURE Key1")
+
+    def test_CorruptedChunk(self):
+        self._listen("TRANSFER STORE Key1 {}".format(self._file("a", self.data)))
+        chunk_id = next(iter(self.remote.chunks))
+        self.remote.chunks[chunk_id] = b"garbage"
+        target = os.path.join(self.tempdir.name, "retrieved")
+        self.assertTrue(
+            self._listen("TRANSFER RETRIEVE Key1 {}".format(target)).startswith(
+                "TRANSFER-FAILURE RETRIEVE Key1 Chunk"
+            )
+        )
+
+    def test_DefaultManifestUsesState(self):
+        remote = annexremote.DedupRemote.put_manifest
+        remote(self.remote, "Key1", "10:abc")
+        self.assertEqual(utils.last_buffer_line(self.output), "SETSTATE Key1 10:abc")
+
+
+class TestContentDefinedChunker(unittest.TestCase):
+    def test_Sizes(self):
+        chunker = annexremote.ContentDefinedChunker(64, 256, 1024)
+        data = random.Random(1).randbytes(50000)
+        chunks = list(chunker.chunks(io.BytesIO(data)))
+        self.assertEqual(b"".join(chunks), data)
+        self.assertTrue(all(64 <= len(c) <= 1024 for c in chunks[:-1]))
+        self.assertTrue(100 < len(data) / len(chunks) < 1000)
+
+    def test_Empty(self):
+        chunker = annexremote.ContentDefinedChunker(64, 256, 1024)
+        self.assertEqual(list(chunker.chunks(io.BytesIO(b""))), [])
+
+    def test_InvalidSizes(self):
+        with self.assertRaises(ValueError):
+            annexremote.ContentDefinedChunker(64, 300, 1024)
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+import io
+import tempfile
+
+import utils
+
+ExportManifest = utils.annexremote.ExportManifest
+
+KEY = "SHA256E-s7--abc.txt"
+
+
+class TestExportManifest(utils.GitAnnexTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.annex.input = io.StringIO("VALUE uuid\n")
+        self.manifest = ExportManifest(self.annex, directory=self.tempdir.name)
+        self.manifest.path()
+        self.remote.export_manifest = self.manifest
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    def _listen(self, *lines):
+        self.annex.Listen(io.StringIO("".join(line + "\n" for line in lines)))
+        return utils.last_buffer_line(self.output)
+
+    def test_Store(self):
+        self.remote.transferexport_store.return_value = "etag1"
+        self._listen("EXPORT dir/file name", "TRANSFEREXPORT STORE {} File".format(KEY))
+        self.assertEqual(self.manifest.get("dir/file name"), (KEY, 7, "etag1"))
+        self.assertEqual(self.manifest.find(KEY), ["dir/file name"])
+
+    def test_FailedStoreNotRecorded(self):
+        self.remote.transferexport_store.side_effect = utils.annexremote.RemoteError
+        self._listen("EXPORT file", "TRANSFEREXPORT STORE {} File".format(KEY))
+        self.assertIsNone(self.manifest.get("file"))
+
+    def test_CheckpresentFromManifest(self):
+        self.manifest.add("file", KEY, 7)
+        self.assertEqual(
+            self._listen("EXPORT file", "CHECKPRESENTEXPORT {}".format(KEY)),
+            "CHECKPRESENT-SUCCESS {}".format(KEY),
+        )
+        self.assertEqual(
+            self._listen("EXPORT file", "CHECKPRESENTEXPORT OtherKey"),
+            "CHECKPRESENT-FAILURE OtherKey",
+        )
+        self.remote.checkpresentexport.assert_not_called()
+
+    def test_CheckpresentUnknownPath(self):
+        self.remote.checkpresentexport.return_value = True
+        self.assertEqual(
+            self._listen("EXPORT file", "CHECKPRESENTEXPORT {}".format(KEY)),
+            "CHECKPRESENT-SUCCESS {}".format(KEY),
+        )
+        self.remote.checkpresentexport.assert_called_once_with(KEY, "file")
+
+    def test_Rebuild(self):
+        self.remote.listexport.side_effect = lambda: iter([("file", 7, "etag1")])
+        self.assertEqual(
+            self._listen("EXPORT file", "CHECKPRESENTEXPORT {}".format(KEY)),
+            "CHECKPRESENT-SUCCESS {}".format(KEY),
+        )
+        self.assertEqual(
+            self._listen("EXPORT other", "CHECKPRESENTEXPORT {}".format(KEY)),
+            "CHECKPRESENT-FAILURE {}".format(KEY),
+        )
+        self.assertTrue(self.manifest.complete)
+        self.remote.listexport.assert_called_once_with()
+        self.remote.checkpresentexport.assert_not_called()
+
+    def test_RebuildKeepsKnownKeys(self):
+        self.manifest.add("same", KEY, 7)
+        self.manifest.add("changed", KEY, 7)
+        self.manifest.add("removed", KEY, 7)
+        self.manifest.rebuild([("same", 7, None), ("changed", 8, None)])
+        self.assertEqual(self.manifest.get("same"), (KEY, 7, None))
+        self.assertEqual(self.manifest.get("changed"), (None, 8, None))
+        self.assertIsNone(self.manifest.get("removed"))
+
+    def test_Remove(self):
+        self.manifest.add("file", KEY, 7)
+        self._listen("EXPORT file", "REMOVEEXPORT {}".format(KEY))
+        self.assertIsNone(self.manifest.get("file"))
+
+    def test_Rename(self):
+        self.manifest.add("file", KEY, 7)
+        self._listen("EXPORT file", "RENAMEEXPORT {} new file".format(KEY))
+        self.assertIsNone(self.manifest.get("file"))
+        self.assertEqual(self.manifest.get("new file"), (KEY, 7, None))
+
+    def test_RemoveDirectory(self):
+        self.manifest.add("dir/a", KEY, 7)
+        self.manifest.add("dir/sub/b", KEY, 7)
+        self.manifest.add("dir2/c", KEY, 7)
+        self._listen("REMOVEEXPORTDIRECTORY dir")
+        self.assertEqual(self.manifest.find(KEY), ["dir2/c"])
+        self.assertEqual(self.manifest.listdirectory("dir2"), [("dir2/c", KEY)])
+
+
+class CopyRemote(utils.DummyRemote):
+    renameexport = utils.annexremote.ExportRemote.renameexport
+
+    def __init__(self, annex):
+        super().__init__(annex)
+        self.files = {}
+        self.uploads = 0
+
+    def transferexport_store(self, key, file_, name):
+        self.uploads += 1
+        self.files[name] = key
+
+    def copyexport(self, key, name, new_name):
+        if name not in self.files:
+            raise utils.annexremote.RemoteError("Not found")
+        self.files[new_name] = key
+        return "etag-{}".format(new_name)
+
+    def removeexport(self, key, name):
+        self.files.pop(name, None)
+
+
+class TestCopyExport(utils.MinimalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.remote = CopyRemote(self.annex)
+        self.annex.LinkRemote(self.remote)
+        self.annex.input = io.StringIO("VALUE uuid\n")
+        self.manifest = ExportManifest(self.annex, directory=self.tempdir.name)
+        self.manifest.path()
+        self.remote.export_manifest = self.manifest
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    def _listen(self, *lines):
+        self.annex.Listen(io.StringIO("".join(line + "\n" for line in lines)))
+        return utils.last_buffer_line(self.output)
+
+    def test_Rename(self):
+        self._listen("EXPORT old", "TRANSFEREXPORT STORE {} File".format(KEY))
+        self.assertEqual(
+            self._listen("EXPORT old", "RENAMEEXPORT {} new".format(KEY)),
+            "RENAMEEXPORT-SUCCESS {}".format(KEY),
+        )
+        self.assertEqual(self.remote.files, {"new": KEY})
+        self.assertEqual(self.manifest.find(KEY), ["new"])
+
+    def test_RenameUnknownFile(self):
+        self.manifest.rebuild([])
+        self.assertEqual(
+            self._listen("EXPORT old", "RENAMEEXPORT {} new".format(KEY)),
+            "RENAMEEXPORT-FAILURE {}".format(KEY),
+        )
+
+    def test_RenameWithoutCopy(self):
+        self.remote.copyexport = utils.DummyRemote.copyexport.__get__(self.remote)
+        self.assertEqual(
+            self._listen("EXPORT old", "RENAMEEXPORT {} new".format(KEY)),
+            "UNSUPPORTED-REQUEST",
+        )
+
+    def test_StoreCopiesExportedKey(self):
+        self._listen("EXPORT a", "TRANSFEREXPORT STORE {} File".format(KEY))
+        self.assertEqual(
+            self._listen("EXPORT b", "TRANSFEREXPORT STORE {} File".format(KEY)),
+            "TRANSFER-SUCCESS STORE {}".format(KEY),
+        )
+        self.assertEqual(self.remote.uploads, 1)
+        self.assertEqual(self.remote.files, {"a": KEY, "b": KEY})
+        self.assertEqual(self.manifest.get("b"), (KEY, 7, "etag-b"))
+
+    def test_StoreUploadsIfCopyFails(self):
+        self.manifest.add("gone", KEY, 7)
+        self._listen("EXPORT b", "TRANSFEREXPORT STORE {} File".format(KEY))
+        self.assertEqual(self.remote.uploads, 1)
+        self.assertEqual(self.remote.files, {"b": KEY})
+
+
+class TreeRemote(CopyRemote):
+    def __init__(self, annex):
+        super().__init__(annex)
+        self.batches = []
+
+    def removeexportdirectory(self, remote_directory):
+        self.removeexporttree(remote_directory, workers=2, batch_size=2)
+
+    def removeexport(self, key, name):
+        if name == "dir/broken":
+            raise utils.annexremote.RemoteError("Failed")
+        super().removeexport(key, name)
+
+    def listexport(self):
+        return [(name, 7, None) for name in self.files]
+
+
+class BulkTreeRemote(TreeRemote):
+    def removeexports(self, files):
+        self.batches.append(sorted(files))
+        for key, name in files:
+            self.files.pop(name, None)
+
+
+class TestRemoveExportTree(utils.MinimalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.annex.input = io.StringIO("VALUE uuid\n")
+        self.manifest = ExportManifest(self.annex, directory=self.tempdir.name)
+        self.manifest.path()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    def _remote(self, cls, manifest=True):
+        remote = cls(self.annex)
+        self.annex.LinkRemote(remote)
+        if manifest:
+            remote.export_manifest = self.manifest
+        for name in ("dir/a", "dir/b", "dir/sub/c", "dir2/d"):
+            remote.files[name] = KEY
+            self.manifest.add(name, KEY, 7)
+        return remote
+
+    def _removedirectory(self, name):
+        self.annex.Listen(io.StringIO("REMOVEEXPORTDIRECTORY {}\n".format(name)))
+        return utils.last_buffer_line(self.output)
+
+    def test_FromManifest(self):
+        remote = self._remote(TreeRemote)
+        remote.files["dir/unknown"] = KEY
+        self.assertEqual(self._removedirectory("dir"), "REMOVEEXPORTDIRECTORY-SUCCESS")
+        self.assertEqual(remote.files, {"dir2/d": KEY, "dir/unknown": KEY})
+        self.assertEqual(self.manifest.find(KEY), ["dir2/d"])
+
+    def test_FromListing(self):
+        remote = self._remote(TreeRemote, manifest=False)
+        self._removedirectory("dir")
+        self.assertEqual(remote.files, {"dir2/d": KEY})
+
+    def test_Bulk(self):
+        remote = self._remote(BulkTreeRemote)
+        self._removedirectory("dir/")
+        self.assertEqual(remote.files, {"dir2/d": KEY})
+        self.assertEqual(sorted(len(batch) for batch in remote.batches), [1, 2])
+
+    def test_Failure(self):
+        remote = self._remote(TreeRemote)
+        remote.files["dir/broken"] = KEY
+        self.manifest.add("dir/broken", KEY, 7)
+        self.assertEqual(self._removedirectory("dir"), "REMOVEEXPORTDIRECTORY-FAILURE")
+        self.assertIn("dir/broken", self.manifest.find(KEY))
@@ -2,12 +2,15 @@
 
 import io
 import logging
+import threading
+import unittest
 
 import utils
 
 RemoteError = utils.annexremote.RemoteError
 ProtocolError = utils.annexremote.ProtocolError
 UnsupportedReqeust = utils.annexremote.UnsupportedRequest
+UrlClaims = utils.annexremote.UrlClaims
 
 
 class TestGitAnnexRequestMessages(utils.GitAnnexTestCase):
@@ -186,7 +189,7 @@ class TestGitAnnexRequestMessages(utils.GitAnnexTestCase):
             self.annex.Listen(io.StringIO("GETAVAILABILITY"))
         self.assertEqual(
             utils.last_buffer_line(self.output),
-            "ERROR Availability must be either 'global' or 'local'",
+            "ERROR Availability must be either 'global', 'local' or 'unavailable'",
         )
 
     def test_ClaimurlSuccess(self):
@@ -200,6 +203,25 @@ class TestGitAnnexRequestMessages(utils.GitAnnexTestCase):
         self.annex.Listen(io.StringIO("CLAIMURL Url"))
         self.assertEqual(utils.second_buffer_line(self.output), "CLAIMURL-FAILURE")
 
+    def test_ClaimurlClaims(self):
+        self.remote.url_claims = UrlClaims(prefixes=["https://example.com/"])
+        self.annex.Listen(io.StringIO("CLAIMURL https://example.com/file"))
+        self.remote.claimurl.assert_not_called()
+        self.assertEqual(utils.second_buffer_line(self.output), "CLAIMURL-SUCCESS")
+
+    def test_ClaimurlClaimsFallback(self):
+        self.remote.url_claims = UrlClaims(prefixes=["https://example.com/"])
+        self.remote.claimurl.return_value = True
+        self.annex.Listen(io.StringIO("CLAIMURL https://example.org/file"))
+        self.remote.claimurl.assert_called_once_with("https://example.org/file")
+        self.assertEqual(utils.second_buffer_line(self.output), "CLAIMURL-SUCCESS")
+
+    def test_ClaimurlClaimsUnsupportedFallback(self):
+        self.remote.url_claims = UrlClaims(schemes=["s3"])
+        self.remote.claimurl.side_effect = UnsupportedReqeust()
+        self.annex.Listen(io.StringIO("CLAIMURL https://example.org/file"))
+        self.assertEqual(utils.second_buffer_line(self.output), "CLAIMURL-FAILURE")
+
     def test_CheckurlContentsTrue(self):
         self.remote.checkurl.return_value = True
         self.annex.Listen(io.StringIO("CHECKURL Url"))
@@ -313,6 +335,90 @@ class TestGitAnnexRequestMessages(utils.GitAnnexTestCase):
         result = "CHECKURL-MULTI Url\twith\ttabs 512 Filename1 Url2 UNKNOWN Filename\twith\ttabs"
         self.assertEqual(utils.second_buffer_line(self.output), result)
 
+    def test_CheckurlMultiGenerator(self):
+        self.remote.checkurl.side_effect = lambda url: (
+            {"url": "Url{}".format(i), "size": i, "filename": "Filename{}".format(i)}
+            for i in range(3)
+        )
+        self.annex.Listen(io.StringIO("CHECKURL Url"))
+        self.assertEqual(
+            utils.second_buffer_line(self.output),
+            "CHECKURL-MULTI Url0 0 Filename0 Url1 1 Filename1 Url2 2 Filename2",
+        )
+
+    def test_CheckurlGeneratorSingleFile(self):
+        self.remote.checkurl.side_effect = lambda url: iter([{"size": 512}])
+        self.annex.Listen(io.StringIO("CHECKURL Url"))
+        self.assertEqual(utils.second_buffer_line(self.output), "CHECKURL-CONTENTS 512")
+
+    def test_CheckurlEmptyGenerator(self):
+        self.remote.checkurl.side_effect = lambda url: iter([])
+        self.annex.Listen(io.StringIO("CHECKURL Url"))
+        self.assertEqual(utils.second_buffer_line(self.output), "CHECKURL-FAILURE")
+
+    def test_CheckurlMultiMany(self):
+        count = 100000
+        self.remote.checkurl.side_effect = lambda url: (
+            {"url": "Url{}".format(i), "size": 1} for i in range(count)
+        )
+        self.annex.Listen(io.StringIO("CHECKURL Url"))
+        reply = utils.second_buffer_line(self.output).split(" ")
+        self.assertEqual(len(reply), 1 + 3 * count)
+        self.assertEqual(reply[-3:], ["Url{}".format(count - 1), "1", ""])
+
+    def test_CheckurlLazySizes(self):
+        started = threading.Barrier(3, timeout=5)
+
+        def size(value):
+            def lookup():
+                # all lookups must run at once to pass the barrier
+                started.wait()
+                return value
+
+            return lookup
+
+        self.remote.checkurl_workers = 3
+        self.remote.checkurl_timeout = 10
+        self.remote.checkurl.return_value = [
+            {"url": "Url{}".format(i), "size": size(i * 100)} for i in range(3)
+        ]
+        self.annex.Listen(io.StringIO("CHECKURL Url"))
+        self.assertEqual(
+            utils.second_buffer_line(self.output),
+            "CHECKURL-MULTI Url0 0  Url1 100  Url2 200 ",
+        )
+
+    def test_CheckurlLazySizeTimeout(self):
+        release = threading.Event()
+
+        def stuck():
+            release.wait(5)
+            return 1
+
+        def failing():
+            raise RemoteError("Not found")
+
+        self.remote.checkurl_workers = 3
+        self.remote.checkurl_timeout = 0.1
+        self.remote.checkurl.return_value = [
+            {"url": "Url1", "size": stuck},
+            {"url": "Url2", "size": lambda: 512},
+            {"url": "Url3", "size": failing},
+        ]
+        self.annex.Listen(io.StringIO("CHECKURL Url"))
+        release.set()
+        self.assertEqual(
+            utils.second_buffer_line(self.output),
+            "CHECKURL-MULTI Url1 UNKNOWN  Url2 512  Url3 UNKNOWN ",
+        )
+
+    def test_CheckurlLazySizeSingleFile(self):
+        self.remote.checkurl_workers = 1
+        self.remote.checkurl_timeout = 10
+        self.remote.checkurl.return_value = [{"size": lambda: 512}]
+        self.annex.Listen(io.StringIO("CHECKURL Url"))
+        self.assertEqual(utils.second_buffer_line(self.output), "CHECKURL-CONTENTS 512")
+
     def test_CheckurlFailure(self):
         self.remote.checkurl.side_effect = RemoteError()
         self.annex.Listen(io.StringIO("CHECKURL Url"))
@@ -697,3 +803,40 @@ class TestLogging(utils.GitAnnexTestCase):
 
         self.assertEqual(buffer_lines[1], "DEBUG root - WARNING - test")
         self.assertEqual(buffer_lines[2], "DEBUG this is a new line")
+
+
+class TestUrlClaims(unittest.TestCase):
+    def test_Prefixes(self):
+        claims = UrlClaims(prefixes=["https://example.com/", "https://a.b/c"])
+        self.assertTrue(claims.match("https://example.com/file"))
+        self.assertTrue(claims.match("https://a.b/c/d"))
+        self.assertFalse(claims.match("https://example.com"))
+        self.assertFalse(claims.match("http://example.com/file"))
+
+    def test_PrefixesEscaped(self):
+        claims = UrlClaims(prefixes=["https://a.b/"])
+        self.assertFalse(claims.match("https://axb/"))
+
+    def test_Schemes(self):
+        claims = UrlClaims(schemes=["s3", "gs"])
+        self.assertTrue(claims.match("s3://bucket/key"))
+        self.assertTrue(claims.match("GS://bucket/key"))
+        self.assertFalse(claims.match("s3x://bucket/key"))
+        self.assertFalse(claims.match("https://s3:443/"))
+
+    def test_Patterns(self):
+        claims = UrlClaims(patterns=[r"https://[a-z]+\.example\.com/", "(ftp|sftp)://"])
+        self.assertTrue(claims.match("https://mirror.example.com/file"))
+        self.assertTrue(claims.match("sftp://host/file"))
+        self.assertFalse(claims.match("https://example.com/file"))
+
+    def test_Combined(self):
+        claims = UrlClaims(
+            prefixes=["https://example.com/"], schemes=["s3"], patterns=["ftp://"]
+        )
+        for url in ("https://example.com/x", "s3://b/k", "ftp://h/f"):
+            self.assertTrue(claims.match(url))
+        self.assertFalse(claims.match("https://example.org/x"))
+
+    def test_Empty(self):
+        self.assertFalse(UrlClaims().match("https://example.com/"))
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import utils
+
+annexremote = utils.annexremote
+
+
+class TestMultipartUpload(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.tempdir.name, "file")
+        self.data = os.urandom(1000)
+        with open(self.file, "wb") as f:
+            f.write(self.data)
+        self.uploaded = {}
+        self.progress = []
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    def _upload_part(self, number, data, report):
+        report(len(data) // 2)
+        self.uploaded[number] = data
+        return "etag{}".format(number)
+
+    def test_Upload(self):
+        upload = annexremote.MultipartUpload(part_size=300, workers=3)
+        result = upload.upload(
+            self.file,
+            self._upload_part,
+            complete=lambda etags: etags,
+            progress=self.progress.append,
+        )
+        self.assertEqual(result, ["etag1", "etag2", "etag3", "etag4"])
+        self.assertEqual(
+            b"".join(self.uploaded[n] for n in sorted(self.uploaded)), self.data
+        )
+        self.assertEqual(self.progress[-1], 1000)
+        self.assertEqual(self.progress, sorted(self.progress))
+
+    def test_ProgressThrottled(self):
+        upload = annexremote.MultipartUpload(
+            part_size=10, workers=2, progress_interval=3600
+        )
+        upload.upload(self.file, self._upload_part, progress=self.progress.append)
+        # the first update and the final total
+        self.assertEqual(len(self.progress), 2)
+        self.assertEqual(self.progress[-1], 1000)
+
+    def test_Parts(self):
+        upload = annexremote.MultipartUpload(part_size=4)
+        self.assertEqual(upload.parts(10), [(1, 0, 4), (2, 4, 4), (3, 8, 2)])
+        self.assertEqual(upload.parts(0), [(1, 0, 0)])
+
+    def test_Abort(self):
+        aborted = threading.Event()
+        started = []
+
+        def upload_part(number, data, report):
+            started.append(number)
+            if number == 1:
+                raise annexremote.RemoteError("Failed")
+            time.sleep(0.01)
+
+        upload = annexremote.MultipartUpload(part_size=10, workers=1)
+        with self.assertRaises(annexremote.RemoteError):
+            upload.upload(
+                self.file,
+                upload_part,
+                complete=lambda parts: self.fail("completed"),
+                abort=aborted.set,
+            )
+        self.assertTrue(aborted.is_set())
+        # the remaining parts of the 100 were cancelled
+        self.assertLess(len(started), 10)
+
+    def test_AbortOnFailedComplete(self):
+        aborted = threading.Event()
+
+        def complete(parts):
+            raise annexremote.RemoteError("Failed")
+
+        with self.assertRaises(annexremote.RemoteError):
+            annexremote.MultipartUpload(part_size=300).upload(
+                self.file, self._upload_part, complete=complete, abort=aborted.set
+            )
+        self.assertTrue(aborted.is_set())
+
+
+class TestRangedDownload(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.tempdir.name, "file")
+        self.data = os.urandom(1000)
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    def _read_range(self, offset, length):
+        with self.lock:
+            self.requests.append(offset)
+        return self.data[offset : offset + length]
+
+    def _content(self):
+        with open(self.file, "rb") as f:
+            return f.read()
+
+    def test_Download(self):
+        progress = []
+        download = annexremote.RangedDownload(range_size=64, workers=4)
+        download.download(self.file, 1000, self._read_range, progress.append)
+        self.assertEqual(self._content(), self.data)
+        self.assertEqual(sorted(self.requests), list(range(0, 1000, 64)))
+        self.assertEqual(progress[-1], 1000)
+        self.assertEqual(progress, sorted(progress))
+        self.assertFalse(os.path.exists(self.file + ".ranges"))
+
+    def test_Empty(self):
+        annexremote.RangedDownload().download(self.file, 0, self._read_range)
+        self.assertEqual(self._content(), b"")
+        self.assertEqual(self.requests, [])
+
+    def test_Retry(self):
+        failures = []
+
+        def read_range(offset, length):
+            if offset == 128 and len(failures) < 2:
+                failures.append(offset)
+                raise annexremote.RemoteError("Connection reset")
+            return self._read_range(offset, length)
+
+        download = annexremote.RangedDownload(range_size=64, retries=2)
+        download.download(self.file, 1000, read_range)
+        self.assertEqual(self._content(), self.data)
+
+    def test_ShortRead(self):
+        download = annexremote.RangedDownload(range_size=64, retries=0)
+        with self.assertRaises(annexremote.RemoteError):
+            download.download(self.file, 1000, lambda offset, length: b"short")
+
+    def test_Resume(self):
+        def read_range(offset, length):
+            if offset >= 512:
+                raise annexremote.RemoteError("Connection reset")
+            return self._read_range(offset, length)
+
+        download = annexremote.RangedDownload(range_size=64, workers=1, retries=0)
+        with self.assertRaises(annexremote.RemoteError):
+            download.download(self.file, 1000, read_range)
+        self.requests.clear()
+        download.download(self.file, 1000, self._read_range)
+        self.assertEqual(self._content(), self.data)
+        self.assertNotIn(0, self.requests)
+        self.assertIn(512, self.requests)
+
+    def test_NoResumeWithOtherLayout(self):
+        with open(self.file + ".ranges", "w") as f:
+            f.write("1000 32\n0\n")
+        with open(self.file, "wb") as f:
+            f.write(bytes(1000))
+        annexremote.RangedDownload(range_size=64).download(
+            self.file, 1000, self._read_range
+        )
+        self.assertEqual(self._content(), self.data)
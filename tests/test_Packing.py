@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import utils
+
+annexremote = utils.annexremote
+
+
+class PackRemote(annexremote.PackingRemote):
+    def __init__(self, annex):
+        super().__init__(annex)
+        self.packs = {}
+        self.index = {}
+        self.uploading = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def initremote(self):
+        pass
+
+    def prepare(self):
+        pass
+
+    def put_pack(self, pack_id, local_file):
+        self.uploading.set()
+        self.release.wait(5)
+        with open(local_file, "rb") as f:
+            self.packs[pack_id] = f.read()
+
+    def get_range(self, pack_id, offset, length):
+        return self.packs[pack_id][offset : offset + length]
+
+    def put_index(self, key, entry):
+        self.index[key] = entry
+
+    def get_index(self, key):
+        return self.index.get(key, "")
+
+
+class TestPackingRemote(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.output = io.StringIO()
+        self.annex = annexremote.Master(self.output)
+        self.remote = PackRemote(self.annex)
+        self.annex.LinkRemote(self.remote)
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    def _file(self, name, data):
+        path = os.path.join(self.tempdir.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def _store(self, key, data):
+        thread = threading.Thread(
+            target=self.remote.transfer_store,
+            args=(key, self._file(key, data)),
+            daemon=True,
+        )
+        thread.start()
+        return thread
+
+    def _wait_staged(self, count):
+        for _ in range(500):
+            with self.remote._packer:
+                if len(self.remote._staged) >= count:
+                    return
+            time.sleep(0.01)
+        self.fail("Keys were not staged")
+
+    def test_StoreAndRetrieve(self):
+        self.annex.Listen(
+            io.StringIO("TRANSFER STORE Key1 {}".format(self._file("a", b"content")))
+        )
+        target = os.path.join(self.tempdir.name, "retrieved")
+        self.annex.Listen(io.StringIO("TRANSFER RETRIEVE Key1 {}".format(target)))
+        self.assertEqual(
+            utils.last_buffer_line(self.output), "TRANSFER-SUCCESS RETRIEVE Key1"
+        )
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), b"content")
+
+    def test_ConcurrentKeysPacked(self):
+        self.remote.release.clear()
+        first = self._store("Key0", b"first")
+        self.assertTrue(self.remote.uploading.wait(5))
+        threads = [self._store("Key{}".format(i), bytes([i]) * i) for i in range(1, 4)]
+        self._wait_staged(3)
+        # nothing is present before its pack is stored
+        self.assertEqual(self.remote.index, {})
+        self.remote.release.set()
+        for thread in [first] + threads:
+            thread.join(5)
+        self.assertEqual(len(self.remote.packs), 2)
+        packs = {entry.split(":")[0] for key, entry in self.remote.index.items()}
+        self.assertEqual(len(packs), 2)
+        for i in range(1, 4):
+            pack_id, offset, length = self.remote._parse_index("Key{}".format(i))
+            self.assertEqual(
+                self.remote.get_range(pack_id, offset, length), bytes([i]) * i
+            )
+
+    def test_PackSizeSealsEarly(self):
+        self.remote.max_delay = 60
+        self.remote.pack_size = 10
+        first = self._store("Key1", b"12345")
+        self._wait_staged(1)
+        second = self._store("Key2", b"67890")
+        first.join(5)
+        second.join(5)
+        self.assertFalse(first.is_alive())
+        self.assertEqual(len(self.remote.packs), 1)
+        self.assertEqual(list(self.remote.packs.values()), [b"1234567890"])
+
+    def test_Failure(self):
+        def put_pack(pack_id, local_file):
+            raise annexremote.RemoteError("Failed")
+
+        self.remote.put_pack = put_pack
+        self.remote.staging_directory = self.tempdir.name
+        self.annex.Listen(
+            io.StringIO("TRANSFER STORE Key1 {}".format(self._file("a", b"content")))
+        )
+        self.assertEqual(
+            utils.last_buffer_line(self.output), "TRANSFER-FAILURE STORE Key1 Failed"
+        )
+        self.assertEqual(self.remote.index, {})
+        self.assertEqual(os.listdir(self.tempdir.name), ["a"])
+
+    def test_CheckpresentAndRemove(self):
+        self.remote.transfer_store("Key1", self._file("a", b"content"))
+        self.assertTrue(self.remote.checkpresent("Key1"))
+        self.remote.remove("Key1")
+        self.assertFalse(self.remote.checkpresent("Key1"))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import pstats
+import tempfile
+import tracemalloc
+from unittest import mock
+
+import utils
+
+RequestProfiler = utils.annexremote.RequestProfiler
+
+
+class TestProfiling(utils.GitAnnexTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tempdir.name, "profile")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    def _listen(self, session, memory=False):
+        environ = {"ANNEXREMOTE_PROFILE": self.directory}
+        if memory:
+            environ["ANNEXREMOTE_PROFILE_MEMORY"] = "1"
+        with mock.patch.dict(os.environ, environ):
+            self.annex.Listen(io.StringIO(session))
+
+    def test_StatsPerRequestType(self):
+        self._listen(
+            "TRANSFER STORE Key File\nTRANSFER RETRIEVE Key File\nCHECKPRESENT Key\n"
+        )
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            [
+                "CHECKPRESENT.pstats",
+                "TRANSFER-RETRIEVE.pstats",
+                "TRANSFER-STORE.pstats",
+            ],
+        )
+        stats = pstats.Stats(os.path.join(self.directory, "TRANSFER-STORE.pstats"))
+        functions = [function for _, _, function in stats.stats]
+        self.assertIn("do_TRANSFER", functions)
+
+    def test_Memory(self):
+        self.remote.checkpresent.side_effect = lambda key: len(bytearray(1024 * 1024))
+        self._listen("CHECKPRESENT Key\nCHECKPRESENT Key\n", memory=True)
+        with open(os.path.join(self.directory, "memory.txt")) as f:
+            request_type, count, peak = f.read().split()
+        self.assertEqual((request_type, count), ("CHECKPRESENT", "2"))
+        self.assertGreaterEqual(int(peak), 1024 * 1024)
+        snapshot = tracemalloc.Snapshot.load(
+            os.path.join(self.directory, "CHECKPRESENT.tracemalloc")
+        )
+        self.assertIsInstance(snapshot, tracemalloc.Snapshot)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_RequestType(self):
+        self.assertEqual(
+            RequestProfiler.request_type("TRANSFEREXPORT STORE Key File"),
+            "TRANSFEREXPORT-STORE",
+        )
+        self.assertEqual(RequestProfiler.request_type("WHEREIS Key"), "WHEREIS")
+        self.assertEqual(RequestProfiler.request_type("PREPARE"), "PREPARE")
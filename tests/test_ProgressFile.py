@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import io
+import unittest
+from unittest import mock
+
+import utils
+
+ProgressFile = utils.annexremote.ProgressFile
+
+
+class TestProgressFile(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.progress = []
+
+    def test_ReadPercent(self):
+        f = ProgressFile(
+            io.BytesIO(bytes(1000)), self.progress.append, size=1000, percent=10
+        )
+        while f.read(30):
+            pass
+        self.assertEqual(self.progress, [120, 240, 360, 480, 600, 720, 840, 960, 1000])
+
+    def test_SizeFromKey(self):
+        f = ProgressFile(
+            io.BytesIO(bytes(1000)),
+            self.progress.append,
+            key="SHA256E-s1000--abc",
+            percent=50,
+        )
+        self.assertEqual(f.size, 1000)
+        for _ in range(10):
+            f.read(100)
+        self.assertEqual(self.progress, [500, 1000])
+
+    def test_ReadInto(self):
+        f = ProgressFile(io.BytesIO(bytes(100)), self.progress.append, size=100)
+        buffer = bytearray(60)
+        f.readinto(buffer)
+        f.readinto(buffer)
+        self.assertEqual(self.progress, [60, 100])
+
+    def test_Write(self):
+        output = io.BytesIO()
+        with ProgressFile(output, self.progress.append, size=1000, percent=50) as f:
+            for _ in range(9):
+                f.write(bytes(100))
+            self.assertEqual(self.progress, [500])
+        self.assertEqual(self.progress, [500, 900])
+
+    @mock.patch("time.monotonic")
+    def test_Interval(self, monotonic):
+        monotonic.return_value = 0
+        f = ProgressFile(io.BytesIO(bytes(1000)), self.progress.append)
+        self.assertEqual(f.interval, 1)
+        f.read(100)
+        monotonic.return_value = 0.5
+        f.read(100)
+        monotonic.return_value = 1.5
+        f.read(100)
+        self.assertEqual(self.progress, [300])
+
+    def test_SeekBackIsMonotonic(self):
+        f = ProgressFile(io.BytesIO(bytes(100)), self.progress.append, size=100)
+        f.read(60)
+        f.seek(0)
+        f.read(60)
+        f.read()
+        self.assertEqual(self.progress, [60, 100])
+
+    def test_Delegation(self):
+        f = ProgressFile(io.BytesIO(b"abc"), self.progress.append)
+        self.assertTrue(f.seekable())
+        self.assertEqual(f.getvalue(), b"abc")
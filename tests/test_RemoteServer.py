@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import tempfile
+import threading
+import unittest
+
+import utils
+
+RemoteServer = utils.annexremote.RemoteServer
+RemoteShim = utils.annexremote.RemoteShim
+
+
+class CountingRemote(utils.MinimalRemote):
+    prepared = 0
+    stored = []
+
+    def prepare(self):
+        CountingRemote.prepared += 1
+
+    def transfer_store(self, key, file_):
+        CountingRemote.stored.append((self.annex.getgitdir(), file_))
+
+
+@unittest.skipUnless(hasattr(utils.annexremote.socket, "AF_UNIX"), "needs AF_UNIX")
+class TestRemoteServer(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        CountingRemote.prepared = 0
+        CountingRemote.stored = []
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, "s.sock")
+        self.server = RemoteServer(CountingRemote, self.path, idle_timeout=30)
+        self.thread = threading.Thread(target=self.server.serve, daemon=True)
+        self.thread.start()
+        for _ in range(100):
+            if os.path.exists(self.path):
+                break
+            threading.Event().wait(0.01)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join(5)
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    def _session(self, session):
+        output = io.StringIO()
+        RemoteShim(self.path).relay(io.StringIO(session), output)
+        return output.getvalue().splitlines()
+
+    def test_PrepareOnce(self):
+        for _ in range(3):
+            lines = self._session("PREPARE\nVALUE uuid-1\n")
+            self.assertEqual(lines, ["VERSION 1", "GETUUID", "PREPARE-SUCCESS"])
+        self.assertEqual(CountingRemote.prepared, 1)
+        self._session("PREPARE\nVALUE uuid-2\n")
+        self.assertEqual(CountingRemote.prepared, 2)
+
+    def test_AbsolutePaths(self):
+        lines = self._session(
+            "PREPARE\nVALUE uuid-1\nTRANSFER STORE Key tmp/File name\nVALUE /repo/.git\n"
+        )
+        self.assertEqual(lines[-1], "TRANSFER-SUCCESS STORE Key")
+        self.assertEqual(
+            CountingRemote.stored,
+            [("/repo/.git", os.path.join(os.getcwd(), "tmp/File name"))],
+        )
+
+    def test_IdleExpiry(self):
+        self._session("PREPARE\nVALUE uuid-1\n")
+        self.server.idle_timeout = 0
+        self._session("PREPARE\nVALUE uuid-1\n")
+        self.assertEqual(CountingRemote.prepared, 2)
+
+
+class TestRemoteShim(unittest.TestCase):
+    def test_RewriteRequest(self):
+        shim = RemoteShim("unused")
+        shim.cwd = "/repo"
+        self.assertEqual(
+            shim.rewrite_request("J 2 TRANSFER RETRIEVE Key a b"),
+            "J 2 TRANSFER RETRIEVE Key /repo/a b",
+        )
+        self.assertEqual(
+            shim.rewrite_request("TRANSFER STORE Key /abs/file"),
+            "TRANSFER STORE Key /abs/file",
+        )
+        self.assertEqual(shim.rewrite_request("VALUE foo"), "VALUE foo")
+        shim._gitdir_queries.add("3")
+        self.assertEqual(shim.rewrite_request("J 3 VALUE .git"), "J 3 VALUE /repo/.git")
+        self.assertEqual(shim.rewrite_request("CHECKPRESENT Key"), "CHECKPRESENT Key")
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import stat
+import tempfile
+import threading
+from unittest import mock
+
+import utils
+
+RemoteError = utils.annexremote.RemoteError
+SessionReplay = utils.annexremote.SessionReplay
+
+
+class TestSessionReplay(utils.GitAnnexTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.transcript = os.path.join(self.tempdir.name, "transcript.log")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    def _record(self, session):
+        with mock.patch.dict(os.environ, {"ANNEXREMOTE_RECORD": self.transcript}):
+            self.annex.Listen(io.StringIO(session))
+
+    def _write_transcript(self, events):
+        with open(self.transcript, "w") as f:
+            for offset, (direction, line) in enumerate(events):
+                f.write("{:.6f} {} {}\n".format(offset / 1000, direction, line))
+
+    def _replay_master(self):
+        annex = utils.annexremote.Master()
+        remote = mock.MagicMock(wraps=utils.DummyRemote(annex))
+        annex.LinkRemote(remote)
+        return annex, remote
+
+    def _replay(self, replay, annex, timeout=5):
+        result = {}
+
+        def run():
+            try:
+                replay.run(annex)
+            except SystemExit:
+                result["exit"] = True
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(timeout)
+        self.assertFalse(thread.is_alive(), "Replay did not finish")
+        return result
+
+    def _events(self):
+        with open(self.transcript) as f:
+            return [tuple(line.rstrip("\n").split(" ", 2)[1:]) for line in f]
+
+    def test_Record(self):
+        self.remote.checkpresent.return_value = True
+        self._record("CHECKPRESENT Key\n")
+        with open(self.transcript) as f:
+            offsets = [float(line.split(" ", 1)[0]) for line in f]
+        self.assertEqual(
+            self._events(),
+            [
+                (">", "VERSION 1"),
+                ("<", "CHECKPRESENT Key"),
+                (">", "CHECKPRESENT-SUCCESS Key"),
+            ],
+        )
+        self.assertEqual(offsets, sorted(offsets))
+
+    def test_RecordPermissions(self):
+        self._record("PREPARE\n")
+        self.assertEqual(stat.S_IMODE(os.stat(self.transcript).st_mode), 0o600)
+
+    def test_RecordMasksCredentials(self):
+        self.remote.prepare.side_effect = lambda: (
+            self.annex.setcreds("mycreds", "User", "Password"),
+            self.annex.getcreds("mycreds"),
+        )
+        self._record("PREPARE\nCREDS User Password\n")
+        events = self._events()
+        self.assertIn((">", "SETCREDS mycreds *** ***"), events)
+        self.assertIn(("<", "CREDS *** ***"), events)
+        self.assertNotIn("Password", open(self.transcript).read())
+
+    def test_RecordPid(self):
+        self.transcript = os.path.join(self.tempdir.name, "{pid}.log")
+        self._record("PREPARE\n")
+        self.assertTrue(
+            os.path.exists(os.path.join(self.tempdir.name, f"{os.getpid()}.log"))
+        )
+
+    def test_Replay(self):
+        def transfer_store(key, file_):
+            self.annex.progress(10)
+            self.annex.getconfig("directory")
+
+        self.remote.transfer_store.side_effect = transfer_store
+        self._record("PREPARE\nTRANSFER STORE Key File\nVALUE /foo\nREMOVE Key\n")
+
+        annex, remote = self._replay_master()
+        directories = []
+        remote.transfer_store.side_effect = lambda key, file_: directories.append(
+            annex.getconfig("directory")
+        )
+        self._replay(SessionReplay(self.transcript), annex)
+
+        remote.prepare.assert_called_once_with()
+        remote.transfer_store.assert_called_once_with("Key", "File")
+        remote.remove.assert_called_once_with("Key")
+        self.assertEqual(directories, ["/foo"])
+
+    def test_ReplayJobs(self):
+        self._write_transcript(
+            [
+                (">", "VERSION 1"),
+                ("<", "EXTENSIONS ASYNC"),
+                (">", "EXTENSIONS ASYNC"),
+                ("<", "J 1 TRANSFER STORE Key1 File"),
+                ("<", "J 2 CHECKPRESENT Key3"),
+                (">", "J 1 GETUUID"),
+                ("<", "J 1 VALUE uuid"),
+                (">", "J 2 CHECKPRESENT-FAILURE Key3"),
+                (">", "J 1 TRANSFER-SUCCESS STORE Key1"),
+                ("<", "J 1 TRANSFER STORE Key2 File"),
+                (">", "J 1 GETUUID"),
+                ("<", "J 1 VALUE uuid"),
+                (">", "J 1 TRANSFER-SUCCESS STORE Key2"),
+            ]
+        )
+
+        annex, remote = self._replay_master()
+        annex.EnableJobs()
+        uuids = []
+        remote.transfer_store.side_effect = lambda key, file_: uuids.append(
+            annex.getuuid()
+        )
+        replay = SessionReplay(self.transcript)
+        self._replay(replay, annex)
+
+        self.assertEqual(remote.transfer_store.call_count, 2)
+        self.assertEqual(uuids, ["uuid", "uuid"])
+        self.assertIn("J 1 TRANSFER-SUCCESS STORE Key1", replay.output)
+        self.assertIn("J 1 TRANSFER-SUCCESS STORE Key2", replay.output)
+        self.assertIn("J 2 CHECKPRESENT-FAILURE Key3", replay.output)
+
+    def test_ReplayUnmatchedValue(self):
+        self._write_transcript(
+            [
+                (">", "VERSION 1"),
+                ("<", "VALUE stray"),
+                ("<", "REMOVE Key"),
+                (">", "REMOVE-SUCCESS Key"),
+            ]
+        )
+        annex, remote = self._replay_master()
+        self._replay(SessionReplay(self.transcript), annex)
+        remote.remove.assert_called_once_with("Key")
+
+    def test_ReplayUnrecordedQuery(self):
+        self._record("TRANSFER STORE Key File\n")
+
+        annex, remote = self._replay_master()
+        remote.transfer_store.side_effect = lambda key, file_: annex.getuuid()
+        replay = SessionReplay(self.transcript)
+        self.assertTrue(self._replay(replay, annex).get("exit"))
+        self.assertTrue(replay.output[-1].startswith("ERROR"))
+
+    def test_ReplayEmptyRecordedReply(self):
+        self._write_transcript(
+            [
+                (">", "VERSION 1"),
+                ("<", "TRANSFER STORE Key File"),
+                (">", "GETUUID"),
+                (">", "TRANSFER-SUCCESS STORE Key"),
+            ]
+        )
+        annex, remote = self._replay_master()
+        remote.transfer_store.side_effect = lambda key, file_: annex.getuuid()
+        replay = SessionReplay(self.transcript)
+        self.assertTrue(self._replay(replay, annex).get("exit"))
+        self.assertTrue(replay.output[-1].startswith("ERROR"))
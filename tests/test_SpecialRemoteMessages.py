@@ -436,6 +436,33 @@ class TestSpecialRemoteMessages(utils.GitAnnexTestCase):
             function_result,
         )
 
+    def test_GeturlsIter(self):
+        self.annex.input = io.StringIO("VALUE Url1\nVALUE Url2\nVALUE\n")
+        urls = self.annex.geturls_iter("Key", "Prefix")
+        self.assertEqual(
+            utils.first_buffer_line(self.output).rstrip(), "GETURLS Key Prefix"
+        )
+        self.assertEqual(list(urls), ["Url1", "Url2"])
+
+    def test_GeturlsIterStopEarly(self):
+        self.annex.input = io.StringIO(
+            "VALUE Url1\nVALUE Url2\nVALUE Url3\nVALUE\nVALUE /foo\n"
+        )
+        urls = self.annex.geturls_iter("Key", "Prefix")
+        self.assertEqual(next(urls), "Url1")
+        urls.close()
+        self.assertEqual(self.annex.getconfig("directory"), "/foo")
+
+    def test_GeturlsIterNotStarted(self):
+        self.annex.input = io.StringIO("VALUE Url1\nVALUE\nVALUE /foo\n")
+        self.annex.geturls_iter("Key", "")
+        self.assertEqual(self.annex.getconfig("directory"), "/foo")
+
+    def test_GeturlsIterUnexpected(self):
+        self.annex.input = io.StringIO("VALUE Url1\nERROR\n")
+        with self.assertRaises(utils.annexremote.UnexpectedMessage):
+            list(self.annex.geturls_iter("Key", "Prefix"))
+
     def test_Debug(self):
         function_to_call = self.annex.debug
         function_parameters = ("message",)
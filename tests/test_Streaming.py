@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import tempfile
+import threading
+import unittest
+
+import utils
+
+annexremote = utils.annexremote
+
+
+class MemoryRemote(annexremote.StreamingRemote):
+    buffer_pool = annexremote.BufferPool(buffer_size=4, count=1)
+
+    def __init__(self, annex):
+        super().__init__(annex)
+        self.store = {}
+
+    def initremote(self):
+        pass
+
+    def prepare(self):
+        pass
+
+    def store_stream(self, key, chunks, size):
+        data = bytearray()
+        for chunk in chunks:
+            self.assertIsMemoryview(chunk)
+            data += chunk
+        if len(data) != size:
+            raise annexremote.RemoteError("Size mismatch")
+        self.store[key] = bytes(data)
+
+    def retrieve_stream(self, key, writer):
+        data = self.store[key]
+        for i in range(0, len(data), 4):
+            writer.write(data[i : i + 4])
+
+    def checkpresent(self, key):
+        return key in self.store
+
+    def remove(self, key):
+        self.store.pop(key, None)
+
+    @staticmethod
+    def assertIsMemoryview(chunk):
+        assert isinstance(chunk, memoryview)
+
+
+class TestStreamingRemote(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.output = io.StringIO()
+        self.annex = annexremote.Master(self.output)
+        self.remote = MemoryRemote(self.annex)
+        self.annex.LinkRemote(self.remote)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.tempdir.name, "file with spaces")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    def test_StoreAndRetrieve(self):
+        with open(self.file, "wb") as f:
+            f.write(b"0123456789")
+        self.annex.Listen(io.StringIO("TRANSFER STORE Key {}".format(self.file)))
+        self.assertEqual(self.remote.store["Key"], b"0123456789")
+        self.assertEqual(
+            utils.buffer_lines(self.output)[1:],
+            ["PROGRESS 4", "PROGRESS 8", "PROGRESS 10", "TRANSFER-SUCCESS STORE Key"],
+        )
+
+        os.unlink(self.file)
+        self.output.seek(0)
+        self.output.truncate()
+        self.annex.Listen(io.StringIO("TRANSFER RETRIEVE Key {}".format(self.file)))
+        with open(self.file, "rb") as f:
+            self.assertEqual(f.read(), b"0123456789")
+        self.assertEqual(
+            utils.buffer_lines(self.output)[1:],
+            [
+                "PROGRESS 4",
+                "PROGRESS 8",
+                "PROGRESS 10",
+                "TRANSFER-SUCCESS RETRIEVE Key",
+            ],
+        )
+
+    def test_BufferReturnedOnFailure(self):
+        with open(self.file, "wb") as f:
+            f.write(b"0123456789")
+
+        def store_stream(key, chunks, size):
+            next(chunks)
+            raise annexremote.RemoteError("Failed")
+
+        self.remote.store_stream = store_stream
+        self.annex.Listen(io.StringIO("TRANSFER STORE Key {}".format(self.file)))
+        self.assertEqual(
+            utils.last_buffer_line(self.output), "TRANSFER-FAILURE STORE Key Failed"
+        )
+        # the only buffer of the pool must be available again
+        buffer = MemoryRemote.buffer_pool.acquire()
+        MemoryRemote.buffer_pool.release(buffer)
+
+
+class TestBufferPool(unittest.TestCase):
+    def test_Bounded(self):
+        pool = annexremote.BufferPool(buffer_size=8, count=2)
+        first = pool.acquire()
+        second = pool.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            pool.acquire()
+            acquired.set()
+
+        threading.Thread(target=acquire, daemon=True).start()
+        self.assertFalse(acquired.wait(0.1))
+        pool.release(first)
+        self.assertTrue(acquired.wait(5))
+        self.assertEqual(len(second), 8)
+
+    def test_Reuse(self):
+        pool = annexremote.BufferPool(buffer_size=8, count=2)
+        buffer = pool.acquire()
+        pool.release(buffer)
+        self.assertIs(pool.acquire(), buffer)
+
+
+class CompressedMemoryRemote(MemoryRemote):
+    buffer_pool = annexremote.BufferPool(buffer_size=1024, count=1)
+    compressor = annexremote.Compressor(workers=2)
+
+    def store_stream(self, key, chunks, size):
+        if size is not None:
+            raise annexremote.RemoteError("Size of compressed content is not known")
+        self.store[key] = b"".join(bytes(chunk) for chunk in chunks)
+
+    def retrieve_stream(self, key, writer):
+        data = self.store[key]
+        for i in range(0, len(data), 7):
+            writer.write(data[i : i + 7])
+
+
+class TestCompressedStreamingRemote(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.output = io.StringIO()
+        self.annex = annexremote.Master(self.output)
+        self.remote = CompressedMemoryRemote(self.annex)
+        self.annex.LinkRemote(self.remote)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.tempdir.name, "file")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    def _roundtrip(self, data):
+        with open(self.file, "wb") as f:
+            f.write(data)
+        self.annex.Listen(io.StringIO("TRANSFER STORE Key {}".format(self.file)))
+        os.unlink(self.file)
+        self.annex.Listen(io.StringIO("TRANSFER RETRIEVE Key {}".format(self.file)))
+        self.assertEqual(
+            utils.last_buffer_line(self.output), "TRANSFER-SUCCESS RETRIEVE Key"
+        )
+        with open(self.file, "rb") as f:
+            self.assertEqual(f.read(), data)
+        return self.remote.store["Key"]
+
+    def test_Compressible(self):
+        stored = self._roundtrip(b"0123456789" * 1000)
+        self.assertLess(len(stored), 2000)
+
+    def test_Incompressible(self):
+        data = os.urandom(5000)
+        stored = self._roundtrip(data)
+        self.assertEqual(stored[annexremote.Compressor.HEADER.size :], data)
+
+    def test_Empty(self):
+        self._roundtrip(b"")
+
+    def test_Uncompressed(self):
+        # content stored before compression was enabled
+        self.remote.store["Key"] = b"plain content"
+        self.annex.Listen(io.StringIO("TRANSFER RETRIEVE Key {}".format(self.file)))
+        with open(self.file, "rb") as f:
+            self.assertEqual(f.read(), b"plain content")
+
+
+class TestCompressor(unittest.TestCase):
+    def _roundtrip(self, compressor, chunks):
+        output = io.BytesIO()
+        decompressor = annexremote.Decompressor(output)
+        for chunk in compressor.compress(chunks):
+            decompressor.write(chunk)
+        decompressor.close()
+        return output.getvalue()
+
+    def test_Codecs(self):
+        chunks = [bytes([i]) * 4096 for i in range(20)]
+        for codec in ("zlib", "bz2", "lzma"):
+            compressor = annexremote.Compressor(codec, workers=3)
+            self.assertEqual(self._roundtrip(compressor, chunks), b"".join(chunks))
+
+    def test_Truncated(self):
+        compressed = b"".join(
+            bytes(c) for c in annexremote.Compressor().compress([b"a" * 4096])
+        )
+        decompressor = annexremote.Decompressor(io.BytesIO())
+        decompressor.write(compressed[:-1])
+        with self.assertRaises(annexremote.RemoteError):
+            decompressor.close()
+
+    def test_UnknownCodec(self):
+        with self.assertRaises(ValueError):
+            annexremote.Compressor("zstd")
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import stat
+import tempfile
+import threading
+import time
+
+import utils
+
+RemoteError = utils.annexremote.RemoteError
+TokenCache = utils.annexremote.TokenCache
+
+
+class TestTokenCache(utils.MinimalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.logins = 0
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        super().tearDown()
+
+    def _cache(self, **kwargs):
+        self.annex.input = io.StringIO(
+            "VALUE {}\nVALUE uuid\n".format(self.tempdir.name)
+        )
+        cache = TokenCache(self.annex, **kwargs)
+        cache.path()
+        return cache
+
+    def _login(self, lifetime=3600):
+        def login():
+            self.logins += 1
+            return "token{}".format(self.logins), lifetime
+
+        return login
+
+    def test_Path(self):
+        cache = self._cache()
+        self.assertEqual(
+            cache.path(),
+            os.path.join(
+                self.tempdir.name, "annex", "annexremote", "tokens", "uuid.json"
+            ),
+        )
+        self.assertEqual(utils.buffer_lines(self.output), ["GETGITDIR", "GETUUID"])
+
+    def test_Reuse(self):
+        self.assertEqual(self._cache().get("api", self._login()), "token1")
+        # another process
+        self.assertEqual(self._cache().get("api", self._login()), "token1")
+        self.assertEqual(self.logins, 1)
+
+    def test_Permissions(self):
+        cache = self._cache()
+        cache.get("api", self._login())
+        self.assertEqual(stat.S_IMODE(os.stat(cache.path()).st_mode), 0o600)
+        self.assertEqual(
+            stat.S_IMODE(os.stat(os.path.dirname(cache.path())).st_mode), 0o700
+        )
+
+    def test_Expired(self):
+        cache = self._cache()
+        cache.get("api", self._login(lifetime=-1))
+        self.assertEqual(cache.get("api", self._login()), "token2")
+
+    def test_Fingerprint(self):
+        cache = self._cache()
+        cache.get("api", self._login(), fingerprint="a")
+        self.assertEqual(cache.get("api", self._login(), fingerprint="a"), "token1")
+        self.assertEqual(cache.get("api", self._login(), fingerprint="b"), "token2")
+
+    def test_Invalidate(self):
+        cache = self._cache()
+        cache.get("api", self._login())
+        cache.invalidate("api")
+        self.assertEqual(cache.get("api", self._login()), "token2")
+
+    def test_BackgroundRefresh(self):
+        cache = self._cache(refresh_margin=60)
+        cache.get("api", self._login(lifetime=30))
+        refreshed = threading.Event()
+
+        def login():
+            refreshed.set()
+            return "fresh", 3600
+
+        # the old token is still handed out while refreshing
+        self.assertEqual(cache.get("api", login), "token1")
+        self.assertTrue(refreshed.wait(5))
+        for _ in range(100):
+            if cache.get("api", self._login()) == "fresh":
+                break
+            time.sleep(0.01)
+        self.assertEqual(cache.get("api", self._login()), "fresh")
+
+    def test_LoginFailure(self):
+        def login():
+            raise RemoteError("Wrong password")
+
+        with self.assertRaises(RemoteError):
+            self._cache().get("api", login)
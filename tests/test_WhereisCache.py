@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import io
+import unittest
+
+import utils
+
+RemoteError = utils.annexremote.RemoteError
+WhereisCache = utils.annexremote.WhereisCache
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestWhereisCache(utils.GitAnnexTestCase):
+    def setUp(self):
+        super().setUp()
+        self.remote.whereis_cache = WhereisCache()
+        self.remote.whereis.return_value = "https://example.com/Key"
+
+    def _whereis(self, *lines):
+        self.annex.Listen(io.StringIO("\n".join(lines)))
+        return utils.buffer_lines(self.output)[1:]
+
+    def test_Cached(self):
+        replies = self._whereis("WHEREIS Key", "WHEREIS Key")
+        self.assertEqual(replies, ["WHEREIS-SUCCESS https://example.com/Key"] * 2)
+        self.remote.whereis.assert_called_once_with("Key")
+
+    def test_FailureCached(self):
+        self.remote.whereis.return_value = None
+        self.assertEqual(
+            self._whereis("WHEREIS Key", "WHEREIS Key"), ["WHEREIS-FAILURE"] * 2
+        )
+        self.remote.whereis.assert_called_once_with("Key")
+
+    def test_Store(self):
+        self._whereis("WHEREIS Key", "TRANSFER STORE Key File", "WHEREIS Key")
+        self.assertEqual(self.remote.whereis.call_count, 2)
+
+    def test_FailedStore(self):
+        self.remote.transfer_store.side_effect = RemoteError("failed")
+        self._whereis("WHEREIS Key", "TRANSFER STORE Key File", "WHEREIS Key")
+        self.remote.whereis.assert_called_once_with("Key")
+
+    def test_Remove(self):
+        self._whereis("WHEREIS Key", "REMOVE Key", "WHEREIS Key", "WHEREIS Key2")
+        self.assertEqual(self.remote.whereis.call_count, 3)
+
+    def test_Export(self):
+        self._whereis(
+            "WHEREIS Key",
+            "EXPORT Name",
+            "TRANSFEREXPORT STORE Key File",
+            "WHEREIS Key",
+            "EXPORT Name",
+            "REMOVEEXPORT Key",
+            "WHEREIS Key",
+        )
+        self.assertEqual(self.remote.whereis.call_count, 3)
+
+
+class TestWhereisCacheEntries(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.calls = []
+
+    def _whereis(self, key):
+        self.calls.append(key)
+        return key.lower()
+
+    def test_Ttl(self):
+        cache = WhereisCache(ttl=10, clock=self.clock)
+        self.assertEqual(cache.lookup("Key", self._whereis), "key")
+        self.clock.now = 9
+        self.assertEqual(cache.lookup("Key", self._whereis), "key")
+        self.clock.now = 10
+        self.assertEqual(cache.lookup("Key", self._whereis), "key")
+        self.assertEqual(self.calls, ["Key", "Key"])
+
+    def test_Lru(self):
+        cache = WhereisCache(max_entries=2, clock=self.clock)
+        cache.lookup("Key1", self._whereis)
+        cache.lookup("Key2", self._whereis)
+        cache.lookup("Key1", self._whereis)
+        cache.lookup("Key3", self._whereis)
+        cache.lookup("Key1", self._whereis)
+        cache.lookup("Key2", self._whereis)
+        self.assertEqual(self.calls, ["Key1", "Key2", "Key3", "Key2"])
+
+    def test_InvalidatedWhileLookingUp(self):
+        cache = WhereisCache(clock=self.clock)
+
+        def whereis(key):
+            cache.invalidate(key)
+            return self._whereis(key)
+
+        cache.lookup("Key", whereis)
+        cache.lookup("Key", self._whereis)
+        self.assertEqual(self.calls, ["Key", "Key"])
+
+    def test_ErrorNotCached(self):
+        cache = WhereisCache(clock=self.clock)
+
+        def whereis(key):
+            raise RemoteError("failed")
+
+        with self.assertRaises(RemoteError):
+            cache.lookup("Key", whereis)
+        self.assertEqual(cache.lookup("Key", self._whereis), "key")
+
+    def test_Clear(self):
+        cache = WhereisCache(clock=self.clock)
+        cache.lookup("Key", self._whereis)
+        cache.clear()
+        cache.lookup("Key", self._whereis)
+        self.assertEqual(self.calls, ["Key", "Key"])
+
+    def test_InvalidMaxEntries(self):
+        with self.assertRaises(ValueError):
+            WhereisCache(max_entries=0)